@@ -0,0 +1,5 @@
+""" Benchmarks of the pysedm pipeline stages on a synthetic night.
+
+Run them with asv (`asv run --python=same` from the repository root)
+or without it using `python -m benchmarks [pattern]`.
+"""
@@ -0,0 +1,79 @@
+""" Minimal runner for environments without asv.
+
+Each benchmark runs in its own process (fork) such that the peak memory is
+the one of the stage only. Usage:
+
+    python -m benchmarks [pattern]
+
+pattern is a regular expression on "Class.method" (e.g. "ExtractCube|Sodium").
+"""
+
+import re
+import sys
+import time
+import itertools
+import resource
+import multiprocessing
+
+from . import bench_pipeline, bench_import
+
+MODULES = [bench_pipeline, bench_import]
+
+PREFIXES = ["time_", "peakmem_", "track_"]
+
+
+def get_benchmarks(pattern=None):
+    """ list of (module, classname, methodname, param) """
+    benchmarks = []
+    for module, clsname, cls in [(m_, k_, v_) for m_ in MODULES for k_, v_ in vars(m_).items()]:
+        if not isinstance(cls, type) or cls.__module__ != module.__name__:
+            continue
+        params = getattr(cls, "params", [])
+        if len(params) == 0:
+            params = [()]
+        elif isinstance(params[0], list):
+            params = list(itertools.product(*params))
+        else:
+            params = [(p_,) for p_ in params]
+        for methname in sorted(vars(cls)):
+            if not any(methname.startswith(p_) for p_ in PREFIXES):
+                continue
+            if pattern is not None and not re.search(pattern, "%s.%s"%(clsname, methname)):
+                continue
+            benchmarks += [(module, clsname, methname, param) for param in params]
+    return benchmarks
+
+def _run_benchmark_(module, clsname, methname, param, queue):
+    """ setup + single call of the benchmark, results sent to queue """
+    bench = getattr(module, clsname)()
+    if hasattr(bench, "setup"):
+        bench.setup(*param)
+    t0 = time.perf_counter()
+    value = getattr(bench, methname)(*param)
+    dt = time.perf_counter() - t0
+    queue.put([dt, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024., value])
+
+def run(pattern=None):
+    """ Run the benchmarks and print one line per benchmark """
+    ctx = multiprocessing.get_context("fork")
+    for module, clsname, methname, param in get_benchmarks(pattern):
+        name  = "%s.%s%s"%(clsname, methname, "" if len(param)==0 else str(list(param)))
+        queue = ctx.Queue()
+        proc  = ctx.Process(target=_run_benchmark_, args=(module, clsname, methname, param, queue))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            print("%-60s FAILED"%name)
+            continue
+        dt, peakmem, value = queue.get()
+        method = getattr(getattr(module, clsname), methname)
+        if methname.startswith("track_"):
+            print("%-60s %10.2f %s"%(name, value, getattr(method, "unit", "")))
+        elif methname.startswith("peakmem_"):
+            print("%-60s %10.1f MB"%(name, peakmem))
+        else:
+            print("%-60s %10.3f s"%(name, dt))
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    run(sys.argv[1] if len(sys.argv)>1 else None)
@@ -0,0 +1,93 @@
+""" Import time of the package and start-up time of the bin/ entry points.
+
+Every measurement runs in a fresh interpreter with `python -X importtime`;
+the value is the sum of the cumulative time of the top-level imports.
+`python -m benchmarks.bench_import` checks the measurements against IMPORT_BUDGET
+and exits with an error if one of them is over budget or cannot be imported
+(tests/test_import.py only checks that the pipeline imports stay lazy).
+"""
+
+import os
+import re
+import sys
+import subprocess
+
+ROOTPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BINPATH  = os.path.join(ROOTPATH, "bin")
+
+# [s] budget of each measurement
+IMPORT_BUDGET = {"pysedm":                0.3,
+                 "pysedm.io":             0.3,
+                 "pysedm.script.pipeline":0.5,
+                 "pysedm.script.watch":   0.5,
+                 "bin/ccd_to_cube.py":    4.,
+                 "bin/extract_star.py":   4.,
+                 "bin/cube_quality.py":   3.,
+                 "bin/derive_wavesolution.py": 1.,
+                 "bin/display_cube.py":   3.,
+                 "bin/quality_check.py":  1.,
+                 "bin/watch_night.py":    1.}
+
+_IMPORTTIME_LINE = re.compile(r"import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)")
+
+
+def get_importtime(target):
+    """ Total import time [s] of the given module name or bin/ script.
+
+    Scripts are run with --help, such that only the imports made before
+    the argument parsing are measured.
+    """
+    if target.startswith("bin/"):
+        cmd = [sys.executable, "-X", "importtime", os.path.join(BINPATH, target[4:]), "--help"]
+    else:
+        cmd = [sys.executable, "-X", "importtime", "-c", "import %s"%target]
+    # - measure this checkout, even when it is not installed
+    env  = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOTPATH]+[p_ for p_ in
+                                            [os.environ.get("PYTHONPATH")] if p_]))
+    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True, env=env)
+    if proc.returncode != 0:
+        raise RuntimeError("%s failed:\n%s"%(" ".join(cmd), proc.stderr.splitlines()[-1]))
+    cumulative = [int(m.group(1)) for m in map(_IMPORTTIME_LINE.match, proc.stderr.splitlines())
+                      if m is not None and len(m.group(2)) == 1] # top-level imports only
+    return sum(cumulative) / 1e6
+
+def check_import_budget(budget=IMPORT_BUDGET):
+    """ Measure every target of the budget.
+
+    Returns
+    -------
+    dict {target: (importtime [s] or the RuntimeError if the import fails, budget [s])}
+    """
+    results = {}
+    for target, limit in budget.items():
+        try:
+            results[target] = (get_importtime(target), limit)
+        except RuntimeError as e:
+            results[target] = (e, limit)
+    return results
+
+
+class ImportTime( object ):
+    """ import time of the package modules and of the bin/ entry points """
+    number  = 1
+    repeat  = 3
+    params  = list(IMPORT_BUDGET.keys())
+    param_names = ["target"]
+
+    def track_importtime(self, target):
+        return get_importtime(target)
+    track_importtime.unit = "s"
+
+
+if __name__ == "__main__":
+    failed = False
+    for target, (importtime, limit) in check_import_budget().items():
+        if isinstance(importtime, RuntimeError):
+            failed = True
+            print("%-30s   IMPORT FAILED: %s"%(target, importtime))
+            continue
+        over = importtime > limit
+        failed |= over
+        print("%-30s %7.3f s  (budget %.1f s)%s"%(target, importtime, limit, "  OVER BUDGET" if over else ""))
+    sys.exit(1 if failed else 0)
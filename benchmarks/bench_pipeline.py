@@ -0,0 +1,294 @@
+""" Per-stage benchmarks of the nightly pipeline (asv format).
+
+- time_*    : wall time of the stage
+- peakmem_* : peak resident memory of the process running the stage
+- track_*   : throughput in the unit of the stage (traces/s, columns/s, slices/s...)
+"""
+
+from . import common
+
+# ================== #
+#   Trace Matching   #
+# ================== #
+class TraceMasks( object ):
+    """ verts_to_mask and load_trace_masks """
+    timeout = 600
+    number  = 1
+    repeat  = 3
+    NTRACES_SINGLE = 20
+
+    def setup(self):
+        self.sim    = common.get_simulator()
+        self.vertices = self.sim.get_trace_vertices()
+
+    def _verts_to_mask_loop(self):
+        from pysedm.spectralmatching import verts_to_mask
+        for verts in self.vertices[:self.NTRACES_SINGLE]:
+            verts_to_mask(verts)
+
+    def _load_trace_masks(self):
+        from pysedm.spectralmatching import load_trace_masks
+        load_trace_masks(self.sim.get_tracematch(), notebook=False, ncore=common.NCORE)
+
+    def time_verts_to_mask(self):
+        self._verts_to_mask_loop()
+
+    def track_verts_to_mask(self):
+        return common.throughput(self._verts_to_mask_loop, self.NTRACES_SINGLE)
+    track_verts_to_mask.unit = "traces/s"
+
+    def time_load_trace_masks(self):
+        self._load_trace_masks()
+
+    def peakmem_load_trace_masks(self):
+        self._load_trace_masks()
+
+    def track_load_trace_masks(self):
+        return common.throughput(self._load_trace_masks, self.sim.ntraces)
+    track_load_trace_masks.unit = "traces/s"
+
+# ================== #
+#   Background       #
+# ================== #
+class Background( object ):
+    """ background.fit_background (one fit per ccd column slice) """
+    timeout = 900
+    number  = 1
+    repeat  = 2
+    JUMP    = 10
+
+    def setup(self):
+        self.ccd = common.get_science_ccd()
+        self.ncolumns = len(range(self.ccd.width)[2::self.JUMP])
+
+    def _fit_background(self):
+        from pysedm.background import fit_background
+        fit_background(self.ccd, start=2, jump=self.JUMP, ncore=common.NCORE, notebook=False)
+
+    def time_fit_background(self):
+        self._fit_background()
+
+    def peakmem_fit_background(self):
+        self._fit_background()
+
+    def track_fit_background(self):
+        return common.throughput(self._fit_background, self.ncolumns)
+    track_fit_background.unit = "columns/s"
+
+
+class StdBackground( object ):
+    """ background.fit_background of a standard star (continuum + gaussian per column) """
+    timeout = 1800
+    number  = 1
+    repeat  = 2
+    params  = [True, False]
+    param_names = ["batch"]
+    JUMP    = 10
+
+    def setup(self, batch):
+        self.ccd = common.get_science_ccd()
+        self.ncolumns = len(range(self.ccd.width)[2::self.JUMP])
+
+    def _fit_background(self, batch):
+        from pysedm.background import fit_background
+        fit_background(self.ccd, start=2, jump=self.JUMP, ncore=common.NCORE, notebook=False,
+                       is_std=True, batch=batch)
+
+    def time_fit_background(self, batch):
+        self._fit_background(batch)
+
+    def track_fit_background(self, batch):
+        return common.throughput(self._fit_background, self.ncolumns, batch)
+    track_fit_background.unit = "columns/s"
+
+# ================== #
+#   Wavelength       #
+# ================== #
+class ArcLines( object ):
+    """ get_arccollection + ArcSpectrumCollection.fit_lineposition """
+    timeout = 600
+    number  = 1
+    repeat  = 3
+    NTRACES = 10
+
+    def setup(self):
+        self.lamps = common.get_lamps()
+        self.traceindexes = common.get_tracematch().trace_indexes[:self.NTRACES]
+
+    def _fit_lines(self):
+        from pysedm.wavesolution import get_arccollection
+        for traceindex in self.traceindexes:
+            get_arccollection(traceindex, self.lamps).fit_lineposition()
+
+    def time_arccollection_fit_lineposition(self):
+        self._fit_lines()
+
+    def track_arccollection_fit_lineposition(self):
+        return common.throughput(self._fit_lines, len(self.traceindexes))
+    track_arccollection_fit_lineposition.unit = "traces/s"
+
+# ================== #
+#   Cube             #
+# ================== #
+class ExtractCube( object ):
+    """ CCD.extract_cube """
+    timeout = 600
+    number  = 1
+    repeat  = 3
+
+    def setup(self):
+        from pysedm.sedm import SEDM_LBDA
+        self.lbda     = SEDM_LBDA
+        self.ccd      = common.get_science_ccd()
+        self.wsol     = common.get_simulator().get_wavesolution()
+        self.hexagrid = common.get_hexagrid()
+
+    def _extract_cube(self):
+        self.ccd.extract_cube(self.wsol, self.lbda, hexagrid=self.hexagrid)
+
+    def time_extract_cube(self):
+        self._extract_cube()
+
+    def peakmem_extract_cube(self):
+        self._extract_cube()
+
+    def track_extract_cube(self):
+        return common.throughput(self._extract_cube, len(self.wsol.wavesolutions))
+    track_extract_cube.unit = "traces/s"
+
+class Precision( object ):
+    """ float64 vs float32 pipeline precision (utils.tools.set_precision) """
+    timeout = 900
+    number  = 1
+    repeat  = 2
+    params  = ["float64", "float32"]
+    param_names = ["precision"]
+
+    def setup(self, precision):
+        from pysedm.utils.tools import set_precision
+        from pysedm.sedm import SEDM_LBDA
+        self.lbda, self.wsol, self.hexagrid = SEDM_LBDA, common.get_simulator().get_wavesolution(), common.get_hexagrid()
+        set_precision("float64")
+        self.cube64 = common.get_science_ccd().extract_cube(self.wsol, self.lbda, hexagrid=self.hexagrid)
+        set_precision(precision)
+        self.ccd = common.get_science_ccd()
+
+    def teardown(self, precision):
+        from pysedm.utils.tools import set_precision
+        set_precision("float64")
+
+    def _extract_cube(self):
+        return self.ccd.extract_cube(self.wsol, self.lbda, hexagrid=self.hexagrid)
+
+    def peakmem_extract_cube(self, precision):
+        self._extract_cube()
+
+    def track_ccd_memory(self, precision):
+        return (self.ccd.rawdata.nbytes + self.ccd.data.nbytes + self.ccd.var.nbytes)/1024.**2
+    track_ccd_memory.unit = "MB"
+
+    def track_cube_filesize(self, precision):
+        import os, tempfile
+        cubefile = os.path.join(tempfile.mkdtemp(), "e3d_precision.fits")
+        self._extract_cube().writeto(cubefile)
+        return os.path.getsize(cubefile)/1024.**2
+    track_cube_filesize.unit = "MB"
+
+    def track_flux_difference(self, precision):
+        """ maximum |flux - flux_float64| in units of the flux error """
+        import numpy as np
+        cube = self._extract_cube()
+        return np.nanmax(np.abs(cube.data - self.cube64.data)/np.sqrt(self.cube64.variance))
+    track_flux_difference.unit = "sigma"
+
+# ================== #
+#   Flexure          #
+# ================== #
+class SodiumFlexure( object ):
+    """ Flexure.fit_cube_sodiumlines """
+    timeout = 600
+    number  = 1
+    repeat  = 3
+    params  = [True, False]
+    param_names = ["batch"]
+    NSPAXELS  = 50
+    AVERAGING = 4 # the nspaxels*averaging faintest spaxels must exist in the simulated cube
+
+    def setup(self, batch):
+        from pysedm.wavesolution import Flexure
+        self.flexure = Flexure(common.get_cube(), mapper=common.get_mapper())
+
+    def time_fit_cube_sodiumlines(self, batch):
+        self.flexure.fit_cube_sodiumlines(nspaxels=self.NSPAXELS, averaging=self.AVERAGING, batch=batch)
+
+    def track_fit_cube_sodiumlines(self, batch):
+        return common.throughput(self.flexure.fit_cube_sodiumlines, self.NSPAXELS,
+                                 nspaxels=self.NSPAXELS, averaging=self.AVERAGING, batch=batch)
+    track_fit_cube_sodiumlines.unit = "spectra/s"
+
+
+class TraceFlexure( object ):
+    """ TraceFlexure.derive_j_offset (sep extraction + expected j of every source) """
+    timeout = 600
+    number  = 1
+    repeat  = 3
+
+    def setup(self):
+        from pysedm.flexure import TraceFlexure
+        self.trace_flexure = TraceFlexure(common.get_science_ccd(), mapper=common.get_mapper())
+        # - sources counted on another ccd: the timed calls include the sep extraction
+        counter = TraceFlexure(common.get_science_ccd(), mapper=common.get_mapper())
+        counter.derive_j_offset()
+        self.nsources = len(counter.js_obs)
+
+    def _derive_j_offset(self):
+        self.trace_flexure.derive_j_offset(rerun_sepextract=True)
+
+    def time_derive_j_offset(self):
+        self._derive_j_offset()
+
+    def track_derive_j_offset(self):
+        return common.throughput(self._derive_j_offset, self.nsources)
+    track_derive_j_offset.unit = "sources/s"
+
+# ================== #
+#   Extract Star     #
+# ================== #
+class PSFExtraction( object ):
+    """ FitPSF.fit_slices and ForcePSF.fit_forcepsf """
+    timeout = 900
+    number  = 1
+    repeat  = 2
+
+    def setup(self):
+        self.cube = common.get_cube()
+        if "psfmodel" not in common._CACHE:
+            from pysedm.utils.extractstar import fit_psf_parameters
+            common._CACHE["psfmodel"] = fit_psf_parameters(self.cube, common.PSF_LBDAS,
+                                                           return_psfmodel=True)
+        self.psfmodel = common._CACHE["psfmodel"]
+
+    def _fit_slices(self):
+        from pysedm.utils.extractstar import FitPSF
+        FitPSF(self.cube).fit_slices(common.PSF_LBDAS)
+
+    def _fit_forcepsf(self):
+        from pysedm.utils.extractstar import ForcePSF
+        ForcePSF(self.cube, self.psfmodel).fit_forcepsf()
+
+    def time_fit_slices(self):
+        self._fit_slices()
+
+    def track_fit_slices(self):
+        return common.throughput(self._fit_slices, len(common.PSF_LBDAS))
+    track_fit_slices.unit = "slices/s"
+
+    def time_fit_forcepsf(self):
+        self._fit_forcepsf()
+
+    def peakmem_fit_forcepsf(self):
+        self._fit_forcepsf()
+
+    def track_fit_forcepsf(self):
+        return common.throughput(self._fit_forcepsf, len(self.cube.lbda))
+    track_fit_forcepsf.unit = "slices/s"
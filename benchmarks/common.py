@@ -0,0 +1,101 @@
+""" Fixed synthetic inputs shared by the benchmarks.
+
+Every fixture is built from the same simulated night (see pysedm.utils.simulation),
+written once in a stable temporary directory and reused by later runs.
+"""
+
+import os
+import time
+import tempfile
+import numpy as np
+
+DATE      = "20000101"
+HEXRADIUS = 8          # 217 traces
+SEED      = 1234
+NCORE     = 2
+PSF_LBDAS = np.asarray([np.linspace(4500, 8500, 7)[:-1], np.linspace(4500, 8500, 7)[1:]]).T
+
+_CACHE = {}
+
+
+def throughput(func, nitems, *args, **kwargs):
+    """ Run func once and return nitems per second """
+    t0 = time.perf_counter()
+    func(*args, **kwargs)
+    return nitems / (time.perf_counter() - t0)
+
+# ------------------ #
+#  Night & Objects   #
+# ------------------ #
+def get_simulator():
+    """ NightSimulator of the benchmark night. The ccds are written only once. """
+    if "sim" not in _CACHE:
+        from pysedm.utils.simulation import NightSimulator
+        reduxpath = os.path.join(tempfile.gettempdir(), "pysedm_bench_r%d_s%d"%(HEXRADIUS, SEED))
+        sim = NightSimulator(DATE, reduxpath=reduxpath, hexradius=HEXRADIUS, seed=SEED)
+        if not os.path.isfile(sim.nightpath+"%s_SimTruth.pkl"%DATE):
+            sim.write_night(nscience=1)
+        else:
+            from pysedm.utils.tools import load_pkl
+            sim._derived_properties["truth"] = load_pkl(sim.nightpath+"%s_SimTruth.pkl"%DATE)
+        sim.set_environ()
+        _CACHE["sim"] = sim
+    return _CACHE["sim"]
+
+def get_tracematch(with_masks=True):
+    """ TraceMatch built on the true vertices (with masks if requested) """
+    key = "tracematch_masks" if with_masks else "tracematch"
+    if key not in _CACHE:
+        if not with_masks:
+            _CACHE[key] = get_simulator().get_tracematch()
+        else:
+            # masks are slow to build, they are stored as the night product.
+            maskfile = get_simulator().nightpath+"%s_TraceMatch_WithMasks.pkl"%DATE
+            if os.path.isfile(maskfile):
+                from pysedm.spectralmatching import load_tracematcher
+                _CACHE[key] = load_tracematcher(maskfile)
+            else:
+                _CACHE[key] = get_simulator().get_tracematch(build_masks=True, notebook=False, ncore=NCORE)
+                _CACHE[key].writeto(maskfile)
+    return _CACHE[key]
+
+def get_science_ccd():
+    """ ScienceCCD of the simulated standard star, with the tracematch attached """
+    from pysedm.ccd import get_ccd
+    sim = get_simulator()
+    ccd = get_ccd(sim.nightpath+list(sim.truth["science"].keys())[0],
+                   tracematch=get_tracematch(), background=0)
+    ccd.set_default_variance()
+    return ccd
+
+def get_lamps():
+    """ Arc lamp ccds with the tracematch attached """
+    from pysedm.ccd import get_ccd
+    sim = get_simulator()
+    return [get_ccd(sim.nightpath+"%s.fits"%lamp, tracematch=get_tracematch(), background=0)
+                for lamp in sim.truth["lamps"].keys()]
+
+def get_hexagrid():
+    """ HexagoneProjection derived from the tracematch """
+    if "hexagrid" not in _CACHE:
+        _CACHE["hexagrid"] = get_tracematch(with_masks=False).extract_hexgrid()
+    return _CACHE["hexagrid"]
+
+def get_mapper(wavesolution=None):
+    """ Mapper of the night (true wavelength solution) """
+    from pysedm.mapping import Mapper
+    wsol = get_simulator().get_wavesolution() if wavesolution is None else wavesolution
+    mapper = Mapper(tracematch=get_tracematch(), hexagrid=get_hexagrid(), wavesolution=wsol)
+    mapper.derive_spaxel_mapping(list(wsol.wavesolutions.keys()))
+    return mapper
+
+def get_cube():
+    """ SEDMCube of the standard star (no flat, no atmosphere, no flexure correction) """
+    if "cube" not in _CACHE:
+        from pysedm.sedm import build_sedmcube
+        _CACHE["cube"] = build_sedmcube(get_science_ccd(), DATE,
+                                        wavesolution=get_simulator().get_wavesolution(),
+                                        hexagrid=get_hexagrid(),
+                                        flexure_corrected=False, flatfielded=False, atmcorrected=False,
+                                        savefig=False, return_cube=True)
+    return _CACHE["cube"]
@@ -35,6 +35,10 @@ if  __name__ == "__main__":
     
     parser.add_argument('--notraceflexure', action="store_true", default=False,
                         help='build cubes without trace flexure (j-ccd correction)')
+
+    parser.add_argument('--extractstar', action="store_true", default=False,
+                        help='to be used with --build. Run the automatic PSF extraction (as extract_star.py --auto) on the science cubes'+
+                            ' in memory, right after they are built, instead of reading them back.')
     
     parser.add_argument('--buildbkgd',  type=str, default=None,
                         help='Build a ccd background of the given target or target list (csv) e.g. --build dome or --build dome,Hg,Cd')
@@ -52,6 +56,10 @@ if  __name__ == "__main__":
     parser.add_argument('--tracematchnomasks', action="store_true", default=False,
                         help='build te tracematch solution for the given night without saved the masks')
     
+    parser.add_argument('--tracematchref', type=str, default=None,
+                        help='YYYYMMDD of a reference night. The tracematch, hexagrid and wavelength solution are obtained by registering the dome on the reference one.'+
+                            ' The trace masks are always saved. Falls back to --tracematch --hexagrid --wavesol if the registration fails.')
+    
     # - Hexagonal Grid
     parser.add_argument('--hexagrid', action="store_true", default=False,
                         help='build the hexagonal grid (index<->qr<->xy) for the given night')
@@ -77,14 +85,28 @@ if  __name__ == "__main__":
     parser.add_argument('--flatref',  type=str, default="dome",
                         help='Build the flat fielding for the night ')
     
+    parser.add_argument('--flatfromcube', action="store_true", default=False,
+                        help='Measure the flat on the reference cube (built if needed) instead of directly on the reference ccd')
+
     parser.add_argument('--flatlbda',  type=str, default="7000,9000",
                         help='The wavelength range for the flat field. Format: min,max [in Angstrom] ')
     
+    # ----------------- #
+    #  Make-style       #
+    # ----------------- #
+    parser.add_argument('--make', type=str, default=None,
+                        help='Build only what is out of date (missing or with modified inputs) following the product dependencies.'+
+                            ' Set "*" for the whole night or a regex on the node names (e.g. --make "^cube:|^flat$")')
+
+    parser.add_argument('--njobs', type=int, default=1,
+                        help='to be used with --make. Number of independent products built in parallel (each in its own process).'+
+                            ' The parallel loops of each product (background fit, trace masks...) then get the number of cpus (or $PYSEDM_NWORKERS) divided by njobs.')
+    
     # ----------------- #
     #  Short Cuts       #
     # ----------------- #
     parser.add_argument('--allcalibs', action="store_true", default=False,
-                        help='')
+                        help='Build the out of date calibrations (tracematch, hexagrid, wavesolution, flat and dome cube). Use --rebuild to force it. The --flatref, --flatlbda and --flatfromcube options apply.')
     
     parser.add_argument('--allscience', action="store_true", default=False,
                         help='')
@@ -92,6 +114,15 @@ if  __name__ == "__main__":
     parser.add_argument('--nofig',    action="store_true", default=False,
                         help='')
 
+    parser.add_argument('--precision', type=str, default=None,
+                        help='float64 or float32. Precision of the ccd images, backgrounds, trace masks and cubes (float32 halves memory and file sizes).')
+
+    parser.add_argument('--executor', type=str, default=None,
+                        help='serial, thread, process or sharedprocess. Backend of the parallel loops (background, trace masks, wavelength solution...). Default: $PYSEDM_EXECUTOR or process.')
+
+    parser.add_argument('--nworkers', type=int, default=None,
+                        help='Number of workers of the parallel loops (<=0: relative to the number of cpus). Default: $PYSEDM_NWORKERS or the number of cpus.')
+
     args = parser.parse_args()
 
     # Matplotlib
@@ -103,31 +134,62 @@ if  __name__ == "__main__":
     #  Date     #
     # --------- #
     date = args.infile
+    if args.precision is not None:
+        from pysedm.utils.tools import set_precision
+        set_precision(args.precision)
+    if args.executor is not None or args.nworkers is not None:
+        from pysedm.utils.executor import set_executor
+        set_executor(backend=args.executor, nworkers=args.nworkers)
 
     # ------------ #
     # Short Cuts   #
     # ------------ #
     if args.allcalibs:
-        args.tracematch = True
-        args.hexagrid   = True
-        args.wavesol    = True
-        args.build      = "dome"
-        args.flat       = True
+        # the flat requires all the other calibrations
+        args.make = "^flat$" if args.make is None else "^flat$|"+args.make
+        # the dome cube is built by the pipeline only if the flat is measured on it
+        if not args.flatfromcube:
+            args.build = "dome" if args.build is None or len(args.build)==0 else "dome,"+args.build
 
         
     # ================= #
     #   Actions         #
     # ================= #
+    # - Bootstrap from a reference night (before the pipeline, such that it uses these calibrations)
+    if args.tracematchref is not None:
+        registration = bootstrap_night_calibrations(date, args.tracematchref)
+        if not registration["success"]:
+            args.tracematch, args.hexagrid, args.wavesol = True, True, True
+        else:
+            args.tracematch = args.tracematchnomasks = args.hexagrid = args.wavesol = False
+            
+    # - Make-style pipeline
+    if args.make is not None:
+        from pysedm.script.pipeline import run_night_pipeline
+        run_night_pipeline(date, targets=None if args.make in ["*",""] else args.make,
+                           njobs=args.njobs, force=args.rebuild,
+                           flatref=args.flatref, flatcube=args.flatfromcube,
+                           flatlbda=list(np.asarray(args.flatlbda.split(","), dtype="float")),
+                           savefig = False if args.nofig else True)
+        
             
     # - Builds
     if args.build is not None and len(args.build) >0:
+        # - In-memory PSF extraction of the cubes (the calibration cubes are skipped)
+        stages = None
+        if args.extractstar:
+            from pysedm.utils.chaining import ProductChain
+            from pysedm.script.pipeline import _psf_extraction_stage_
+            stages = ProductChain().add_stage(_psf_extraction_stage_, name="psf_extraction",
+                                              date=date, savefig=False if args.nofig else True)
         for target in args.build.split(","):
             build_night_cubes(date, target=target,
                              lamps=True, only_lamps=False, skip_calib=True,
                              # - options
                              savefig = False if args.nofig else True,
                              flexure_corrected = False if args.noflexure else True,
-                             traceflexure_corrected = False if args.notraceflexure else True)
+                             traceflexure_corrected = False if args.notraceflexure else True,
+                             stages=stages)
 
     if args.buildcal is not None:
         if args.buildcal=="*": args.buildcal=args.build
@@ -174,6 +236,7 @@ if  __name__ == "__main__":
                         lbda_min=lbda_min,
                         lbda_max=lbda_max,
                         ref=args.flatref, build_ref=True,
+                        from_cube=args.flatfromcube,
                         savefig=~args.nofig)
 
     
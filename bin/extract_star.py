@@ -13,6 +13,7 @@ if  __name__ == "__main__":
     import numpy as np
     from pysedm.utils import extractstar
     from pysedm       import get_sedmcube, io
+    from pysedm.utils import performance
 
     # ================= #
     #   Options         #
@@ -26,7 +27,8 @@ if  __name__ == "__main__":
 
     # // AUTOMATIC EXTRACTION
     parser.add_argument('--auto',  type=str, default=None,
-                        help='Shall this run an automatic PSF extraction')
+                        help='Shall this run an automatic PSF extraction on the saved cubes of the given targets.'+
+                            ' (ccd_to_cube.py --build --extractstar extracts them while they are built, without reading them back)')
 
     parser.add_argument('--autorange',  type=str, default="4500,7000",
                         help='Wavelength range [in Angstrom] for measuring the metaslice PSF')
@@ -76,39 +78,41 @@ if  __name__ == "__main__":
                 #  Cube to Fit?     #
                 # ----------------- #
                 print("Automatic extraction of target %s, file: %s"%(target, filecube))
-                cube = get_sedmcube(filecube)
-                # --------------
-                # Fitting
-                # --------------
-                # - wavelengthes used
-                lbda_range = np.asarray(args.autorange.split(","), dtype="float")
-                lbdas_ = np.linspace(lbda_range[0],lbda_range[1],args.autobins+1)
-                lbdas  = np.asarray([lbdas_[:-1],lbdas_[1:]]).T
+                with performance.stage("extract_star", date=date, cube=filecube.split("/")[-1]):
+                    cube = get_sedmcube(filecube)
+                    # --------------
+                    # Fitting
+                    # --------------
+                    # - wavelengthes used
+                    lbda_range = np.asarray(args.autorange.split(","), dtype="float")
+                    lbdas_ = np.linspace(lbda_range[0],lbda_range[1],args.autobins+1)
+                    lbdas  = np.asarray([lbdas_[:-1],lbdas_[1:]]).T
 
-                # Step 1 fit the PSF shape:
-                output = cube.filename.replace("e3d","psffit_e3d")
-                savedata = output.replace(".fits",".json")
-                savefig = savedata.replace(".json",".pdf") if not args.nofig else None
+                    # Step 1 fit the PSF shape:
+                    output = cube.filename.replace("e3d","psffit_e3d")
+                    savedata = output.replace(".fits",".json")
+                    savefig = savedata.replace(".json",".pdf") if not args.nofig else None
 
-                psfmodel = extractstar.fit_psf_parameters(cube, lbdas,
-                                                        savedata=savedata,savefig=savefig,
-                                                        return_psfmodel=True)
-                # Step 2 ForcePSF spectroscopy:
+                    psfmodel = extractstar.fit_psf_parameters(cube, lbdas,
+                                                            savedata=savedata,savefig=savefig,
+                                                            return_psfmodel=True)
+                    # Step 2 ForcePSF spectroscopy:
                 
-                output = cube.filename.replace("e3d","forcepsf_e3d")
-                savefig = output.replace(".fits",".pdf") if not args.nofig else None
-                spec, bkgd, forcepsf = extractstar.fit_force_spectroscopy(cube, psfmodel, savefig=savefig)
-                cubemodel = forcepsf.cubemodel
-                cuberes   = forcepsf.cuberes
+                    output = cube.filename.replace("e3d","forcepsf_e3d")
+                    savefig = output.replace(".fits",".pdf") if not args.nofig else None
+                    spec, bkgd, forcepsf = extractstar.fit_force_spectroscopy(cube, psfmodel, savefig=savefig)
+                    cubemodel = forcepsf.cubemodel
+                    cuberes   = forcepsf.cuberes
                 
                 
-                # --------------
-                # Recording
-                # --------------
-                io._saveout_forcepsf_(filecube, cube, cuberes, cubemodel, spec, bkgd)
+                    # --------------
+                    # Recording
+                    # --------------
+                    performance.get_registry().to_header(spec.header)
+                    io._saveout_forcepsf_(filecube, cube, cuberes, cubemodel, spec, bkgd)
                 
-                # - for the record
-                extracted_objects.append(spec)
+                    # - for the record
+                    extracted_objects.append(spec)
                 
     else:
         print("NO  AUTO")
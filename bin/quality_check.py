@@ -2,20 +2,13 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-CCD_STD_FLUX_RATIO = 10
+from pysedm.script.quality import CCD_STD_FLUX_RATIO
 
 def check_if_stdobs_worked(ccdfile, tracematch, limit=CCD_STD_FLUX_RATIO):
-    """ """
-    from pysedm.ccd import get_ccd
-    ccd = get_ccd(ccdfile, tracematch=tmap, background=0)
-    mask_out = ccd.tracematch.get_notrace_mask()
-    vlow_out, vmedian_out, vmax_out = np.percentile(ccd.rawdata[mask_out],[10,50,99.99])
-    vlow_in,   vmedian_in,  vmax_in = np.percentile(ccd.rawdata[~mask_out],[10,50,99.99])
-    deltas = {"low":    vlow_in-vlow_out,
-              "median": vmedian_in-vmedian_out,
-              "max":    vmax_in-vmax_out}
-    
-    return bool(deltas["max"] > limit*(deltas["median"]/deltas["low"]))
+    """ Has the given STD observation (ccd.crr) been successful?
+    (the notrace mask of the tracematch is measured once and cached, see pysedm.script.quality) """
+    from pysedm.script.quality import check_stdobs
+    return check_stdobs(ccdfile, tracematch.get_notrace_mask(), limit=limit)
 
 ############################@
 #
@@ -38,8 +31,14 @@ if  __name__ == "__main__":
                         help='The date YYYYMMDD')
 
     parser.add_argument('--stdobs',  type=str, default=None,
-                        help='Check if an given STD observations (ccd.crr) has been successful. [accepting target, target list (csv) or regex] ')
-        
+                        help='Check if an given STD observations (ccd.crr) has been successful. [accepting target, target list (csv) or regex]. Set "*" for all the STD observations of the night.')
+
+    parser.add_argument('--nworkers', type=int, default=None,
+                        help='Number of ccds checked in parallel. (default: number of cpus)')
+
+    parser.add_argument('--report', type=str, default=None,
+                        help='Where the json report is saved. (default: <date>_QualityCheck.json in the night directory; "None" to not save it)')
+    
     # - Standard Star object
     
 
@@ -56,14 +55,14 @@ if  __name__ == "__main__":
 
     
     if args.stdobs is not None:
-        tmap = pysedm.load_nightly_tracematch(date)
-        for target in args.stdobs.split(","):
-            for datafile in pysedm.get_night_files(date, "ccd.crr", target):
-                if check_if_stdobs_worked(datafile, tmap):
-                    print("%s: STD obs ccd.crr test: Successfull"%datafile.split("/")[-1])
-                else:
-                    print("%s: STD obs ccd.crr test: FAILED | code 4: no star detected."%datafile.split("/")[-1])
-                              
-
-                
-                
+        from pysedm.script.quality import check_night_stdobs
+        report = check_night_stdobs(date, target=None if args.stdobs in ["*",""] else args.stdobs,
+                                    nworkers=args.nworkers,
+                                    savefile=True if args.report is None else False if args.report=="None" else args.report)
+        for result in report["stdobs"]:
+            if result["success"]:
+                print("%s: STD obs ccd.crr test: Successfull"%result["filename"])
+            elif "error" in result:
+                print("%s: STD obs ccd.crr test: FAILED | %s"%(result["filename"], result["error"]))
+            else:
+                print("%s: STD obs ccd.crr test: FAILED | code %d: no star detected."%(result["filename"], result["code"]))
@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#################################
+#
+#   MAIN
+#
+#################################
+if  __name__ == "__main__":
+
+    import argparse
+    from pysedm.script.watch import watch_night
+    # ================= #
+    #   Options         #
+    # ================= #
+    parser = argparse.ArgumentParser(
+        description="""pysedm watch mode: reduce the science exposures of the night as they land.
+        The night calibrations (tracematch, hexagrid, wavesolution, flat) must exist.
+        The state of every exposure is stored in <date>_WatchStatus.json ; restarting resumes from it.
+            """, formatter_class=argparse.RawTextHelpFormatter)
+
+    parser.add_argument('infile', type=str, default=None,
+                        help='The date YYYYMMDD')
+
+    parser.add_argument('--nworkers',  type=int, default=1,
+                        help='Number of exposures reduced at the same time')
+
+    parser.add_argument('--queuesize',  type=int, default=4,
+                        help='Maximum number of exposures waiting for a worker (back-pressure)')
+
+    parser.add_argument('--interval',  type=float, default=5,
+                        help='Time [s] between two scans of the night directory')
+
+    parser.add_argument('--maxretries',  type=int, default=1,
+                        help='Number of times a failed exposure is tried again')
+
+    parser.add_argument('--untilidle', action="store_true", default=False,
+                        help='Stop once every exposure already in the directory is reduced')
+
+    parser.add_argument('--ncore',  type=int, default=None,
+                        help='Number of processes of the background fit of each exposure. Default: the number of cpus (or $PYSEDM_NWORKERS) divided by nworkers.')
+
+    parser.add_argument('--nofluxcal', action="store_true", default=False,
+                        help='Do not build the flux calibrated cubes')
+
+    parser.add_argument('--nopsf', action="store_true", default=False,
+                        help='Do not run the automatic PSF extraction on the cubes')
+
+    parser.add_argument('--nofig', action="store_true", default=False,
+                        help='')
+
+    parser.add_argument('--precision', type=str, default=None,
+                        help='float64 or float32. Precision of the ccd images, backgrounds, trace masks and cubes.')
+
+    parser.add_argument('--executor', type=str, default=None,
+                        help='serial, thread, process or sharedprocess. Backend of the parallel loops within a reduction. Default: $PYSEDM_EXECUTOR or process.')
+
+    args = parser.parse_args()
+
+    # ================= #
+    #   The Scripts     #
+    # ================= #
+    if args.precision is not None:
+        from pysedm.utils.tools import set_precision
+        set_precision(args.precision)
+    if args.executor is not None:
+        from pysedm.utils.executor import set_executor
+        set_executor(backend=args.executor)
+
+    watch_night(args.infile, nworkers=args.nworkers, queuesize=args.queuesize,
+                interval=args.interval, until_idle=args.untilidle,
+                max_retries=args.maxretries, ncore=args.ncore,
+                fluxcalibration=not args.nofluxcal,
+                psf_extraction=not args.nopsf,
+                savefig=not args.nofig)
@@ -1,10 +1,26 @@
-
-
 __version__ = "0.8.7"
 
 from .io import *
 #from .ccd import *
-from .sedm import *
 #from .wavesolution import *
 #from .spectralmatching import *
 
+# sedm (and so pyifu) is only imported when one of its objects is requested,
+# such that `import pysedm` (CLI, worker processes) stays cheap.
+_LAZY_SEDM = ["get_sedmcube", "build_sedmcube", "kpy_to_e3d"]
+_LAZY_SUBMODULES = ["sedm", "ccd", "background", "mapping", "flexure",
+                    "spectralmatching", "wavesolution", "utils", "script"]
+
+__all__ = io.__all__ + _LAZY_SEDM
+
+def __getattr__(name):
+    """ lazy access to the sedm objects and to the submodules """
+    import importlib
+    if name in _LAZY_SEDM:
+        return getattr(importlib.import_module(".sedm", __name__), name)
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module("."+name, __name__)
+    raise AttributeError("module %r has no attribute %r"%(__name__, name))
+
+def __dir__():
+    return sorted(list(globals().keys()) + _LAZY_SEDM + _LAZY_SUBMODULES)
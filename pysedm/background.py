@@ -4,15 +4,11 @@
 """  """
 import warnings
 import numpy as np
-import matplotlib.pyplot as mpl
-
-from astropy.io import fits as pf
-from astropy.utils.console import ProgressBar
-
 
 from propobject   import BaseObject
-from .utils.tools import kwargs_update, load_pkl, dump_pkl
+from .utils.tools import kwargs_update, load_pkl, dump_pkl, get_dtype
 from .sedm        import SEDM_CCD_SIZE
+from .utils.performance import timed_stage, get_registry
 
 DEGREE   = 13
 LEGENDRE = True
@@ -21,20 +17,29 @@ NGAUSS = 1
 CONTDEGREE_GAUSS = 4
 LEGENDRE_GAUSS= False
 
+# Standard star batched fit (see get_contvalues_sdt_batch)
+STD_SIG_BOUNDARIES = [100, 200] # as in CCDSlice.fit_continuum
+STD_MU_STEPS       = [64, 8, 1] # successive grid steps [pixels] of the gaussian centroid
+STD_SIG_STEPS      = [25, 5, 1] # successive grid steps [pixels] of the gaussian width
+
 
 # ------------------ #
 #  Builder           #
 # ------------------ #
+@timed_stage()
 def build_background(ccd,
                     smoothing=[0,5],
                     start=2, jump=10, multiprocess=True,notebook=False,
-                    savefile=None):
+                    savefile=None, batch=True, ncore=None):
     """ """
     from .io import is_stdstars, filename_to_background_name
     ccd.fit_background(start=start, jump=jump, multiprocess=multiprocess, notebook=notebook,
-                                set_it=False, is_std= is_stdstars(ccd.header), smoothing=smoothing)
+                                set_it=False, is_std= is_stdstars(ccd.header), smoothing=smoothing,
+                                batch=batch, ncore=ncore)
+    get_registry().to_header(ccd._background.header)
     ccd._background.writeto( filename_to_background_name(ccd.filename).replace('.gz','') )
     if savefile is not None:
+        import matplotlib.pyplot as mpl
         ccd._background.show(savefile=savefile)
         mpl.close("all")
 
@@ -70,80 +75,238 @@ def get_contvalue_sdt(spec):
     spec.fit_continuum(CONTDEGREE_GAUSS, legendre=LEGENDRE_GAUSS, ngauss=NGAUSS)
     return spec.contmodel.fitvalues
 
+def get_contvalues_sdt_batch(xslices, clipping=[2,2], degree=CONTDEGREE_GAUSS,
+                                 mu_boundaries=None, sig_boundaries=STD_SIG_BOUNDARIES,
+                                 mu_steps=STD_MU_STEPS, sig_steps=STD_SIG_STEPS):
+    """ Batched equivalent of `get_contvalue_sdt` for a list of ccd slices.
+
+    The continuum (`degree` polynomial, no legendre) + gaussian model is fitted
+    on all the slices at once: the gaussian centroid (mu0) and width (sig0) are
+    scanned on grids shared by all the slices (coarse to fine, see mu_steps and sig_steps)
+    and, for each trial, the linear parameters (a_i and ampl0) are solved in closed form.
+
+    Parameters
+    ----------
+    xslices: [list of CCDSlice]
+        ccd slices (see CCD.get_xslice), with their tracebounds set.
+
+    clipping: [2-float] -optional-
+        lower and upper nmad clipping of the data out of the traces (as in CCDSlice.fit_continuum)
+
+    mu_boundaries, sig_boundaries: [2-float] -optional-
+        ranges of the gaussian centroid and width. mu_boundaries is [0, slice size] if None.
+
+    mu_steps, sig_steps: [list] -optional-
+        steps of the successive grids. Each grid covers +/- the previous step around
+        the best trial of the previous one.
+
+    Returns
+    -------
+    list of dict (contvalues, with the `a_i`, `mu0`, `sig0`, `ampl0` keys, their `.err` and the `chi2`,
+    see get_contvalue_names)
+    """
+    x, y, w = [], [], []
+    for slice_ in xslices:
+        # - same data selection as CCDSlice.fit_continuum
+        lbda, data, var = slice_.lbda[slice_.tracemaskout], slice_.data[slice_.tracemaskout], \
+                          slice_.variance[slice_.tracemaskout]
+        median = np.nanmedian(data)
+        nmad   = 1.4826 * np.nanmedian(np.abs(data - median))
+        flagin = (median - clipping[0] * nmad < data) & (data < median + clipping[1] * nmad) & (data==data)
+        x.append(lbda[flagin]); y.append(data[flagin]); w.append(1./var[flagin])
+
+    if mu_boundaries is None:
+        mu_boundaries = [0, len(xslices[0].data)]
+    # - padded arrays (null weight outside the data)
+    npts = np.max([len(x_) for x_ in x])
+    xpad, ypad, wpad = [np.zeros((len(x), npts)) for i in range(3)]
+    for i, (x_, y_, w_) in enumerate(zip(x, y, w)):
+        xpad[i,:len(x_)], ypad[i,:len(y_)], wpad[i,:len(w_)] = x_, y_, w_
+    wpad[~np.isfinite(wpad) | (wpad<0)] = 0
+
+    return fit_normpolynomial_batch(xpad, ypad, wpad, degree=degree,
+                                    mu_boundaries=mu_boundaries, sig_boundaries=sig_boundaries,
+                                    mu_steps=mu_steps, sig_steps=sig_steps)
+
+def fit_normpolynomial_batch(x, y, w, degree=CONTDEGREE_GAUSS,
+                                 mu_boundaries=[0,SEDM_CCD_SIZE[0]], sig_boundaries=STD_SIG_BOUNDARIES,
+                                 mu_steps=STD_MU_STEPS, sig_steps=STD_SIG_STEPS):
+    """ Fit `polynome(degree) + ampl0 * N(mu0, sig0)` independently on each row of x, y, w.
+
+    (mu0, sig0) are scanned on grids shared by all the rows. For a given (mu0, sig0)
+    the model is linear and the best a_i and ampl0 (>=0) and the chi2 are derived
+    in closed form (block elimination of the normal equations).
+
+    Parameters
+    ----------
+    x, y, w: [2d-array]
+        (nrows, npoints) abscissa, data and weights (1/variance). Null weights are ignored.
+
+    Returns
+    -------
+    list of dict (a_i, mu0, sig0, ampl0, their .err and the chi2), the polynomial being on raw x
+    (modefit's normal_and_polynomial_model with use_legendre=False)
+    """
+    from scipy.special import comb
+    nrows = len(x)
+    # - Polynomial basis on scaled x for conditioning
+    inside = w>0
+    xmin, xmax = np.min(x[inside]), np.max(x[inside])
+    center, scale = (xmax+xmin)/2., (xmax-xmin)/2.
+    basis  = ((x-center)/scale)[:,:,None]**np.arange(degree)  # nrows, npoints, degree
+    basisw = basis*w[:,:,None]
+    btwb   = np.einsum("rpi,rpj->rij", basisw, basis)
+    p_inv  = np.linalg.pinv(btwb)
+    btwy   = np.einsum("rpi,rp->ri", basisw, y)
+    py     = np.einsum("rij,rj->ri", p_inv, btwy)
+    chi2_poly = np.sum(w*y**2, axis=1) - np.sum(btwy*py, axis=1)
+
+    def get_linear_solution(mu, sig):
+        """ chi2, gaussian height and normal-equation terms for (nrows,) mu and sig """
+        gauss   = np.exp(-0.5*((x-mu[:,None])/sig[:,None])**2)
+        btwg    = np.einsum("rpi,rp->ri", basisw, gauss)
+        pg      = np.einsum("rij,rj->ri", p_inv, btwg)
+        gtwg    = np.sum(w*gauss**2, axis=1)
+        schur   = gtwg - np.sum(btwg*pg, axis=1)
+        num     = np.sum(w*gauss*y, axis=1) - np.sum(pg*btwy, axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            height = num/schur
+        flagout = ~(height>0)
+        height[flagout] = 0
+        chi2 = chi2_poly - height*num
+        return chi2, height, pg, btwg, gtwg
+
+    def scan(mu_trials, sig_trials):
+        """ best (mu, sig) per row among the (nrows, ntrials) trials """
+        best_chi2 = np.full(nrows, np.inf)
+        best_mu, best_sig = np.zeros(nrows), np.zeros(nrows)
+        for mu_, sig_ in zip(mu_trials.T, sig_trials.T):
+            chi2 = get_linear_solution(mu_, sig_)[0]
+            better = chi2 < best_chi2
+            best_chi2[better], best_mu[better], best_sig[better] = chi2[better], mu_[better], sig_[better]
+        return best_mu, best_sig
+
+    # - Coarse to fine grids
+    for level, (mu_step, sig_step) in enumerate(zip(mu_steps, sig_steps)):
+        if level == 0: # shared by all rows
+            mu_axis  = np.arange(mu_boundaries[0], mu_boundaries[1]+mu_step, mu_step)[None,:]
+            sig_axis = np.arange(sig_boundaries[0], sig_boundaries[1]+sig_step, sig_step)[None,:]
+        else: # around the previous best
+            mu_axis  = mu[:,None]  + np.arange(-mu_steps[level-1], mu_steps[level-1]+mu_step, mu_step)
+            sig_axis = sig[:,None] + np.arange(-sig_steps[level-1], sig_steps[level-1]+sig_step, sig_step)
+        mu_trials, sig_trials = np.broadcast_arrays(np.clip(mu_axis, *mu_boundaries)[:,:,None],
+                                                    np.clip(sig_axis, *sig_boundaries)[:,None,:])
+        mu, sig = scan(np.broadcast_to(mu_trials, (nrows,)+mu_trials.shape[1:]).reshape(nrows,-1),
+                       np.broadcast_to(sig_trials, (nrows,)+sig_trials.shape[1:]).reshape(nrows,-1))
+
+    # - Best linear parameters and their errors
+    chi2, height, pg, btwg, gtwg = get_linear_solution(mu, sig)
+    coefs = py - pg*height[:,None]
+    normal_matrix = np.zeros((nrows, degree+1, degree+1))
+    normal_matrix[:,:degree,:degree] = btwb
+    normal_matrix[:,:degree, degree] = normal_matrix[:,degree,:degree] = btwg
+    normal_matrix[:,degree,degree]   = gtwg
+    cov = np.linalg.pinv(normal_matrix)
+    # scaled -> raw x polynomial coefficients: a_i = sum_j conv_ij b_j
+    conv = np.asarray([[comb(j,i)*(-center)**(j-i)/scale**j if j>=i else 0
+                            for j in range(degree)] for i in range(degree)])
+    coefs_raw = np.einsum("ij,rj->ri", conv, coefs)
+    coefs_err = np.sqrt(np.abs(np.einsum("ij,rjk,ik->ri", conv, cov[:,:degree,:degree], conv)))
+    # mu and sig errors from the chi2 curvature (delta chi2 = 1)
+    errors = {}
+    for name, (mu_, sig_) in zip(["mu0","sig0"], [[1,0],[0,1]]):
+        chi2_p = get_linear_solution(mu+mu_, sig+sig_)[0]
+        chi2_m = get_linear_solution(mu-mu_, sig-sig_)[0]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            errors[name] = np.sqrt(2./(chi2_p + chi2_m - 2*chi2))
+
+    ampl_norm = sig*np.sqrt(2*np.pi) # height -> normal-pdf amplitude
+    contvalues = []
+    for i in range(nrows):
+        contvalue_ = {"chi2":chi2[i],
+                      "mu0":mu[i], "mu0.err":errors["mu0"][i],
+                      "sig0":sig[i], "sig0.err":errors["sig0"][i],
+                      "ampl0":height[i]*ampl_norm[i], "ampl0.err":np.sqrt(np.abs(cov[i,degree,degree]))*ampl_norm[i]}
+        for j in range(degree):
+            contvalue_["a%d"%j], contvalue_["a%d.err"%j] = coefs_raw[i,j], coefs_err[i,j]
+        contvalues.append(contvalue_)
+    return contvalues
+
+def get_contvalue_names(is_std=False):
+    """ names of the contvalues (fitted parameters, their errors and the chi2) of get_contvalue (or get_contvalue_sdt) """
+    from modefit.basics import polynomial_model, normal_and_polynomial_model
+    freeparameters = normal_and_polynomial_model(CONTDEGREE_GAUSS, NGAUSS).FREEPARAMETERS if is_std else \
+                     polynomial_model(DEGREE).FREEPARAMETERS
+    return list(freeparameters) + [k+".err" for k in freeparameters] + ["chi2"]
+
+def _fit_shared_column_(task, shared):
+    """ executor task: fits the j-th column (ccd-column i) of the "data" and "var" shared arrays
+    and writes its contvalues in the j-th row of the "contvalues" shared buffer.
+    task: (j, i, tracebounds, is_std) """
+    from .ccd import CCDSlice
+    j, i, tracebounds, is_std = task
+    data, var = np.asarray(shared["data"][:,i]), np.asarray(shared["var"][:,i])
+    slice_ = CCDSlice(None)
+    slice_.create(data, variance=var, lbda=np.arange(len(data)), logwave=False)
+    slice_.set_tracebounds(tracebounds)
+    contvalue = get_contvalue(slice_) if not is_std else get_contvalue_sdt(slice_)
+    shared["contvalues"][j] = [contvalue[k] for k in get_contvalue_names(is_std)]
+    
 def fit_background(ccd, start=2, jump=10, multiprocess=True, ncore=None,
-                       notebook=True, is_std=False):
+                       notebook=True, is_std=False, batch=True):
     """ calling `get_contvalue` for each ccd column (xslice).
-    This uses astropy's ProgressBar.map 
+    This uses the pipeline executor (see utils.executor): the ccd data and variance
+    are shared with the workers, which write the fitted values in a shared buffer
+    (no image-sized payload is serialized with the tasks).
+
+    For standard stars (is_std) and if batch is True, the continuum+gaussian
+    fits of all the columns are made at once (see get_contvalues_sdt_batch).
+    The executor is not used then, so multiprocess and ncore are ignored.
+
+    Parameters
+    ----------
+    multiprocess: [bool] -optional-
+        Shall the columns be fitted in parallel? (serial backend otherwise)
+        Ignored by the batch fit of the standard stars.
+
+    ncore: [int/None] -optional-
+        number of workers. If None, the pipeline default (see utils.executor.get_nworkers)
+        Ignored by the batch fit of the standard stars.
 
     Returns 
     -------
     dictionary 
     """
-    # Running from ipython notebook
+    from .utils.executor import get_executor
     index_column = range(ccd.width)[start::jump]
-    bar = ProgressBar( len(index_column), ipython_widget=notebook)
-
-    # - Multiprocessing 
-    if multiprocess:
-        import multiprocessing
-        if ncore is None:
-            if multiprocessing.cpu_count()>20:
-                ncore = multiprocessing.cpu_count() - 10
-            elif multiprocessing.cpu_count()>8:
-                ncore = multiprocessing.cpu_count() - 5
-            else:
-                ncore = multiprocessing.cpu_count() - 2
-            if ncore==0:
-                ncore = 1
-        p = multiprocessing.Pool(ncore)
-        res = {}
-        for j, result in enumerate( p.imap(get_contvalue if not is_std else get_contvalue_sdt,
-                                                         [ccd.get_xslice(i_) for i_ in index_column])):
-            res[index_column[j]] = result
-            bar.update(j)
-        bar.update(len(index_column))
-        return res
-    
-    # - No multiprocessing 
-    return {index_column[i_]: get_contvalue(ccd.get_xslice(spec_)) if not is_std else get_contvalue_sdt(ccd.get_xslice(spec_)) for i_,spec_ in enumerate(bar)}
+    if is_std and batch:
+        return dict(zip(index_column, get_contvalues_sdt_batch([ccd.get_xslice(i_) for i_ in index_column])))
 
+    if not ccd.has_var():
+        warnings.warn("Setting the default variance for 'fit_background' ")
+        ccd.set_default_variance()
+        
+    names = get_contvalue_names(is_std)
+    tasks = [(j, i_, ccd.tracematch.get_traces_crossing_x_ybounds(i_), is_std) for j, i_ in enumerate(index_column)]
+    with get_executor(backend=None if multiprocess else "serial", nworkers=ncore,
+                      shared={"data": ccd.data, "var": ccd.var}) as executor:
+        contvalues = executor.allocate("contvalues", (len(tasks), len(names)))
+        _ = executor.map(_fit_shared_column_, tasks, progress=True, notebook=notebook)
+        
+    return {i_: dict(zip(names, contvalue_)) for i_, contvalue_ in zip(index_column, contvalues)}
 
 def _fit_background_notebook_(ccd, start=2, jump=10, multiprocess=True,
                                   is_std=False, ncore=None,
                                   ipython_widget=True):
     """ calling `get_contvalue` for each ccd column (xslice).
-    This uses astropy's ProgressBar.map 
-s
-    ===
-    This version of the code is made to be called from fit_background
-    when this software detects that ipython is running from an notebook
-    ===
+    (fit_background with an ipython widget progress bar and without the batch fit)
 
     Returns 
     -------
     dictionary 
     """
-    index_column = range(ccd.width)[start::jump]
-    bar = ProgressBar( len(index_column), ipython_widget=ipython_widget)
-
-    # - Multiprocessing 
-    if multiprocess:
-        import multiprocessing
-        if ncore is None:
-            ncore = multiprocessing.cpu_count() - 1
-            if ncore==0:
-                ncore = 1
-        p = multiprocessing.Pool(ncore)
-        res = {}
-        for j, result in enumerate( p.imap(get_contvalue if not is_std else get_contvalue_sdt,
-                                                         [ccd.get_xslice(i_) for i_ in index_column])):
-            res[index_column[j]] = result
-            bar.update(j)
-        bar.update(len(index_column))
-        return res
-    
-    # - No multiprocessing 
-    return {index_column[i_]: get_contvalue(ccd.get_xslice(spec_)) if not is_std else get_contvalue_sdt(ccd.get_xslice(spec_)) for i_,spec_ in enumerate(bar)}
+    return fit_background(ccd, start=start, jump=jump, multiprocess=multiprocess, ncore=ncore,
+                          notebook=ipython_widget, is_std=is_std, batch=False)
 
 def _get_xaxis_polynomial_(xyv, degree=DEGREE, legendre=LEGENDRE,
                          xmodel=None, clipping = [5,5]):
@@ -168,10 +331,11 @@ class Background( BaseObject ):
     
     def load(self, filename):
         """ """
+        from astropy.io import fits as pf
         data_ = pf.open(filename)
         
         # - background
-        self._derived_properties['background'] = data_[0].data
+        self._derived_properties['background'] = np.asarray(data_[0].data, dtype=get_dtype())
         self._side_properties['header'] = data_[0].header
         # - contvalues
         contheader = data_["POLYVALUES"].header
@@ -188,7 +352,8 @@ class Background( BaseObject ):
         
     def build(self, width, height, smoothing= [0,5]):
         """ """
-        self._derived_properties['background'] = self.get_background(height, width, smoothing=smoothing)
+        self._derived_properties['background'] = np.asarray(self.get_background(height, width, smoothing=smoothing),
+                                                            dtype=get_dtype())
         
     def contvalue_to_polynome(self, contvalue_):
         """ """
@@ -249,6 +414,7 @@ class Background( BaseObject ):
         -------
         Void
         """
+        from astropy.io import fits as pf
         img_shape = np.shape(self.background)
         
         self.header["NAXIS"] = len(img_shape)
@@ -277,6 +443,7 @@ class Background( BaseObject ):
         """ """
         from .utils.mpl import figout
         
+        import matplotlib.pyplot as mpl
         fig = mpl.figure(figsize=[9,4])
         space = 0.02
         width = 0.38
@@ -349,5 +516,6 @@ class Background( BaseObject ):
     def header(self):
         """ """
         if self._side_properties["header"] is None:
+            from astropy.io import fits as pf
             self._side_properties["header"] = pf.Header()
         return self._side_properties["header"]
@@ -16,7 +16,7 @@ from astrobject.photometry import Image
 from pyifu.spectroscopy    import Spectrum
 
 
-from .utils.tools import kwargs_update
+from .utils.tools import kwargs_update, is_arraylike, get_dtype
 
 """
 The Idea of the CCD calibration is to first estimate the Spectral Matching. 
@@ -34,7 +34,7 @@ __all__ = ["get_dome","get_ccd"]
 #                                #
 ##################################
 def get_ccd(lampfile, ccdspec_mask=None,
-            tracematch=None, background=None, **kwargs):
+            tracematch=None, background=None, lazy=False, **kwargs):
     """ Load a SEDmachine ccd image. 
 
     Parameters
@@ -47,13 +47,18 @@ def get_ccd(lampfile, ccdspec_mask=None,
 
     background: [bool] -optional-
         which kind of background do you want (i.e. background=0)
+
+    lazy: [bool] -optional-
+        Shall the fits data be memory-mapped and the data (rawdata - background)
+        and the default variance only be derived when used? (see BaseCCD)
+
     **kwargs goes to _get_default_background_()
 
     Returns
     -------
     ScienceCCD (Child of CCD which is a Child of an astrobjec's Image)
     """
-    lamp = ScienceCCD(lampfile, background=0)
+    lamp = ScienceCCD(lampfile, background=0, lazy=lazy)
     if tracematch is not None:
         lamp.set_tracematch(tracematch)
     if background is None:
@@ -63,7 +68,7 @@ def get_ccd(lampfile, ccdspec_mask=None,
         
     return lamp
 
-def get_dome(domefile, tracematch=None,  load_sep=False, **kwargs):
+def get_dome(domefile, tracematch=None,  load_sep=False, lazy=False, **kwargs):
     """ Load a SEDmachine domeflat image. 
     (special version of get_ccd. might be moved to get_ccd...)
 
@@ -75,6 +80,10 @@ def get_dome(domefile, tracematch=None,  load_sep=False, **kwargs):
     tracematch: [Tracematch (pysedm object)] -optional-
         Tracematch object containing the Spectral property on the CCD
 
+    lazy: [bool] -optional-
+        Shall the fits data be memory-mapped and the data (rawdata - background)
+        and the default variance only be derived when used? (see BaseCCD)
+
     **kwargs goes to DomeCCD.__init__() if tracematch is None 
              else to _get_default_background_
     Returns
@@ -84,11 +93,11 @@ def get_dome(domefile, tracematch=None,  load_sep=False, **kwargs):
     if tracematch is not None:
         kwargs["background"] = 0
         
-    dome = DomeCCD(domefile, **kwargs)
+    dome = DomeCCD(domefile, lazy=lazy, **kwargs)
     
     if load_sep:
         dome.datadet = dome.data/np.sqrt(np.abs(dome.data))
-        dome.sep_extract(thresh=50., on="datadet")
+        dome.sep_extract_tiled(thresh=50., on="datadet")
         
     if tracematch is not None:
         # = Tracematch that gonna help the background
@@ -100,13 +109,154 @@ def get_dome(domefile, tracematch=None,  load_sep=False, **kwargs):
     return dome
 
 
+# ------------------------------ #
+#   Tiled Source Extraction      #
+# ------------------------------ #
+SEP_COORD_FIELDS = {"x":["x", "xmin", "xmax", "xpeak", "xcpeak"],
+                    "y":["y", "ymin", "ymax", "ypeak", "ycpeak"]}
+
+def get_extraction_tiles(shape, ntiles=(8,1), overlap=16, xybounds=None):
+    """ Overlapping tiles covering the image (or the given region of it).
+
+    Parameters
+    ----------
+    shape: [2-tuple]
+        (ny, nx) image shape
+
+    ntiles: [int or 2-tuple] -optional-
+        number of tiles along (y, x). By default the ccd is cut in horizontal bands
+        such that the traces (that are long along x) are not split.
+
+    overlap: [int] -optional-
+        margin [in pixel] added on each side of the tiles for the extraction.
+        This should be larger than the half-size of the objects.
+
+    xybounds: [[xmin, xmax], [ymin, ymax]] -optional-
+        restrict the tiles to this region.
+
+    Returns
+    -------
+    list of (core, extent) where both are [y0, y1, x0, x1] pixel slices: objects are
+    extracted within extent and kept if their center is within core.
+    """
+    ny, nx = shape
+    ntiles = np.broadcast_to(ntiles, 2)
+    (xmin, xmax), (ymin, ymax) = [[0, nx], [0, ny]] if xybounds is None else \
+      np.clip(np.asarray(np.round(xybounds), dtype="int"), 0, [[nx, nx], [ny, ny]])
+    ybounds = np.linspace(ymin, ymax, ntiles[0]+1, dtype="int")
+    xbounds = np.linspace(xmin, xmax, ntiles[1]+1, dtype="int")
+    return [([y0, y1, x0, x1], [max(y0-overlap, 0), min(y1+overlap, ny), max(x0-overlap, 0), min(x1+overlap, nx)])
+            for y0, y1 in zip(ybounds[:-1], ybounds[1:]) for x0, x1 in zip(xbounds[:-1], xbounds[1:])]
+    
+def _extract_tile_(data, core, extent, thresh, err=None, background=None, **kwargs):
+    """ sep.extract of one tile, in full image coordinates. Only the objects centered within the core are returned.
+    (sep releases the GIL, tiles can be processed by threads) """
+    import sep
+    y0, y1, x0, x1 = extent
+    tile = np.ascontiguousarray(data[y0:y1, x0:x1], dtype=data.dtype.newbyteorder("="))
+    if np.ndim(err) == 2:
+        err = np.ascontiguousarray(err[y0:y1, x0:x1], dtype=err.dtype.newbyteorder("="))
+    if background is not None:
+        bkgd = sep.Background(tile, **background)
+        tile = tile - bkgd.back()
+        if err is None: # -> thresh is relative to the background rms
+            err = bkgd.globalrms
+
+    objects = sep.extract(tile, thresh, err=err, **kwargs)
+    for axis, offset in [["x", x0], ["y", y0]]:
+        for field in SEP_COORD_FIELDS[axis]:
+            if field in objects.dtype.names:
+                objects[field] += offset
+                
+    cy0, cy1, cx0, cx1 = core
+    return objects[(objects["x"] >= cx0-0.5) & (objects["x"] < cx1-0.5) &
+                   (objects["y"] >= cy0-0.5) & (objects["y"] < cy1-0.5)]
+
+def sep_extract_tiled(data, thresh, err=None, ntiles=(8,1), overlap=16,
+                      contours=None, background=None, nworkers=None, **kwargs):
+    """ sep.extract ran on overlapping tiles by a pool of threads.
+
+    Objects are de-duplicated by keeping, in each tile, only those whose
+    center is in the (non-overlapping) core of the tile.
+
+    Parameters
+    ----------
+    data: [2D array]
+        image on which the extraction is made
+
+    thresh: [float]
+        detection threshold (see sep.extract; relative if err is given)
+
+    err: [float/2D array/None] -optional-
+        see sep.extract.
+
+    ntiles, overlap: -optional-
+        see get_extraction_tiles
+
+    contours: [vertices/None] -optional-
+        polygon (e.g. sedm.INDEX_CCD_CONTOURS). If given, only the tiles overlapping it
+        are used and only the objects centered inside it are returned.
+
+    background: [dict/None] -optional-
+        If given, a sep.Background is measured (using these options: bw, bh, fw, fh)
+        and removed on each tile. If err is None, thresh is then relative to the background rms.
+
+    nworkers: [int/None] -optional-
+        number of threads. If None, the pipeline default (see utils.executor.get_nworkers)
+
+    **kwargs goes to sep.extract
+
+    Returns
+    -------
+    structured array (sep.extract output, in image coordinates)
+    """
+    from .utils.executor import get_executor
+    xybounds = None if contours is None else np.percentile(contours, [0,100], axis=0).T + np.asarray([0,1])
+    tiles = get_extraction_tiles(np.shape(data), ntiles=ntiles, overlap=overlap, xybounds=xybounds)
+    
+    def _extract_(tile):
+        return _extract_tile_(data, *tile, thresh, err=err, background=background, **kwargs)
+    
+    objects = np.concatenate(list(get_executor(backend="thread", nworkers=nworkers).imap(_extract_, tiles)))
+    if contours is not None and len(objects)>0:
+        from .spectralmatching import points_in_polygons
+        objects = objects[points_in_polygons(objects["x"], objects["y"],
+                                             np.broadcast_to(contours, (len(objects),)+np.shape(contours)))]
+    return objects
+
 #####################################
 #                                   #
 #  Raw CCD Images for SED machine   #
 #                                   #
 #####################################
 class BaseCCD( Image ):
-    """ """
+    """ Base SEDm ccd image.
+
+    In lazy mode (lazy=True) the fits data are memory-mapped and used as
+    (read-only) rawdata. The data (rawdata - background) are only derived,
+    i.e. copied in memory, when first accessed and can be dropped once they
+    are no longer needed using release_memory().
+    """
+    SIDE_PROPERTIES = ["lazy"]
+
+    def __init__(self, filename=None, lazy=False, **kwargs):
+        """ 
+        Parameters
+        ----------
+        filename: [string.fits] -optional-
+            fits file from where the image will be loaded
+
+        lazy: [bool] -optional-
+            Shall the fits data be memory-mapped and the data (rawdata - background)
+            only be derived when used?
+
+        **kwargs goes to astrobject's Image.__init__
+        """
+        self._side_properties["lazy"] = lazy
+        if lazy and filename is not None:
+            kwargs.setdefault("memmap", True) # -> astropy.io.fits.open
+        super(BaseCCD, self).__init__(filename, **kwargs)
+        
     def __build__(self,bw=64, bh=64,
                       fw=3, fh=3,**kwargs):
         """ build the structure of the class
@@ -124,18 +274,120 @@ class BaseCCD( Image ):
         # -- How to read the image
         self._build_properties["bkgdbox"]={"bh":bh,"bw":bw,"fh":fh,"fw":fw}
 
+    # ==================== #
+    #  Memory              #
+    # ==================== #
+    def release_memory(self):
+        """ Drop the arrays derived from the rawdata (data and default variance).
+
+        This only applies in lazy mode: they will be derived again
+        from the memory-mapped rawdata if accessed afterwards.
+
+        Returns
+        -------
+        Void
+        """
+        if not self.is_lazy():
+            return
+        self._derived_properties["data"] = None
+
+    def is_lazy(self):
+        """ Are the rawdata memory-mapped and the data derived on first access? """
+        return self._side_properties["lazy"] is not None and self._side_properties["lazy"]
+    
     # ==================== #
     #  Internal tools      #
     # ==================== #
+    def _read_rawdata_(self, rawdata):
+        """ rawdata in the pipeline precision (see utils.tools.set_precision) 
+        [in lazy mode, the memory-mapped rawdata are kept as such] """
+        if self.is_lazy():
+            return rawdata
+        return np.asarray(rawdata, dtype=get_dtype())
+
+    def _update_data_(self, update_background=True):
+        """ data (rawdata - background) in the pipeline precision (see utils.tools.set_precision).
+        In lazy mode, the data will be derived on first access (see data) """
+        # - a float64 background (e.g. set_background(0)) would promote the data
+        if self.background is not None:
+            self._properties["background"] = np.asarray(self.background, dtype=get_dtype())
+        if not self.is_lazy() or (update_background and hasattr(self,"_sepbackground")):
+            super(BaseCCD, self)._update_data_(update_background=update_background)
+            if not self.is_lazy():
+                self._derived_properties["data"] = np.asarray(self._derived_properties["data"], dtype=get_dtype())
+                return
+        self._derived_properties["data"] = None
+
     def _get_sep_threshold_(self, thresh):
         """ Trick to automatically get the proper threshold for SEP extract """
         if thresh is None:
             return np.median(self.rawdata)
         return thresh
+
+    def sep_extract_tiled(self, thresh=None, on="data", ntiles=(8,1), overlap=16,
+                              within_contours=False, background=False, min_objects=2,
+                              nworkers=None, returnobjects=False, **kwargs):
+        """ Multi-threaded version of sep_extract (see sep_extract_tiled).
+        
+        Parameters
+        ----------
+        thresh: [float/None] -optional-
+            detection threshold. If None, the default one is used (see sep_extract) and it
+            is lowered (once) if less than min_objects are detected.
+
+        on: [string] -optional-
+            On which variable should the extraction be made? (e.g. data or datadet)
+
+        ntiles, overlap: -optional-
+            see get_extraction_tiles
+
+        within_contours: [bool/vertices] -optional-
+            Only extract the objects within the given polygon.
+            True means sedm.INDEX_CCD_CONTOURS.
+
+        background: [bool] -optional-
+            Shall a sep background be measured and removed on each tile? (using the bkgdbox build properties)
+
+        **kwargs goes to sep.extract
+
+        Returns
+        -------
+        Void [or sepobjects if returnobjects]
+        """
+        from astrobject.collections import get_sepobject
+        if within_contours is True:
+            from .sedm import INDEX_CCD_CONTOURS
+            within_contours = INDEX_CCD_CONTOURS
+            
+        if thresh is not None:
+            min_objects = None
+        thresh = self._get_sep_threshold_(thresh)
+        
+        objects = sep_extract_tiled(getattr(self, on), thresh, ntiles=ntiles, overlap=overlap,
+                                    contours=within_contours if within_contours is not False else None,
+                                    background=self._build_properties["bkgdbox"] if background else None,
+                                    nworkers=nworkers, **kwargs)
+        if min_objects is not None and len(objects) < min_objects:
+            warnings.warn("Automatic Threshold lowered for too few sources has been detected ")
+            return self.sep_extract_tiled(thresh=thresh/5., on=on, ntiles=ntiles, overlap=overlap,
+                                          within_contours=within_contours, background=background,
+                                          nworkers=nworkers, returnobjects=returnobjects, **kwargs)
+        
+        self._derived_properties["sepobjects"] = get_sepobject(objects)
+        if returnobjects:
+            return self.sepobjects
     
     # ==================== #
     #  Properties          #
     # ==================== #
+    @property
+    def data(self):
+        """ rawdata - background """
+        if self._derived_properties["data"] is None and self.is_lazy() and self.rawdata is not None:
+            background = self.background if self.background is not None else 0
+            self._derived_properties["data"] = np.asarray(self.rawdata - background, dtype=get_dtype())
+        return self._derived_properties["data"]
+    
     @property
     def data_log(self):
         return np.log10(self.data)
@@ -150,7 +402,7 @@ class CCD( BaseCCD ):
     """ Virtual Class For CCD images that have input light """
     
     PROPERTIES         = ["tracematch"]
-    DERIVED_PROPERTIES = ["matched_septrace_index"]
+    DERIVED_PROPERTIES = ["matched_septrace_index", "variance_offset"]
     
     # ------------------- #
     # Tracematch <-> CCD   #
@@ -167,7 +419,8 @@ class CCD( BaseCCD ):
         """ matches the SEP ellipse with the current trace vertices. 
         You must have ran sep_extract() to be able to use this method.
         
-        (This method need Shapely.)
+        All the sep objects are assigned in one pass (see TraceMatch.get_points_traceindex)
+        and stored as compact arrays (see matchedindex).
             
         You can then use the methods:
         - sepindex_to_traceindex()
@@ -177,33 +430,49 @@ class CCD( BaseCCD ):
         -------
         Void
         """
-        # -> import and tests
-        try:
-            from shapely import geometry, vectorized
-        except ImportError:
-            raise AttributeError("Matching traces to sep requires Shapely. pip install Shapely")
-
         if not self.has_sepobjects():
             raise AttributeError("sep has not been ran. Do so to be able to match sep output with traces")
 
         # -> actual code
-        x,y,a,b,theta = self.sepobjects.get(["x","y","a","b","theta"]).T
-        self._derived_properties["matched_septrace_index"] =\
-          {idx: np.argwhere(vectorized.contains( geometry.Polygon(self.tracematch.get_trace_vertices(idx)), x,y)).ravel()
-               for idx in self.tracematch.trace_indexes}
+        x,y = self.sepobjects.get(["x","y"]).T
+        sep_traceindex = self.tracematch.get_points_traceindex(x, y)
+        # - CSR like trace -> sep
+        traceindexes  = np.sort(self.tracematch.trace_indexes)
+        matched       = np.argwhere(sep_traceindex>=0).ravel()
+        tracerows     = np.searchsorted(traceindexes, sep_traceindex[matched])
+        order         = np.argsort(tracerows, kind="stable")
+        self._derived_properties["matched_septrace_index"] = \
+          {"sep_traceindex": sep_traceindex,
+           "traceindexes":   traceindexes,
+           "indptr":         np.concatenate([[0],np.cumsum(np.bincount(tracerows, minlength=len(traceindexes)))]),
+           "sepindexes":     matched[order]}
         
     def sepindex_to_traceindex(self, sepindex):
-        """ Give the index of an sep entry. This will give the corresponding trace index """
+        """ Give the index of an sep entry. This will give the corresponding trace index 
+        
+        Returns
+        -------
+        list ([] if the sep entry is not in any trace) or array (-1 if not in any trace) if sepindex is an array
+        """
         if not self.has_matchedindex():
             raise AttributeError("spectral match traces has not been matched with sep indexes. Run match_tracematch_and_sep()")
-        return [traceindex for traceindex, sepindexes in self.matchedindex.items() if sepindex in sepindexes]
+        if is_arraylike(sepindex):
+            return self.matchedindex["sep_traceindex"][sepindex]
+        
+        traceindex = self.matchedindex["sep_traceindex"][sepindex]
+        return [traceindex] if traceindex>=0 else []
     
     def traceindex_to_sepindex(self, traceindex):
         """ Give the index of an sep entry. This will give the corresponding trace index """
         if not self.has_matchedindex():
             self.match_trace_to_sep()
             
-        return self.matchedindex[traceindex]
+        traceindexes = self.matchedindex["traceindexes"]
+        row = np.searchsorted(traceindexes, traceindex)
+        if row >= len(traceindexes) or traceindexes[row] != traceindex:
+            return np.asarray([], dtype="int")
+        
+        return self.matchedindex["sepindexes"][self.matchedindex["indptr"][row]:self.matchedindex["indptr"][row+1]]
 
     
     def set_default_variance(self, force_it=False):
@@ -221,8 +490,23 @@ class CCD( BaseCCD ):
         if self.has_var() and not force_it:
             raise AttributeError("Cannot reset the variance. Set force_it to True to allow overwritting of the variance.")
         delta_sigma = np.percentile(self.data, [16,50])
-        
-        self._properties['var'] = self.rawdata+(delta_sigma[1]-delta_sigma[0])**2
+        self._derived_properties["variance_offset"] = (delta_sigma[1]-delta_sigma[0])**2
+        # - lazy: derived from the rawdata when first used (see _get_default_variance_)
+        self._properties['var'] = None if self.is_lazy() else self._get_default_variance_()
+
+    def release_memory(self):
+        """ Drop the arrays derived from the rawdata (data and default variance).
+
+        This only applies in lazy mode: they will be derived again
+        from the memory-mapped rawdata if accessed afterwards.
+
+        Returns
+        -------
+        Void
+        """
+        super(CCD, self).release_memory()
+        if self.is_lazy() and self._derived_properties["variance_offset"] is not None:
+            self._properties['var'] = None
         
     # ----------- #
     #   GETTER    #
@@ -401,11 +685,104 @@ class CCD( BaseCCD ):
             raise AttributeError("The TraceMatch has not been set. see set_tracematch() ")
             
         if hasattr(traceindex, "__iter__"):
-            return [self.get_spectrum(id_) for id_ in traceindex]
+            return [self.get_spectrum(id_, on=on, finetune=finetune) for id_ in traceindex]
 
         maskidx  = self.get_trace_mask(traceindex, finetune=finetune)
         return np.sum(eval("self.%s"%on)*maskidx, axis=0)
 
+    def get_spectra(self, traceindexes=None, on="data"):
+        """ Get the basic spectra of many traces at once.
+
+        This uses a single sparse product between the flatten 2d image 
+        and the tracematch's extraction matrix (see 
+        TraceMatch.get_extraction_matrix), which is much faster than looping
+        over `get_spectrum()`.
+        
+        Parameters
+        ----------
+        traceindexes: [list of int] -optional-
+            indexes of the spectra to return. If None, all the tracematch 
+            trace_indexes are used.
+
+        on: [str] -optional-
+            on which 2d image shall the spectra be extracted.
+            By Default 'data', but you can set e.g. rawdata, background 
+            or anything accessible as 'self.%s'%on. 
+
+        Returns
+        -------
+        2d-array (ntraces, npixels): row k is the flux of traceindexes[k]
+        """
+        if not self.has_tracematch():
+            raise AttributeError("The TraceMatch has not been set. see set_tracematch() ")
+        if traceindexes is None:
+            traceindexes = self.tracematch.trace_indexes
+            
+        matrix = self.tracematch.get_extraction_matrix(traceindexes)
+        return (matrix * np.ravel(eval("self.%s"%on))).reshape(len(traceindexes), -1)
+
+    def get_band_flux(self, wavesolution, lbda_min, lbda_max, traceindexes=None, on="data"):
+        """ Mean flux of the traces within the [lbda_min, lbda_max] wavelength range,
+        measured directly on the ccd.
+
+        The traces are extracted at once (see get_spectra()) and every pixel is
+        weighted by the fraction of the wavelength range it covers. This is the
+        equivalent of the cube's get_slice(lbda_min, lbda_max, usemean=True)
+        without extracting the cube.
+
+        Parameters
+        ----------
+        wavesolution: [WaveSolution]
+            The object containing the pixels<->wavelength relation of the night.
+
+        lbda_min, lbda_max: [float, float]
+            wavelength range [in Angstrom]
+
+        traceindexes: [list of int] -optional-
+            Which traces should be measured?
+            If None, all the traceindexes having a wavelength solution are used.
+
+        on: [str] -optional-
+            on which 2d image shall the flux be measured (see get_spectra())
+
+        Returns
+        -------
+        array (NaN for traces without wavelength solution or not fully covering the range)
+        """
+        if traceindexes is None:
+            traceindexes = np.sort(list(wavesolution.wavesolutions.keys()))
+        from .mapping import INVERTED_LBDA_X
+        traceindexes = np.asarray(traceindexes)
+        spectra = self.get_spectra(traceindexes, on=on)
+        xbounds = np.asarray([self.tracematch.get_trace_xbounds(i) for i in traceindexes])
+        # - wavesolution pixels run opposite to the ccd columns: pixel p is column ncols-1-p (see extract_spectrum)
+        if INVERTED_LBDA_X:
+            spectra = spectra[:,::-1]
+            xbounds = (spectra.shape[1]-1) - xbounds[:,::-1]
+
+        # - Pixels covering the wavelength range
+        pixbounds = np.sort(wavesolution.lbda_to_pixels_array([[lbda_min, lbda_max]], traceindexes[:,None]), axis=1)
+        flagok    = np.all(np.isfinite(pixbounds), axis=1)
+        flagok[flagok] = (pixbounds[flagok,0]>xbounds[flagok,0]) * (pixbounds[flagok,1]<xbounds[flagok,1])
+        if not np.any(flagok):
+            return np.full(len(traceindexes), np.nan)
+
+        pixstart = np.floor(pixbounds[flagok,0]).astype("int")-1
+        npix     = int(np.max(np.ceil(pixbounds[flagok,1])-pixstart))+2
+        pixels   = pixstart[:,None] + np.arange(npix)
+        # - wavelength covered by each pixel
+        lbdaedges = wavesolution.pixels_to_lbda_array(np.concatenate([pixels-0.5, pixels[:,-1:]+0.5], axis=1),
+                                                    traceindexes[flagok][:,None])
+        lbdalow   = np.minimum(lbdaedges[:,:-1], lbdaedges[:,1:])
+        lbdahigh  = np.maximum(lbdaedges[:,:-1], lbdaedges[:,1:])
+        weights   = np.clip(np.minimum(lbdahigh, lbda_max)-np.maximum(lbdalow, lbda_min), 0, None) / (lbda_max-lbda_min)
+
+        inccd     = (pixels>=0) * (pixels<spectra.shape[1])
+        fluxes    = np.take_along_axis(spectra[flagok], np.clip(pixels, 0, spectra.shape[1]-1), axis=1)
+        bandflux  = np.full(len(traceindexes), np.nan)
+        bandflux[flagok] = np.sum(np.where(inccd, fluxes*weights, 0), axis=1)
+        return bandflux
+
     def get_xslice(self, i, on="data"):
         """ build a `CCDSlice` based on the ith-column.
 
@@ -595,7 +972,7 @@ class CCD( BaseCCD ):
         if hexagrid is None:
             hexagrid = self.tracematch.extract_hexgrid(traceindexes)
             
-        used_indexes = [i_ for i_ in traceindexes if i_ in hexagrid.ids_index.keys()]
+        used_indexes = np.asarray(traceindexes)[hexagrid.ids_to_index(traceindexes)>=0]
         # - data
         cube      = SEDMCube(None)
         cubeflux_ = {}
@@ -621,16 +998,16 @@ class CCD( BaseCCD ):
         # ------------ #
         # - MultiThreading to speed this up
         if show_progress:
-            from astropy.utils.console import ProgressBar
-            ProgressBar.map(_build_ith_flux_, used_indexes)
+            from .utils.executor import get_executor
+            get_executor(backend="serial").map(_build_ith_flux_, used_indexes, progress=True)
         else:
             #from multiprocessing import Pool as ThreadPool
             #pool = ThreadPool(4)
             #pool.map(_build_ith_flux_, used_indexes)
-            _ = [_build_ith_flux_[i] for i in used_indexes]
+            _ = [_build_ith_flux_(i) for i in used_indexes]
             
-        cubeflux = np.asarray([cubeflux_[i] for i in used_indexes])
-        cubevar  = np.asarray([cubevar_[i]   for i in used_indexes]) if cubevar_ is not None else None
+        cubeflux = np.asarray([cubeflux_[i] for i in used_indexes], dtype=get_dtype())
+        cubevar  = np.asarray([cubevar_[i]   for i in used_indexes], dtype=get_dtype()) if cubevar_ is not None else None
         
         # - Fill the Cube
         spaxel_map = {i:c
@@ -841,10 +1218,18 @@ class CCD( BaseCCD ):
             falses[(np.arange(self.shape[0])<yremove)   + (np.arange(self.shape[0])>(self.shape[0]-yremove)),:] = 1.
             add_mask = add_mask + np.asarray(falses, dtype="bool")
 
-        return self.get_sep_background(doublepass=False, update_background=False,
+        background = self.get_sep_background(doublepass=False, update_background=False,
                                        add_mask=add_mask,
                                        apply_sepmask=apply_sepmask, scaleup_sepmask=scaleup_sepmask,
                                        **kwargs)
+        return np.asarray(background, dtype=get_dtype()) if is_arraylike(background) else background
+    
+    def _get_default_variance_(self):
+        """ rawdata + offset if set_default_variance() has been called """
+        if self._derived_properties["variance_offset"] is not None:
+            return np.asarray(self.rawdata + self._derived_properties["variance_offset"],
+                                  dtype=get_dtype())
+        return super(CCD, self)._get_default_variance_()
     
     # ================== #
     #   Properties       #
@@ -861,7 +1246,9 @@ class CCD( BaseCCD ):
 
     @property
     def matchedindex(self):
-        """ Object containing the relation between the sepindex and the trace index.
+        """ Object containing the relation between the sepindex and the trace index:
+        {sep_traceindex: traceindex of each sep entry (-1 if none),
+         traceindexes, indptr, sepindexes: CSR-like trace -> sep entries}
         see the methods sepindex_to_traceindex() and traceindex_to_sepindex() """
         if self._derived_properties["matched_septrace_index"] is None:
             self._derived_properties["matched_septrace_index"] = {}
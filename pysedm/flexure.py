@@ -21,19 +21,25 @@ class TraceFlexure( BaseObject ):
     # ================== #
     #   Properties       #
     # ================== #
-    def derive_j_offset(self, var_threshold=5, elliptical_limit=0.5, rerun_sepextract=False, verbose=False):
-        """ """
+    def derive_j_offset(self, var_threshold=5, elliptical_limit=0.5, rerun_sepextract=False,
+                            within_contours=True, verbose=False):
+        """ 
+        Parameters
+        ----------
+        within_contours: [bool] -optional-
+            Shall the sep extraction be limited to sedm.INDEX_CCD_CONTOURS? (see CCD.sep_extract_tiled)
+        """
         if not self.ccd.has_var():
             if verbose: print("INFO: setting the default variance to the ccd")
             self.ccd.set_default_variance()
         if not self.ccd.has_sepobjects() or rerun_sepextract:
             try:
                 if verbose: print("INFO: Running  sep_extract")
-                self.ccd.sep_extract()
+                self.ccd.sep_extract_tiled(within_contours=within_contours)
             except:
                 tresh = np.nanmean( np.sqrt(self.ccd.var) )*var_threshold
                 if verbose: print("INFO: FAILED running sep_extract. Trying now using tresh=%.2f"%tresh)
-                self.ccd.sep_extract(tresh)
+                self.ccd.sep_extract_tiled(tresh, within_contours=within_contours)
                 
         # - The SEP data
         a,b,x,y = self.ccd.sepobjects.get(["a","b",'x','y']).T
@@ -42,13 +48,7 @@ class TraceFlexure( BaseObject ):
         # - Getting the expected J
         i_obs, j_obs = x, y
         if verbose: print("INFO: mesuring the expected j-coordinates")
-        js= []
-        for i_,j_ in zip(x, y):
-            try:
-                js.append( self.mapper.get_expected_j(i_,j_) )
-            except:
-                js.append(np.NaN)
-
+        js = self.mapper.get_expected_j_array(i_obs, j_obs)
         
         self._derived_properties['js']     = np.asarray(js)
         self._derived_properties['js_obs'] = np.asarray(j_obs)
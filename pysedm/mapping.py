@@ -7,9 +7,8 @@
 import numpy as np
 from propobject import BaseObject
 
-from shapely.geometry import Point, LineString
 
-from .utils.tools import is_arraylike
+from .utils.tools import is_arraylike, polyval_rows
 
 
 # = Pysedm Information = #
@@ -18,6 +17,23 @@ from .sedm import SEDM_CCD_SIZE as CCD_SHAPE
 INVERTED_LBDA_X = True
 
 
+def get_vertices_jbounds(vertices, i):
+    """ lower and upper j-coordinates of the polygon defined by the 
+    given vertices along the vertical lines `i`.
+    
+    Returns
+    -------
+    array, array (NaN when the line does not cross the polygon)
+    """
+    i = np.atleast_1d(np.asarray(i, dtype="float"))
+    (i0, j0), (i1, j1) = np.asarray(vertices, dtype="float").T, np.roll(vertices, -1, axis=0).T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        jcross = j0 + (i[:,None]-i0)*(j1-j0)/(i1-i0)
+    crossing = (i[:,None] >= np.minimum(i0,i1)) & (i[:,None] <= np.maximum(i0,i1)) & (i1 != i0)
+    jcross[~crossing] = np.nan
+    return np.nanmin(jcross, axis=1), np.nanmax(jcross, axis=1)
+
+
 ##########################
 #                        #
 #   The Mapping Class    #
@@ -26,7 +42,7 @@ INVERTED_LBDA_X = True
 class Mapper( BaseObject ):
     """ """
     PROPERTIES = ["tracematch","hexagrid", "wavesolution"]
-    DERIVED_PROPERTIES = ["spaxel_mapping","spaxelslice"]
+    DERIVED_PROPERTIES = ["spaxel_mapping","spaxelslice","centerlines","labelimage"]
     # ================= #
     #  Initialization   #
     # ================= #
@@ -51,6 +67,81 @@ class Mapper( BaseObject ):
           pyifu.get_slice( self.traceindexes, xy, spaxel_vertices= np.dot( self.hexagrid.grid_rotmatrix, SPAXEL_SHAPE.T ).T )
           
         self._derived_properties["spaxel_polygon"] = {i:p_ for i,p_ in zip(traceindexes,self.spaxel_slice.get_spaxel_polygon()) }
+        # - the default centerline traces follow the spaxel mapping
+        self._derived_properties["centerlines"] = None
+        self._derived_properties["labelimage"]  = None
+
+    def derive_trace_centerlines(self, traceindexes=None, degree=2, nsamples=20):
+        """ Fit the center line of the traces as polynomials j(i).
+        This is used by the vectorized conversion methods (e.g. traceindex_lbda_to_ij)
+        The center lines are derived again (with the default parameters) once the 
+        tracematch vertices or the spaxel mapping change.
+
+        Parameters
+        ----------
+        traceindexes: [list/array] -optional-
+            list of traces you want to use. If None self.traceindexes will be
+            used if the spaxel_mapping has been derived, all the tracematch
+            traces otherwise.
+
+        degree: [int] -optional-
+            degree of the polynomials
+
+        nsamples: [int] -optional-
+            number of i-columns used to measure the trace centers.
+
+        Returns
+        -------
+        Void
+        """
+        if traceindexes is None:
+            traceindexes = self.traceindexes if self._derived_properties["spaxel_mapping"] is not None \
+              else self.tracematch.trace_indexes
+        traceindexes = np.sort(np.asarray(traceindexes, dtype="int"))
+
+        coefs, ibounds, halfwidths = [], [], []
+        for traceindex in traceindexes:
+            verts = np.asarray(self.tracematch.get_trace_vertices(traceindex), dtype="float")
+            imin, imax  = np.nanmin(verts.T[0]), np.nanmax(verts.T[0])
+            i_          = np.linspace(imin, imax, nsamples+2)[1:-1]
+            jlow, jup   = get_vertices_jbounds(verts, i_)
+            coefs.append(np.polyfit(i_, (jlow+jup)/2., degree))
+            ibounds.append([imin, imax])
+            halfwidths.append(np.nanmax(jup-jlow)/2.)
+            
+        self._derived_properties["labelimage"]  = None
+        self._derived_properties["centerlines"] = {"traceindexes":traceindexes,
+                                                   "coefs":np.asarray(coefs),
+                                                   "ibounds":np.asarray(ibounds),
+                                                   "halfwidths":np.asarray(halfwidths),
+                                                   "vertices":self.tracematch.trace_vertices}
+    def derive_trace_labelimage(self):
+        """ Rasterize the traces (following their center lines, see derive_trace_centerlines)
+        into a ccd-size image containing, for each pixel, the traceindex it belongs to (-1 if none).
+        This enables a O(1) (i,j) -> traceindex lookup (see ij_to_traceindex_array).
+
+        Returns
+        -------
+        Void
+        """
+        cl      = self.trace_centerlines
+        labels  = np.full((CCD_SHAPE[0], CCD_SHAPE[1]), -1, dtype="int32")
+        # - One entry per (trace, column)
+        istart  = np.ceil(cl["ibounds"].T[0])
+        ncols   = np.clip(np.floor(cl["ibounds"].T[1]) - istart + 1, 0, None).astype("int")
+        rows    = np.repeat(np.arange(len(ncols)), ncols)
+        i_      = np.repeat(istart, ncols) + np.arange(ncols.sum()) - np.repeat(np.cumsum(ncols)-ncols, ncols)
+        jc      = polyval_rows(cl["coefs"][rows], i_)
+        hw      = cl["halfwidths"][rows]
+        # - Walk along the trace widths
+        maxhw   = int(np.ceil(np.nanmax(cl["halfwidths"])))
+        for dj in range(-maxhw, maxhw+1):
+            j_    = np.round(jc) + dj
+            flag_ = (np.abs(j_-jc) <= hw) & (j_>=0) & (j_<CCD_SHAPE[0]) & (i_>=0) & (i_<CCD_SHAPE[1])
+            labels[j_[flag_].astype("int"), i_[flag_].astype("int")] = cl["traceindexes"][rows[flag_]]
+            
+        self._derived_properties["labelimage"] = labels
+        
     # ================= #
     #  Methods          #
     # ================= #
@@ -77,8 +168,10 @@ class Mapper( BaseObject ):
         """
         if traceindexes is None:
             traceindexes = self.traceindexes
-            
-        return {traceindex:self.lbda_to_ij(lbda, traceindex) for traceindex in traceindexes}
+        # i is returned here as the wavelength solution pixel (see lbda_to_ij)
+        i, j = self.traceindex_lbda_to_ij(traceindexes, lbda)
+        pixels = (CCD_SHAPE[1]-1)-i if INVERTED_LBDA_X else i
+        return {traceindex:[i_,j_] for traceindex,i_,j_ in zip(traceindexes, pixels, j)}
     
     def get_ij(self, x, y, lbda):
         """ """
@@ -92,6 +185,42 @@ class Mapper( BaseObject ):
         x,y        = self.traceindex_to_xy(traceindex)
         return np.asarray([x,y,lbda])
 
+    def get_trace_centerline_j(self, traceindexes, i):
+        """ j-coordinate of the center of the traces at the i-columns.
+        (see derive_trace_centerlines)
+
+        Parameters
+        ----------
+        traceindexes, i: [int/array, float/array]
+            traceindexes and ccd i-coordinates. They are broadcasted against each other.
+
+        Returns
+        -------
+        array (NaN if i is outside the trace or for unknown traceindexes)
+        """
+        traceindexes, i = np.broadcast_arrays(traceindexes, np.asarray(i, dtype="float"))
+        rows, known = self._centerline_rows_(np.ravel(traceindexes))
+        i_ = np.ravel(i)
+        j  = polyval_rows(self.trace_centerlines["coefs"][rows], i_)
+        ibounds = self.trace_centerlines["ibounds"][rows]
+        j[~known | (i_<ibounds.T[0]) | (i_>ibounds.T[1])] = np.nan
+        return j.reshape(i.shape)
+        
+    def get_expected_j_array(self, i, j):
+        """ Vectorized version of get_expected_j.
+        
+        Parameters
+        ----------
+        i, j: [float/array, float/array]
+            ccd coordinates.
+
+        Returns
+        -------
+        array (NaN for pixels outside the traces)
+        """
+        traceindexes = self.ij_to_traceindex_array(i, j)
+        return np.where(traceindexes>=0, self.get_trace_centerline_j(traceindexes, i), np.nan)
+    
     def get_expected_j(self, i,j):
         """ fetch the traceindex associated to the i,j coordinates
         and then returns where the j is supposed to be if the trace where perfectly 
@@ -133,10 +262,98 @@ class Mapper( BaseObject ):
             return np.asarray([self.traceindexi_to_j(traceindex, i_) for _ in i])
         
         if i is None: return np.asarray([None,None])
+        from shapely.geometry import LineString
         i_eff = (CCD_SHAPE[1]-1)-i if inverted else i # -1 because starts at 0
         
         return i, np.mean(self.tracematch.trace_polygons[traceindex].intersection(LineString([[i_eff,0],[i_eff, maxlines]])), axis=0)[1]
 
+    def traceindex_lbda_to_ij(self, traceindexes, lbda):
+        """ Vectorized conversion (traceindex, lbda) -> (i, j).
+        i is the ccd column of the given wavelength and j the center of the 
+        trace at this column.
+
+        Parameters
+        ----------
+        traceindexes, lbda: [int/array, float/array]
+            traceindexes and wavelengths [in angstrom]. They are broadcasted
+            against each other.
+
+        Returns
+        -------
+        array, array (i, j)
+        """
+        pixels = self.wavesolution.lbda_to_pixels_array(lbda, traceindexes)
+        i = (CCD_SHAPE[1]-1)-pixels if INVERTED_LBDA_X else pixels # -1 because starts at 0
+        return i, self.get_trace_centerline_j(traceindexes, i)
+
+    def ij_to_traceindex_lbda(self, i, j):
+        """ Vectorized conversion (i, j) -> (traceindex, lbda).
+
+        Parameters
+        ----------
+        i, j: [float/array, float/array]
+            ccd coordinates.
+
+        Returns
+        -------
+        array, array (traceindex, lbda). traceindex is -1 (and lbda NaN) 
+        for pixels outside the traces.
+        """
+        traceindexes = self.ij_to_traceindex_array(i, j)
+        i      = np.broadcast_to(np.asarray(i, dtype="float"), traceindexes.shape)
+        i_eff  = (CCD_SHAPE[1]-1)-i if INVERTED_LBDA_X else i # -1 because starts at 0
+        lbda   = np.full(traceindexes.shape, np.nan)
+        intrace = traceindexes>=0
+        lbda[intrace] = self.wavesolution.pixels_to_lbda_array(i_eff[intrace], traceindexes[intrace])
+        return traceindexes, lbda
+    
+    # .................... #
+    #  i,j <-> traceindex  #
+    # .................... #
+    def ij_to_traceindex_array(self, i, j, use_labelimage=True, chunksize=1000):
+        """ Vectorized version of ij_to_traceindex.
+        A pixel belongs to the trace whose center line (see derive_trace_centerlines)
+        is the closest, if within the trace half width.
+
+        Parameters
+        ----------
+        i, j: [float/array, float/array]
+            ccd coordinates.
+
+        use_labelimage: [bool] -optional-
+            Use the rasterized traces (see trace_labelimage) to look up the 
+            traceindex of the nearest pixel. This is O(1) per pixel.
+            If False, the distances to all the center lines are computed.
+            
+        chunksize: [int] -optional-
+            number of pixels processed simultaneously (if not use_labelimage).
+
+        Returns
+        -------
+        array (traceindex, -1 if not in any trace)
+        """
+        i, j = np.broadcast_arrays(np.asarray(i, dtype="float"), np.asarray(j, dtype="float"))
+        i_, j_ = np.ravel(i), np.ravel(j)
+        if use_labelimage:
+            traceindexes = np.full(len(i_), -1, dtype="int")
+            ipix, jpix   = np.round(i_), np.round(j_)
+            inccd = (ipix>=0) & (ipix<CCD_SHAPE[1]) & (jpix>=0) & (jpix<CCD_SHAPE[0])
+            traceindexes[inccd] = self.trace_labelimage[jpix[inccd].astype("int"), ipix[inccd].astype("int")]
+            return traceindexes.reshape(i.shape)
+        
+        cl = self.trace_centerlines
+        traceindexes = np.full(len(i_), -1, dtype="int")
+        for start in range(0, len(i_), chunksize):
+            ic, jc = i_[start:start+chunksize], j_[start:start+chunksize]
+            # (ntraces, npixels)
+            dist = np.abs(polyval_rows(cl["coefs"], ic[None,:]) - jc)
+            dist[(ic < cl["ibounds"][:,0:1]) | (ic > cl["ibounds"][:,1:2]) | (dist > cl["halfwidths"][:,None]) ] = np.inf
+            best  = np.argmin(dist, axis=0)
+            found = np.isfinite(dist[best, np.arange(len(ic))])
+            traceindexes[start:start+chunksize][found] = cl["traceindexes"][best[found]]
+            
+        return traceindexes.reshape(i.shape)
+        
     # .................... #
     #  i,j <-> traceindex  #
     # .................... #
@@ -156,6 +373,7 @@ class Mapper( BaseObject ):
         if is_arraylike(i):
             return [self.ij_to_traceindex(i_,j_) for i_,j_ in zip(i,j)]
         
+        from shapely.geometry import Point
         pij = Point(i,j)
         traceindex = [i_ for i_ in self.traceindexes if self.tracematch.trace_polygons[i_].contains(pij)]
         if len(traceindex) > 1:
@@ -196,6 +414,7 @@ class Mapper( BaseObject ):
         if is_arraylike(x):
             return [self.xy_to_traceindex(x_,y_) for x_,y_ in zip(x,y)]
         
+        from shapely.geometry import Point
         pxy = Point(x,y)
         traceindex = [i_ for i_ in self.traceindexes if self._spaxel_polygon[i_].contains(pxy)]
         if len(traceindex) > 1:
@@ -236,6 +455,8 @@ class Mapper( BaseObject ):
     def set_tracematch(self, tmap):
         """ """
         self._properties["tracematch"] = tmap
+        self._derived_properties["centerlines"] = None
+        self._derived_properties["labelimage"]  = None
         
     def set_wavesolution(self, wsol):
         """ """
@@ -271,6 +492,32 @@ class Mapper( BaseObject ):
         """ 'ID' (int) of the spaxels """
         return np.asarray(list(self.spaxel_mapping.keys()))
 
+    @property
+    def trace_centerlines(self):
+        """ dictionary containing the polynomial center lines j(i) of the traces 
+        {traceindexes, coefs, ibounds, halfwidths}. (see derive_trace_centerlines) """
+        # - set_trace_vertices (e.g. add_trace_offset) replaces the vertices dictionary
+        if self._derived_properties["centerlines"] is None or \
+          self._derived_properties["centerlines"]["vertices"] is not self.tracematch.trace_vertices:
+            self.derive_trace_centerlines()
+        return self._derived_properties["centerlines"]
+
+    @property
+    def trace_labelimage(self):
+        """ ccd-size image of the traceindex each pixel belongs to (-1 if none). 
+        (see derive_trace_labelimage) """
+        _ = self.trace_centerlines # resets the labelimage if the center lines are outdated
+        if self._derived_properties["labelimage"] is None:
+            self.derive_trace_labelimage()
+        return self._derived_properties["labelimage"]
+    
+    def _centerline_rows_(self, traceindexes):
+        """ row of the given traceindexes in trace_centerlines' arrays and whether 
+        these traceindexes are known """
+        known_indexes = self.trace_centerlines["traceindexes"]
+        rows  = np.clip(np.searchsorted(known_indexes, traceindexes), 0, len(known_indexes)-1)
+        return rows, known_indexes[rows] == traceindexes
+    
     @property
     def spaxel_slice(self):
         """ pyifu Slice using traceindex as data """
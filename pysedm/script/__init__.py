@@ -1,4 +1,22 @@
 """ Scripts """
 
-from .ccd_to_cube import *
+# ccd_to_cube imports the whole pipeline (pyifu, astrobject, matplotlib...).
+# It is only loaded when one of its functions is requested, such that
+# `pysedm.script.pipeline` or `pysedm.script.watch` start fast.
+__all__ = ["build_tracematcher", "bootstrap_night_calibrations", "build_hexagonalgrid", "build_flatfield_reference",
+           "build_flatfield", "build_backgrounds", "build_wavesolution",
+           "build_night_cubes", "build_cubes", "calibrate_night_cubes",
+           "calibrate_cubes", "save_cubeplot"]
 
+_SUBMODULES = ["ccd_to_cube", "pipeline", "watch", "quality"]
+
+def __getattr__(name):
+    """ lazy access to the submodules and to the ccd_to_cube functions """
+    import importlib
+    if name in _SUBMODULES:
+        return importlib.import_module("."+name, __name__)
+    if not name.startswith("__"):
+        ccd_to_cube = importlib.import_module(".ccd_to_cube", __name__)
+        if hasattr(ccd_to_cube, name):
+            return getattr(ccd_to_cube, name)
+    raise AttributeError("module %r has no attribute %r"%(__name__, name))
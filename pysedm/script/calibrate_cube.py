@@ -31,10 +31,10 @@ def flat_cubes(date, lbda_min=7000, lbda_max=9000, ref="dome"):
         cube_.scale_by(flatfied)
         cube_.writeto(cube_.filename.replace(baseroot,newroot))
         
-    from astropy.utils.console import ProgressBar
+    from ..utils.executor import get_executor
     cubefiles = io.get_night_cubes(date, kind="cube")
     print(cubefiles)
-    ProgressBar.map(build_flat_cube, cubefiles)
+    get_executor(backend="serial").map(build_flat_cube, cubefiles, progress=True)
     
     
     
@@ -4,13 +4,12 @@
 import numpy as np
 import os
 import warnings
-import matplotlib.pyplot as mpl
 from glob import glob
 
 from astrobject.utils.tools import dump_pkl
-from astropy.io import fits
 
 from .. import io
+from ..utils.performance import timed_stage
 
 from ..ccd import get_ccd
 from ..spectralmatching import get_tracematcher, illustrate_traces, load_trace_masks
@@ -25,6 +24,7 @@ from ..sedm import INDEX_CCD_CONTOURS, TRACE_DISPERSION, build_sedmcube, build_c
 #  Spectral Matcher        #
 #                          #
 ############################
+@timed_stage()
 def build_tracematcher(date, verbose=True, width=None,
                            save_masks=False,
                            rebuild=False,
@@ -81,7 +81,105 @@ def build_tracematcher(date, verbose=True, width=None,
             return
         load_trace_masks(smap, smap.get_traces_within_polygon(INDEX_CCD_CONTOURS), notebook=notebook)
         smap.writeto(timedir+"%s_TraceMatch_WithMasks.pkl"%date)
-    
+
+@timed_stage()
+def bootstrap_night_calibrations(date, refdate, max_shift=10, ntiles=4, fit_rotation=True,
+                                     max_residual=0.5, notebook=False):
+    """ Build the TraceMatch, HexaGrid and WaveSolution of the night by moving
+    those of a reference night, instead of building them from scratch.
+
+    The dome of the night is registered on the dome of the reference night
+    (see spectralmatching.register_images). If the registration is good enough,
+    - the reference traces are moved accordingly (TraceMatch.add_trace_transformation);
+      the reference trace masks are shifted if the transformation is an integer translation,
+      rebuilt otherwise. The TraceMatch_WithMasks is always saved, such that the
+      make-style pipeline (see pipeline.NightPipeline) records the three calibrations as built.
+    - the reference HexaGrid is copied as is (the trace indexes are unchanged).
+    - the reference wavelength solutions are moved by the ccd x-shift of each trace
+      (WaveSolution.add_pixel_offset).
+
+    Parameters
+    ----------
+    date, refdate: [string]
+        YYYYMMDD of the night to calibrate and of the reference night
+        (that must have its TraceMatch, HexaGrid and WaveSolution)
+
+    max_shift: [int] -optional-
+        largest shift [in pixels] searched along each axis.
+
+    ntiles: [int] -optional-
+        number of tiles along each axis used to measure the local shifts.
+
+    fit_rotation: [bool] -optional-
+        Shall a rotation and scale be fitted in addition to the shift?
+
+    max_residual: [float] -optional-
+        The bootstrap fails if the rms [in pixel] of the local shifts around
+        the registration model is larger than this.
+
+    Returns
+    -------
+    dict (the registration, with its 'success' entry).
+    Nothing is saved if the registration failed: the calibrations should then be built (build_tracematcher etc.)
+    """
+    import json
+    from astropy.io import fits
+    from ..spectralmatching import register_images, get_registration_shifts, shift_sparse_mask
+
+    timedir, refdir = io.get_datapath(date), io.get_datapath(refdate)
+    dome    = fits.getdata(glob(timedir+"dome.fits*")[0])
+    refdome = fits.getdata(glob(refdir+"dome.fits*")[0])
+
+    registration = register_images(dome, refdome, max_shift=max_shift, ntiles=ntiles,
+                                       fit_rotation=fit_rotation)
+    registration.update({"date": date, "refdate": refdate,
+                         "success": bool(registration["residual"] <= max_residual)})
+    print("Registration of %s on %s: i_offset=%.2f j_offset=%.2f rotation=%.3fdeg scale=%.5f (residual %.2f pixels)"%(
+        date, refdate, registration["i_offset"], registration["j_offset"],
+        registration["rotation"], registration["scale"], registration["residual"]))
+
+    if not registration["success"]:
+        warnings.warn("the dome registration of %s on %s failed (residual %.2f > %.2f pixels). Nothing saved."%(
+            date, refdate, registration["residual"], max_residual))
+        return registration
+
+    # - TraceMatch
+    smap = io.load_nightly_tracematch(refdate, withmask=True)
+    refmasks   = dict(smap.trace_masks)
+    refcenters = {i: np.mean(v, axis=0) for i,v in smap.trace_vertices.items()}
+    smap.add_trace_transformation(registration["i_offset"], registration["j_offset"],
+                                    rotation=registration["rotation"], scale=registration["scale"],
+                                    center=registration["center"])
+    smap.writeto(timedir+"%s_TraceMatch.pkl"%date)
+    ij_round = np.round([registration["i_offset"], registration["j_offset"]])
+    if len(refmasks)>0 and np.abs(registration["rotation"])<1e-3 and np.abs(registration["scale"]-1)<1e-5 \
+      and np.all(np.abs(np.asarray([registration["i_offset"], registration["j_offset"]])-ij_round) < 0.05):
+        for i, mask in refmasks.items():
+            smap.set_trace_masks(shift_sparse_mask(mask, *ij_round), i)
+    else:
+        warnings.warn("the registration is not an integer translation, the trace masks are rebuilt")
+        load_trace_masks(smap, smap.get_traces_within_polygon(INDEX_CCD_CONTOURS), notebook=notebook)
+    smap.writeto(timedir+"%s_TraceMatch_WithMasks.pkl"%date)
+
+    # - HexaGrid
+    io.load_nightly_hexagonalgrid(refdate).writeto(timedir+"%s_HexaGrid.pkl"%date)
+
+    # - WaveSolution. arc pixels run opposite to the ccd x-axis
+    wsol   = io.load_nightly_wavesolution(refdate)
+    traceindexes = [i for i in wsol.traceindexes if i in refcenters]
+    ishifts = get_registration_shifts(registration, [refcenters[i] for i in traceindexes])[:,0]
+    wsol.add_pixel_offset({i: -di for i, di in zip(traceindexes, ishifts)})
+    wsol.writeto(timedir+"%s_WaveSolution.pkl"%date)
+
+    with open(timedir+"%s_TraceRegistration.json"%date, "w") as f_:
+        json.dump(registration, f_, indent=1)
+
+    # - the make-style pipeline must not rebuild them
+    from .pipeline import NightPipeline
+    NightPipeline(date).set_built(["tracematch", "hexagrid", "wavesolution"])
+
+    return registration
+
 ############################
 #                          #
 # Spaxel Spacial Position  #
@@ -105,68 +203,127 @@ def build_hexagonalgrid(date, xybounds=None):
 # Spaxel Spacial Position  #
 #                          #
 ############################
+def build_flatfield_reference(date, ref="dome"):
+    """ Build the cube (e3d_<ref>.fits) of the lamp ccd used as flatfield reference.
+    This cube is not flatfielded, flexure or atmosphere corrected. 
+    """
+    tmatch   = io.load_nightly_tracematch(date, withmask=True) 
+    # - The CCD
+    ccdreffile = io.get_night_files(date, kind="ccd.lamp", target=ref)[0]
+    ccdref     = get_ccd(ccdreffile, tracematch = tmatch, background = 0)
+    ccdref.fetch_background(set_it=True, build_if_needed=True)
+    if not ccdref.has_var():
+        ccdref.set_default_variance()
+    # - HexaGrid
+    hgrid    = io.load_nightly_hexagonalgrid(date)
+    wcol     = io.load_nightly_wavesolution(date)
+    wcol._load_full_solutions_()
+    # - Build a cube
+    build_sedmcube(ccdref, date, lbda=None, wavesolution=wcol, hexagrid=hgrid,
+                    flexure_corrected=False,
+                    flatfielded=False, build_calibrated_cube=False,atmcorrected=False)
+
 def build_flatfield(date, lbda_min=7000, lbda_max=9000,
-                    ref="dome", build_ref=True,
+                    ref="dome", build_ref=True, from_cube=False,
                     kind="median", savefig=True):
-    """ """
-    from ..sedm import get_sedmcube
-    from pyifu.spectroscopy  import get_slice
+    """ Build the night flatfield (<date>_Flat.fits), i.e. the relative transmission 
+    of the spaxels measured on the `ref` lamp within [lbda_min, lbda_max].
+
+    Parameters
+    ----------
+    date: [string]
+        date in usual YYYYMMDD format
 
-    reffile  = io.get_night_files(date, kind="cube.basic", target=ref)
+    lbda_min, lbda_max: [float, float] -optional-
+        wavelength range [in Angstrom] used to measure the spaxel fluxes.
 
-    # - If the reference if not there yet.
-    if len(reffile)==0:
-        warnings.warn("The reference cube %s does not exist "%ref)
-        if build_ref:
-            warnings.warn("build_flatfield is building it!")
-        else:
-            raise IOError("No reference cube to build the flatfield (build_ref was set to False)")
-        # --------------------- #
-        # Build the reference   #
-        # --------------------- #
-        tmatch   = io.load_nightly_tracematch(date, withmask=True) 
+    ref: [string] -optional-
+        target name of the lamp used as reference.
+
+    build_ref: [bool] -optional-
+        (only if from_cube) shall the reference cube be built if it does not exist?
+
+    from_cube: [bool] -optional-
+        Shall the spaxel fluxes be measured on the e3d cube of the reference lamp
+        (see build_flatfield_reference)? If False, they are directly measured on
+        the reference ccd (see CCD.get_band_flux), which does not require the cube.
+
+    kind: [string] -optional-
+        How to normalize the flat: median, mean or a spaxel index.
+
+    savefig: [bool] -optional-
+        Shall the flat3d figure be saved?
+
+    Returns
+    -------
+    Void
+    """
+    from pyifu.spectroscopy  import get_slice
+
+    if from_cube:
+        from ..sedm import get_sedmcube
+        reffile  = io.get_night_files(date, kind="cube.basic", target=ref)
+
+        # - If the reference if not there yet.
+        if len(reffile)==0:
+            warnings.warn("The reference cube %s does not exist "%ref)
+            if build_ref:
+                warnings.warn("build_flatfield is building it!")
+            else:
+                raise IOError("No reference cube to build the flatfield (build_ref was set to False)")
+            # --------------------- #
+            # Build the reference   #
+            # --------------------- #
+            build_flatfield_reference(date, ref=ref)
+        
+        reffile  = io.get_night_files(date, kind="cube.basic", target=ref)[0]
+        refcube  = get_sedmcube(reffile)
+        sliceref = refcube.get_slice(lbda_min, lbda_max, usemean=True)
+        indexes  = refcube.indexes
+        xy       = np.asarray(refcube.index_to_xy(indexes))
+        vertices = refcube.spaxel_vertices
+    else:
+        from ..sedm import SEDMSPAXELS
+        tmatch   = io.load_nightly_tracematch(date, withmask=True)
+        hgrid    = io.load_nightly_hexagonalgrid(date)
+        wcol     = io.load_nightly_wavesolution(date)
         # - The CCD
         ccdreffile = io.get_night_files(date, kind="ccd.lamp", target=ref)[0]
-        ccdref     = get_ccd(ccdreffile, tracematch = tmatch, background = 0)
+        ccdref     = get_ccd(ccdreffile, tracematch = tmatch, background = 0, lazy=True)
         ccdref.fetch_background(set_it=True, build_if_needed=True)
-        if not ccdref.has_var():
-            ccdref.set_default_variance()
-        # - HexaGrid
-        hgrid    = io.load_nightly_hexagonalgrid(date)
-        wcol     = io.load_nightly_wavesolution(date)
-        wcol._load_full_solutions_()
-        # - Build a cube
-        build_sedmcube(ccdref, date, lbda=None, wavesolution=wcol, hexagrid=hgrid,
-                        flexure_corrected=False,
-                        flatfielded=False, build_calibrated_cube=False,atmcorrected=False)
+        # - Same spaxels as extract_cube
+        traceindexes = np.sort(list(wcol.wavesolutions.keys()))
+        indexes  = traceindexes[hgrid.ids_to_index(traceindexes)>=0]
+        sliceref = ccdref.get_band_flux(wcol, lbda_min, lbda_max, traceindexes=indexes)
+        xy       = np.asarray(hgrid.index_to_xy(hgrid.ids_to_index(indexes), invert_rotation=True)).T
+        vertices = np.dot(hgrid.grid_rotmatrix, SEDMSPAXELS.T).T
+        ccdref.release_memory()
         
     # ---------------------- #
     #  Actual FlatFielding   #
     # ---------------------- #
-    reffile  = reffile  = io.get_night_files(date, kind="cube.basic", target=ref)[0]
-    refcube  = get_sedmcube(reffile)
-    sliceref = refcube.get_slice(lbda_min, lbda_max, usemean=True)
     # - How to normalize the Flat
     if kind in ["med", "median"]:
         norm = np.nanmedian(sliceref)
     elif kind in ["mean"]:
         norm = np.nanmean(sliceref)
-    elif kind in refcube.indexes:
-        norm = sliceref[np.argwhere(refcube.indexes==kind)]
+    elif kind in indexes:
+        norm = sliceref[np.argwhere(indexes==kind)]
     else:
         raise ValueError("Unable to parse the given kind: %s"%kind)
     
     # - The Flat
     flat     = sliceref / norm
-    slice_ = get_slice(flat, np.asarray(refcube.index_to_xy(refcube.indexes)),
-                        refcube.spaxel_vertices,
-                        indexes=refcube.indexes, variance=None, lbda=None)
+    slice_ = get_slice(flat, xy, vertices,
+                        indexes=indexes, variance=None, lbda=None)
     # - Figure
     timedir  = io.get_datapath(date)
     # - Saving
     slice_.header["CALTYPE"] = "FlatField"
     slice_.header["FLATSRC"]  = ref
     slice_.header["FLATREF"]  = kind
+    slice_.header["FLATLBDA"] = ("%d-%d"%(lbda_min, lbda_max), "wavelength range [A] of the flat")
+    slice_.header["FLATCUBE"] = (from_cube, "Is the flat measured on the reference cube?")
     slice_.writeto(timedir+'%s_Flat.fits'%date)
     
     if savefig:
@@ -179,6 +336,7 @@ def build_flatfield(date, lbda_min=7000, lbda_max=9000,
 #   BackGround             #
 #                          #
 ############################
+@timed_stage()
 def build_backgrounds(date, smoothing=[0,5], start=2, jump=10, 
                         target=None, lamps=True, only_lamps=False, skip_calib=True,
                         multiprocess=True,
@@ -190,7 +348,9 @@ def build_backgrounds(date, smoothing=[0,5], start=2, jump=10,
     fileccds = []
     if not only_lamps:
         crrfiles  = io.get_night_files(date, "ccd.crr", target=target)
-        if skip_calib: fileccds = [f for f in crrfiles if "Calib" not in fits.getval(f,"Name")]            
+        if skip_calib:
+            from astropy.io import fits
+            fileccds = [f for f in crrfiles if "Calib" not in fits.getval(f,"Name")]            
         fileccds += crrfiles
 
     # - Building the background
@@ -198,7 +358,7 @@ def build_backgrounds(date, smoothing=[0,5], start=2, jump=10,
     nfiles = len(fileccds)
     print("%d files to go..."%nfiles)
     for i,file_ in enumerate(fileccds):
-        build_background(get_ccd(file_, tracematch=tmap, background=0),
+        build_background(get_ccd(file_, tracematch=tmap, background=0, lazy=True),
                         start=start, jump=jump, multiprocess=multiprocess, notebook=notebook,
                         smoothing=smoothing,
             savefile = None if not savefig else timedir+"bkgd_%s.pdf"%(file_.split('/')[-1].replace(".fits","")))
@@ -209,6 +369,7 @@ def build_backgrounds(date, smoothing=[0,5], start=2, jump=10,
 #  Wavelength Solution     #
 #                          #
 ############################
+@timed_stage()
 def build_wavesolution(date, verbose=False, ntest=None, idxrange=None,
                        use_fine_tuned_traces=False,
                        wavedegree=5, contdegree=3,
@@ -259,8 +420,11 @@ def build_wavesolution(date, verbose=False, ntest=None, idxrange=None,
         idxall = [l for l in idxall if l>=idxrange[0] and l<idxrange[1]]
     idx = idxall if ntest is None else np.random.choice(idxall,ntest, replace=False) 
 
-    # - Do The loop and map it thanks to astropy
-    from astropy.utils.console import ProgressBar
+    # - Extract all the arcspectra at once (one sparse product per lamp)
+    csolution.load_arccollections(idx)
+    
+    # - Do The loop (serial: the fits update csolution)
+    from ..utils.executor import get_executor
     def fitsolution(idx_):
         if saveindividuals:
             saveplot = timedir+"%s_wavesolution_trace%d.pdf"%(date,idx_)
@@ -269,10 +433,11 @@ def build_wavesolution(date, verbose=False, ntest=None, idxrange=None,
         csolution.fit_wavelesolution(traceindex=idx_, saveplot=None,
                     contdegree=contdegree, wavedegree=wavedegree, plotprop={"show_guesses":True})
         if saveplot is not None:
+            import matplotlib.pyplot as mpl
             csolution._wsol.show(show_guesses=True, savefile=saveplot)
             mpl.close("all")
             
-    ProgressBar.map(fitsolution, idx)
+    get_executor(backend="serial").map(fitsolution, idx, progress=True)
 
     # - output - #
     outfile = "%s_WaveSolution"%date
@@ -311,7 +476,9 @@ def build_night_cubes(date, target=None, lamps=True, only_lamps=False,
         fileccds += io.get_night_files(date, "ccd.lamp", target=target)
     if not only_lamps:
         crrfiles  = io.get_night_files(date, "ccd.crr", target=target)
-        if skip_calib: crrfiles = [f for f in crrfiles if "Calib" not in fits.getval(f,"Name")]            
+        if skip_calib:
+            from astropy.io import fits
+            crrfiles = [f for f in crrfiles if "Calib" not in fits.getval(f,"Name")]            
         fileccds += crrfiles
 
     print(fileccds)
@@ -321,12 +488,14 @@ def build_night_cubes(date, target=None, lamps=True, only_lamps=False,
 # ----------------- #
 #  Build Cubes      #
 # ----------------- #
+@timed_stage()
 def build_cubes(ccdfiles,  date, lbda=None,
                 tracematch=None, wavesolution=None, hexagrid=None,
                 flatfielded=True, flatfield=None,
                 traceflexure_corrected=True,
                 atmcorrected=True, flexure_corrected=True, 
                 build_calibrated_cube=True, calibration_ref=None,
+                stages=None, asyncwrite=True,
                 savefig=True, verbose=True, notebook=False):
     """ Build a cube from the an IFU ccd image. This image 
     should be bias corrected and cosmic ray corrected.
@@ -350,7 +519,12 @@ def build_cubes(ccdfiles,  date, lbda=None,
         See pysedm.sedm.SEDM_LBDA.
 
     // Cube Calibrator //
-    
+
+    tracematch: [TraceMatch] -optional-
+        The TraceMatch object. If it has trace masks, they are moved by the
+        trace flexure offset (see spectralmatching.shift_sparse_mask) instead of being rebuilt.
+        If None, this will be loaded using `date`.
+
     wavesolution: [WaveSolution] -optional-
         The wavelength solution containing the pixel<->wavelength conversion.
         If None, this will be loaded using `date`.
@@ -389,6 +563,17 @@ def build_cubes(ccdfiles,  date, lbda=None,
         If None, this will load the latest fluxcal object of the night.
         If Nothing found, no flux calibrated cube will be created. 
 
+    // In memory chaining //
+
+    stages: [ProductChain] -optional-
+        Stages applied in memory to every cube once built (e.g. PSF extraction),
+        see pysedm.utils.chaining.
+
+    asyncwrite: [bool] -optional-
+        Shall the cubes be written on a background thread while the next 
+        stages run? (all are written when this function returns; the writer
+        is specific to this call, such that only its own write errors are raised)
+
     Returns
     -------
     Void
@@ -396,6 +581,7 @@ def build_cubes(ccdfiles,  date, lbda=None,
     if traceflexure_corrected:
         from ..flexure import TraceFlexure
         from ..mapping import Mapper
+        from ..spectralmatching import shift_sparse_mask
     # ------------------ #
     # Loading the Inputs #
     # ------------------ #
@@ -426,17 +612,23 @@ def build_cubes(ccdfiles,  date, lbda=None,
     # ---------------- #
     ccds = []
     for ccdfile in ccdfiles:
-        ccd_    = get_ccd(ccdfile, tracematch = tracematch.copy(), background = 0)
+        ccd_    = get_ccd(ccdfile, tracematch = tracematch.copy(), background = 0, lazy=True)
         if traceflexure_corrected:
             flex = TraceFlexure(ccd_, mapper=mapper)
             flex.derive_j_offset(verbose=verbose)
+            premasks = dict(ccd_.tracematch.trace_masks)
             ccd_.tracematch.add_trace_offset(0, flex.j_offset)
             if savefig:
                 flex.show_j_flexure_ccd(show=False, savefile=ccd_.filename.replace("crr","flexuretrace_crr").replace(".fits",".pdf"))
             ccd_.header["FLXTRACE"] =  (True, "Is TraceMatch corrected for j flexure?")
             ccd_.header["FLXTRVAL"] =  (flex.j_offset, "amplitude in pixel of the  j flexure Trace correction")
-            if verbose: print("Loading the %d traces"%len(mapper.traceindexes))
-            load_trace_masks(ccd_.tracematch, mapper.traceindexes, notebook=notebook)
+            # - masks given with the tracematch are moved (as the vertices) by the offset, the others are built
+            for i, mask in premasks.items():
+                ccd_.tracematch.set_trace_masks(shift_sparse_mask(mask, 0, flex.j_offset), i)
+            missing = [i for i in mapper.traceindexes if i not in premasks]
+            if len(missing)>0:
+                if verbose: print("Loading the %d traces"%len(missing))
+                load_trace_masks(ccd_.tracematch, missing, notebook=notebook)
         else:
             ccd_.header["FLXTRACE"] =  (False, "Is TraceMatch corrected for j flexure?")
             ccd_.header["FLXTRVAL"] =  (0, "amplitude in pixel of the  j flexure Trace correction")
@@ -450,6 +642,11 @@ def build_cubes(ccdfiles,  date, lbda=None,
     # ---------------- #
     # Build the Cubes  #
     # ---------------- #
+    # - a writer per call: only the cubes of this call are waited for (e.g. watcher threads)
+    if asyncwrite:
+        from ..utils.chaining import AsyncWriter
+        asyncwrite = AsyncWriter()
+        
     # internal routine 
     def _build_cubes_(ccdin):
         print(ccdin.filename)
@@ -459,6 +656,7 @@ def build_cubes(ccdfiles,  date, lbda=None,
                     atmcorrected=atmcorrected, 
                     build_calibrated_cube=build_calibrated_cube,
                     calibration_ref=calibration_ref,
+                    stages=stages, asyncwrite=asyncwrite,
                     savefig=savefig)
         #try:
         build_sedmcube(ccdin, date,  **prop)
@@ -467,11 +665,19 @@ def build_cubes(ccdfiles,  date, lbda=None,
             
             
     # The actual build
-    if len(ccds)>1:
-        from astropy.utils.console import ProgressBar
-        ProgressBar.map(_build_cubes_, ccds)
-    else:
-        _build_cubes_(ccds[0])
+    try:
+        if len(ccds)>1:
+            from ..utils.executor import get_executor
+            get_executor(backend="serial").map(_build_cubes_, ccds, progress=True)
+        else:
+            _build_cubes_(ccds[0])
+    except:
+        if asyncwrite:
+            asyncwrite.close(raise_errors=False)
+        raise
+
+    if asyncwrite:
+        asyncwrite.close()
         
 # ---------------- #
 # Flux Calibration #
@@ -494,8 +700,9 @@ def calibrate_cubes(cubefiles, date=None, calibrated_reference=None,
     if len(cubefiles)==1:
         _build_cal_cubes_(cubefiles[0])
     else:
-        from astropy.utils.console import ProgressBar
-        ProgressBar.map(_build_cal_cubes_, cubefiles, multiprocess=multiprocess, step=2)
+        # threads: _build_cal_cubes_ is a closure
+        from ..utils.executor import get_executor
+        get_executor(backend="thread" if multiprocess else "serial").map(_build_cal_cubes_, cubefiles, progress=True)
         
     
 def save_cubeplot(date, kind="cube.basic"):
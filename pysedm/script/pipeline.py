@@ -0,0 +1,502 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Make-style night pipeline.
+
+The night products are nodes of a dependency graph:
+
+  TraceMatch -> HexaGrid -> WaveSolution -> Flat (dome cube only if flatcube=True)
+             -> backgrounds -> cubes (+ calibrated cubes and PSF extraction)
+
+The flux calibration and the PSF extraction are chained in memory within the
+cube node (see utils.chaining.ProductChain), such that the cubes are not read back.
+
+A node is rebuilt only if one of its outputs is missing or if one of its
+inputs changed since its last build (mtime and size first, then content hash).
+The state of the nodes is stored in `<date>_PipelineState.json`.
+Nodes whose dependencies are up-to-date can run in parallel (njobs).
+
+Example
+-------
+```
+from pysedm.script.pipeline import NightPipeline
+pipe = NightPipeline("20180101", njobs=4)
+pipe.run()                  # everything that is out of date
+pipe.run(targets="^cube:")  # only the cubes (and what they need)
+```
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import warnings
+import numpy as np
+
+from propobject import BaseObject
+
+from .. import io
+
+__all__ = ["NightPipeline", "run_night_pipeline"]
+
+STATE_ROOT = "PipelineState"
+LAMPS      = ["Hg", "Cd", "Xe"]
+FLATREF    = "dome"
+
+
+def run_night_pipeline(date, targets=None, njobs=1, force=False, dry_run=False, **kwargs):
+    """ Build (only) what is out of date in the given night.
+
+    Parameters
+    ----------
+    date: [string]
+        YYYYMMDD
+
+    targets: [string/None] -optional-
+        regular expression on the node names (e.g. "^cube:|^flat$").
+        These nodes and their dependencies are considered. None means all.
+
+    njobs: [int] -optional-
+        number of nodes that can run at the same time (in worker processes).
+        The parallel loops of each node (e.g. background fit, trace masks) then
+        get the number of cpus (or $PYSEDM_NWORKERS) divided by njobs workers.
+
+    force: [bool] -optional-
+        rebuild the (targeted) nodes even if they are up-to-date.
+
+    dry_run: [bool] -optional-
+        only print what would be done.
+
+    **kwargs goes to NightPipeline (options)
+
+    Returns
+    -------
+    dict (node name -> status)
+    """
+    pipe = NightPipeline(date, njobs=njobs, **kwargs)
+    return pipe.run(targets=targets, force=force, dry_run=dry_run)
+
+def get_file_signature(filename, content=True):
+    """ mtime, size and (if content) sha1 of the given file """
+    stat = os.stat(filename)
+    signature = {"mtime":stat.st_mtime, "size":stat.st_size}
+    if content:
+        sha1 = hashlib.sha1()
+        with open(filename, "rb") as f_:
+            for chunk in iter(lambda: f_.read(2**20), b""):
+                sha1.update(chunk)
+        signature["sha1"] = sha1.hexdigest()
+    return signature
+
+def _get_objname_(ccdfile):
+    """ ccd.objname without loading the ccd """
+    from astropy.io.fits import getval
+    try:
+        name = getval(ccdfile, "NAME")
+    except KeyError:
+        return "no-name"
+    return name.split()[1] if "Calib" in name else name
+
+# ------------------ #
+#  Node Actions      #
+# ------------------ #
+def _run_tracematch_(date):
+    from .ccd_to_cube import build_tracematcher
+    build_tracematcher(date, save_masks=True, rebuild=True, notebook=False)
+
+def _run_hexagrid_(date):
+    from .ccd_to_cube import build_hexagonalgrid
+    build_hexagonalgrid(date)
+
+def _run_wavesolution_(date, lamps, savefig=True):
+    from .ccd_to_cube import build_wavesolution
+    build_wavesolution(date, lamps=lamps, savefig=savefig, rebuild=True)
+
+def _run_background_(date, ccdfile, savefig=True):
+    from ..ccd import get_ccd
+    from ..background import build_background
+    ccd = get_ccd(ccdfile, tracematch=io.load_nightly_tracematch(date), background=0, lazy=True)
+    build_background(ccd, notebook=False,
+                     savefile=None if not savefig else
+                        io.get_datapath(date)+"bkgd_%s.pdf"%(ccdfile.split('/')[-1].replace(".fits","")))
+
+def _run_flatreference_(date, ref=FLATREF):
+    from .ccd_to_cube import build_flatfield_reference
+    build_flatfield_reference(date, ref=ref)
+
+def _run_flat_(date, ref=FLATREF, lbda_min=7000, lbda_max=9000, from_cube=False, savefig=True):
+    from .ccd_to_cube import build_flatfield
+    build_flatfield(date, lbda_min=lbda_min, lbda_max=lbda_max, ref=ref,
+                    build_ref=False, from_cube=from_cube, savefig=savefig)
+
+def _run_cube_(date, ccdfile, calibrated_cube=False, psf_extraction=False, savefig=True):
+    """ cube of the ccd, then (in memory) its flux calibrated cube and PSF extraction """
+    from .ccd_to_cube import build_cubes
+    from ..utils.chaining import ProductChain
+    stages = ProductChain()
+    if psf_extraction:
+        stages.add_stage(_psf_extraction_stage_, name="psf_extraction", date=date, savefig=savefig)
+    build_cubes([ccdfile], date, build_calibrated_cube=calibrated_cube,
+                stages=stages, asyncwrite=True, savefig=savefig)
+
+def _run_psf_extraction_(date, cubefile, lbdarange=[4500,7000], nbins=10, savefig=True):
+    """ Same as the --auto mode of bin/extract_star.py 
+    (cubefile can also be the in-memory SEDMCube, see _psf_extraction_stage_) """
+    from ..sedm import get_sedmcube
+    from ..utils import extractstar, performance
+    cube     = get_sedmcube(cubefile) if type(cubefile) is str else cubefile
+    cubefile = cube.filename
+    with performance.stage("extract_star", date=date, cube=cubefile.split("/")[-1]):
+        lbdas_ = np.linspace(lbdarange[0], lbdarange[1], nbins+1)
+        lbdas  = np.asarray([lbdas_[:-1],lbdas_[1:]]).T
+        savedata = cube.filename.replace("e3d","psffit_e3d").replace(".fits",".json")
+        psfmodel = extractstar.fit_psf_parameters(cube, lbdas, savedata=savedata,
+                                                  savefig=savedata.replace(".json",".pdf") if savefig else None,
+                                                  return_psfmodel=True)
+        spec, bkgd, forcepsf = extractstar.fit_force_spectroscopy(cube, psfmodel,
+                            savefig=cube.filename.replace("e3d","forcepsf_e3d").replace(".fits",".pdf") if savefig else None)
+        performance.get_registry().to_header(spec.header)
+        io._saveout_forcepsf_(cubefile, cube, forcepsf.cuberes, forcepsf.cubemodel, spec, bkgd, nofig=not savefig)
+
+def _psf_extraction_stage_(cube, date, **kwargs):
+    """ _run_psf_extraction_ as an in-memory stage (see utils.chaining.ProductChain).
+    Calibration (dome, arc) cubes are skipped. """
+    if "Calib" in cube.header.get("NAME", ""):
+        return
+    _run_psf_extraction_(date, cube, **kwargs)
+
+def _run_node_(action, args, kwargs):
+    """ (picklable) node execution used by the worker processes """
+    action(*args, **kwargs)
+
+
+class NightPipeline( BaseObject ):
+    """ Dependency graph of the night products with up-to-date checks """
+    PROPERTIES         = ["date"]
+    SIDE_PROPERTIES    = ["njobs", "options"]
+    DERIVED_PROPERTIES = ["nodes", "state"]
+
+    def __init__(self, date, njobs=1, savefig=True, lamps=LAMPS, flatref=FLATREF,
+                     flatlbda=[7000,9000], flatcube=False, psf_extraction=True, calibrated_cubes=True,
+                     load=True):
+        """ """
+        self._properties["date"] = date
+        self._side_properties["njobs"] = njobs
+        self._side_properties["options"] = dict(savefig=savefig, lamps=lamps, flatref=flatref,
+                                                flatlbda=flatlbda, flatcube=flatcube,
+                                                psf_extraction=psf_extraction,
+                                                calibrated_cubes=calibrated_cubes)
+        if load:
+            self.build_nodes()
+
+    # =================== #
+    #   Methods           #
+    # =================== #
+    # --------- #
+    #  BUILDER  #
+    # --------- #
+    def add_node(self, name, inputs, outputs, action, *args, **kwargs):
+        """ Add a node to the graph.
+
+        Parameters
+        ----------
+        name: [string]
+            unique name of the node
+
+        inputs, outputs: [list of string]
+            filenames (relative to the night directory) read and created by the node.
+
+        action: [function]
+            called as action(*args, **kwargs) to build the outputs.
+        """
+        self.nodes[name] = {"inputs":list(inputs), "outputs":list(outputs),
+                            "action":action, "args":args, "kwargs":kwargs}
+
+    def build_nodes(self):
+        """ Build the graph based on the files currently in the night directory """
+        date, opts = self.date, self.options
+        self._derived_properties["nodes"] = {}
+        savefig = opts["savefig"]
+        # - Calibrations
+        tmatch, tmatchmask = "%s_TraceMatch.pkl"%date, "%s_TraceMatch_WithMasks.pkl"%date
+        hexagrid, wsol, flat = "%s_HexaGrid.pkl"%date, "%s_WaveSolution.pkl"%date, "%s_Flat.fits"%date
+        lampfiles = [f.split("/")[-1] for f in io.get_night_files(date, "ccd.lamp")]
+        domefile  = [f for f in lampfiles if f.startswith("dome")]
+        arcfiles  = [f for f in lampfiles if re.search("^(%s)"%"|".join(opts["lamps"]), f)]
+        flatfile  = [f for f in lampfiles if f.startswith(opts["flatref"])]
+
+        self.add_node("tracematch", domefile[:1], [tmatch, tmatchmask], _run_tracematch_, date)
+        self.add_node("hexagrid", [tmatch], [hexagrid], _run_hexagrid_, date)
+        self.add_node("wavesolution", [tmatchmask]+arcfiles, [wsol], _run_wavesolution_,
+                          date, opts["lamps"], savefig=savefig)
+        if len(flatfile)>0:
+            reffile = flatfile[0]
+            self.add_node("background:%s"%reffile, [reffile, tmatch], ["bkgd_%s"%reffile],
+                              _run_background_, date, io.get_datapath(date)+reffile, savefig=savefig)
+            # - the flat is measured on the reference ccd, its cube is only built if requested
+            if opts["flatcube"]:
+                refcube = "%s_%s"%(io.PROD_CUBEROOT, reffile.split(".fits")[0])+".fits"
+                self.add_node("flatreference", [reffile, "bkgd_%s"%reffile, tmatchmask, hexagrid, wsol], [refcube],
+                                  _run_flatreference_, date, ref=opts["flatref"])
+                flatinputs = [refcube]
+            else:
+                flatinputs = [reffile, "bkgd_%s"%reffile, tmatchmask, hexagrid, wsol]
+            self.add_node("flat", flatinputs, [flat], _run_flat_, date, ref=opts["flatref"],
+                              lbda_min=opts["flatlbda"][0], lbda_max=opts["flatlbda"][1],
+                              from_cube=opts["flatcube"], savefig=savefig)
+
+        # - Science
+        fluxcals = [f.split("/")[-1] for f in io.get_night_files(date, "spec.invsensitivity")] \
+          if opts["calibrated_cubes"] else []
+        for ccdfile in io.get_night_files(date, "ccd.crr"):
+            objname = _get_objname_(ccdfile)
+            if "Calib" in objname:
+                continue
+            ccdbase = ccdfile.split("/")[-1]
+            cube    = "%s_%s_%s.fits"%(io.PROD_CUBEROOT, ccdbase.split(".fits")[0], objname)
+            self.add_node("background:%s"%ccdbase, [ccdbase, tmatch], ["bkgd_%s"%ccdbase],
+                              _run_background_, date, ccdfile, savefig=savefig)
+            # - the calibrated cube and the PSF extraction are chained in memory (see _run_cube_)
+            inputs, outputs = [ccdbase, "bkgd_%s"%ccdbase, tmatch, hexagrid, wsol, flat], [cube]
+            calibrated_cube = len(fluxcals)>0
+            if calibrated_cube:
+                inputs  += fluxcals
+                outputs += [cube.replace(io.PROD_CUBEROOT, "%s_defcal"%io.PROD_CUBEROOT)]
+            if opts["psf_extraction"]:
+                outputs += [cube.replace(io.PROD_CUBEROOT, io.PROD_SPECROOT+"_forcepsf_auto_")]
+            self.add_node("cube:%s"%ccdbase, inputs, outputs, _run_cube_, date, ccdfile,
+                              calibrated_cube=calibrated_cube, psf_extraction=opts["psf_extraction"],
+                              savefig=savefig)
+
+    # --------- #
+    #  GETTER   #
+    # --------- #
+    def get_dependencies(self, name):
+        """ names of the nodes producing the inputs of the given node """
+        return [other for other, node in self.nodes.items()
+                    if other != name and np.any([f in node["outputs"] for f in self.nodes[name]["inputs"]])]
+
+    def get_required_nodes(self, targets=None):
+        """ nodes matching the targets regex and all their (recursive) dependencies """
+        if targets is None:
+            return list(self.nodes.keys())
+        required = [n for n in self.nodes.keys() if re.search(targets, n)]
+        i = 0
+        while i < len(required):
+            required += [d for d in self.get_dependencies(required[i]) if d not in required]
+            i += 1
+        return [n for n in self.nodes.keys() if n in required]
+
+    def is_stale(self, name):
+        """ Does the node need to be (re)built?
+
+        Returns
+        -------
+        bool, string (reason)
+        """
+        node, state = self.nodes[name], self.state.get(name, None)
+        path = io.get_datapath(self.date)
+        missing_in = [f for f in node["inputs"] if not os.path.isfile(path+f)]
+        if len(missing_in)>0:
+            return True, "missing input %s"%", ".join(missing_in)
+        missing_out = [f for f in node["outputs"] if not os.path.isfile(path+f)]
+        if len(missing_out)>0:
+            return True, "missing output %s"%", ".join(missing_out)
+        if state is None:
+            return True, "never built by the pipeline"
+
+        touched = {}
+        for f in node["inputs"]:
+            recorded = state["inputs"].get(f, None)
+            if recorded is None:
+                return True, "new input %s"%f
+            current = get_file_signature(path+f, content=False)
+            if current["mtime"] == recorded["mtime"] and current["size"] == recorded["size"]:
+                continue
+            # mtime or size changed, does the content too?
+            current = get_file_signature(path+f)
+            if current["sha1"] != recorded["sha1"]:
+                return True, "%s changed"%f
+            touched[f] = current
+            
+        # - same content: record the new signatures such that the file is not hashed again
+        if len(touched)>0:
+            state["inputs"].update(touched)
+            self.writeto_state()
+        return False, "up-to-date"
+
+    # --------- #
+    #  RUN      #
+    # --------- #
+    def run(self, targets=None, force=False, dry_run=False):
+        """ (re)build the out-of-date nodes, in dependency order.
+
+        Parameters
+        ----------
+        targets: [string/None] -optional-
+            regular expression on the node names. None means all.
+
+        force: [bool] -optional-
+            rebuild the targeted nodes even if they are up-to-date.
+
+        dry_run: [bool] -optional-
+            print what would be done without doing it.
+
+        Returns
+        -------
+        dict (node name -> "built", "up-to-date", "failed", "skipped" or "would-build" if dry_run)
+        """
+        required = self.get_required_nodes(targets)
+        forced   = [n for n in required if force and (targets is None or re.search(targets, n))]
+        status   = {}
+        running  = {}
+        executor = None
+        if self.njobs > 1 and not dry_run:
+            # - same worker processes as utils.executor (no fork, PYSEDM_* environment)
+            from concurrent.futures import ProcessPoolExecutor
+            from ..utils.executor import get_process_context, get_nworkers, _set_worker_shared_
+            environ  = {k: v for k, v in os.environ.items() if k.startswith("PYSEDM_")}
+            # - the cpus are shared by the nodes running at the same time (their inner pools)
+            environ["PYSEDM_NWORKERS"] = "%d"%max(get_nworkers() // self.njobs, 1)
+            executor = ProcessPoolExecutor(max_workers=self.njobs, mp_context=get_process_context(),
+                                           initializer=_set_worker_shared_, initargs=({}, environ))
+
+        try:
+            while len(status) < len(required):
+                nstatus = len(status)
+                # - Nodes ready to be checked
+                for name in required:
+                    if name in status or name in running:
+                        continue
+                    deps = [d for d in self.get_dependencies(name) if d in required]
+                    if np.any([d not in status for d in deps]):
+                        continue
+                    if np.any([status[d] in ["failed","skipped"] for d in deps]):
+                        status[name] = "skipped"
+                        continue
+                    if name in forced:
+                        stale, reason = True, "forced"
+                    elif np.any([status[d] == "would-build" for d in deps]):
+                        stale, reason = True, "dependency out of date"
+                    else:
+                        stale, reason = self.is_stale(name)
+                    if not stale:
+                        status[name] = "up-to-date"
+                        continue
+                    print("[%s] %s: %s"%(self.date, name, reason))
+                    if dry_run:
+                        status[name] = "would-build"
+                        continue
+                    node = self.nodes[name]
+                    if executor is None:
+                        running[name] = None
+                        status[name]  = self._run_node_locally_(name)
+                        running.pop(name)
+                    else:
+                        running[name] = executor.submit(_run_node_, node["action"], node["args"], node["kwargs"])
+
+                if len(running) == 0:
+                    if len(status) == nstatus: # nothing can progress (cyclic graph)
+                        status.update({n:"skipped" for n in required if n not in status})
+                    continue
+                # - Wait for at least one running node
+                from concurrent.futures import wait, FIRST_COMPLETED
+                done, _ = wait(list(running.values()), return_when=FIRST_COMPLETED)
+                for name in [n for n,f in running.items() if f in done]:
+                    future = running.pop(name)
+                    if future.exception() is not None:
+                        warnings.warn("%s failed: %s"%(name, future.exception()))
+                        status[name] = "failed"
+                    else:
+                        self._record_node_(name)
+                        status[name] = "built"
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        return status
+
+    def set_built(self, names):
+        """ Record the given nodes as built from their current inputs
+        (e.g. calibrations obtained otherwise, see ccd_to_cube.bootstrap_night_calibrations)
+
+        Returns
+        -------
+        Void
+        """
+        for name in names:
+            self._record_node_(name)
+
+    def _run_node_locally_(self, name):
+        """ run the node in the current process """
+        node = self.nodes[name]
+        try:
+            node["action"](*node["args"], **node["kwargs"])
+        except Exception as e:
+            warnings.warn("%s failed: %s"%(name, e))
+            return "failed"
+        self._record_node_(name)
+        return "built"
+
+    # --------- #
+    #  STATE    #
+    # --------- #
+    def _record_node_(self, name):
+        """ store the input signatures of a freshly built node """
+        path = io.get_datapath(self.date)
+        node = self.nodes[name]
+        self.state[name] = {"built":time.strftime("%Y-%m-%dT%H:%M:%S"),
+                            "inputs":{f:get_file_signature(path+f) for f in node["inputs"]
+                                          if os.path.isfile(path+f)},
+                            "outputs":node["outputs"]}
+        self.writeto_state()
+
+    def load_state(self):
+        """ load the <date>_PipelineState.json file (if any) """
+        self._derived_properties["state"] = {}
+        if os.path.isfile(self.statefile):
+            with open(self.statefile) as f_:
+                self._derived_properties["state"] = json.load(f_)
+
+    def writeto_state(self):
+        """ write the node states in <date>_PipelineState.json """
+        with open(self.statefile, "w") as f_:
+            json.dump(self.state, f_, indent=1)
+
+    # =================== #
+    #   Properties        #
+    # =================== #
+    @property
+    def date(self):
+        """ YYYYMMDD """
+        return self._properties["date"]
+
+    @property
+    def njobs(self):
+        """ number of nodes running at the same time """
+        return self._side_properties["njobs"]
+
+    @property
+    def options(self):
+        """ options of the pipeline (savefig, lamps, flatref...) """
+        return self._side_properties["options"]
+
+    @property
+    def nodes(self):
+        """ dictionary of the nodes (see add_node) """
+        if self._derived_properties["nodes"] is None:
+            self._derived_properties["nodes"] = {}
+        return self._derived_properties["nodes"]
+
+    @property
+    def statefile(self):
+        """ file containing the state of the nodes """
+        return io.get_datapath(self.date)+"%s_%s.json"%(self.date, STATE_ROOT)
+
+    @property
+    def state(self):
+        """ last build information of the nodes """
+        if self._derived_properties["state"] is None:
+            self.load_state()
+        return self._derived_properties["state"]
@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Night-wide quality checks of the ccd products.
+
+The in-trace / out-of-trace mask of a night is measured once at the native
+CCD resolution (see TraceMatch.get_notrace_mask) and shared by all the checks.
+The ccds are memory-mapped and checked in parallel (threads), and the results
+are stored in the machine-readable report `<date>_QualityCheck.json`.
+
+Example
+-------
+```
+from pysedm.script.quality import check_night_stdobs
+report = check_night_stdobs("20180101")   # all the standard star ccd.crr of the night
+[r["filename"] for r in report["stdobs"] if not r["success"]]
+```
+"""
+
+import os
+import json
+import functools
+import warnings
+import numpy as np
+
+from .. import io
+
+__all__ = ["check_night_stdobs", "check_stdobs", "get_night_notrace_mask"]
+
+QUALITY_ROOT       = "QualityCheck"
+CCD_STD_FLUX_RATIO = 10
+STD_PERCENTILES    = [10, 50, 99.99]
+STD_FAILURE_CODE   = 4 # no star detected
+
+
+def get_night_notrace_mask(date):
+    """ 2D boolean mask (read-only) that is True for places in the CCD without trace.
+    Measured once per night (per process) from the nightly tracematch, and again
+    if the tracematch file has been rebuilt since.
+    """
+    tracematchfile = io.get_datapath(date)+"%s_TraceMatch.pkl"%(date)
+    return _load_night_notrace_mask_(date, os.path.getmtime(tracematchfile))
+
+@functools.lru_cache(maxsize=4)
+def _load_night_notrace_mask_(date, mtime):
+    """ cached by date and modification time of the tracematch """
+    return io.load_nightly_tracematch(date).get_notrace_mask()
+
+def get_stdobs_stats(ccdfile, notrace_mask, limit=CCD_STD_FLUX_RATIO, only_std=False):
+    """ Percentile statistics inside and outside the traces of the given ccd.
+
+    Parameters
+    ----------
+    ccdfile: [string]
+        fullpath of the ccd (e.g. ccd.crr) file. The data are memory-mapped.
+
+    notrace_mask: [2D boolean array]
+        True for places in the CCD without trace (see get_night_notrace_mask).
+
+    limit: [float] -optional-
+        The std observation succeeded if the max(in-out) difference is greater
+        than limit times the median/low ratio of the (in-out) differences.
+
+    only_std: [bool] -optional-
+        Shall None be returned if the ccd is not a standard star exposure? (see io.is_stdstars)
+
+    Returns
+    -------
+    dict (or None)
+    """
+    from astropy.io import fits
+    with fits.open(ccdfile, memmap=True) as hdulist:
+        header = hdulist[0].header
+        if only_std and not io.is_stdstars(header):
+            return None
+        rawdata = hdulist[0].data
+        values_out = np.percentile(rawdata[notrace_mask], STD_PERCENTILES)
+        values_in  = np.percentile(rawdata[~notrace_mask], STD_PERCENTILES)
+        del rawdata
+
+    deltas = {k: float(v_in-v_out) for k, v_in, v_out in zip(["low","median","max"], values_in, values_out)}
+    success = bool(deltas["max"] > limit*(deltas["median"]/deltas["low"]))
+    return {"filename": ccdfile.split("/")[-1],
+            "object": header.get("OBJECT", None),
+            "percentiles": STD_PERCENTILES,
+            "in": [float(v_) for v_ in values_in],
+            "out": [float(v_) for v_ in values_out],
+            "deltas": deltas,
+            "limit": limit,
+            "success": success,
+            "code": 0 if success else STD_FAILURE_CODE}
+
+def check_stdobs(ccdfile, notrace_mask, limit=CCD_STD_FLUX_RATIO):
+    """ Has the given STD observation (ccd.crr) been successful? (see get_stdobs_stats)
+
+    Returns
+    -------
+    bool
+    """
+    return get_stdobs_stats(ccdfile, notrace_mask, limit=limit)["success"]
+
+def check_night_stdobs(date, target=None, limit=CCD_STD_FLUX_RATIO, nworkers=None,
+                       savefile=True):
+    """ Check all the standard star observations of the night.
+
+    Parameters
+    ----------
+    date: [string]
+        YYYYMMDD
+
+    target: [string/None] -optional-
+        target, target list (csv) or regex selecting the ccd.crr files.
+        If None, every ccd.crr file whose header OBJECT is a standard star is checked.
+
+    limit: [float] -optional-
+        see get_stdobs_stats()
+
+    nworkers: [int/None] -optional-
+        number of ccds checked in parallel (threads). If None, the pipeline default (see utils.executor.get_nworkers)
+
+    savefile: [bool/string] -optional-
+        Where the json report should be saved.
+        True means `<date>_QualityCheck.json` in the night directory, False means not saved.
+
+    Returns
+    -------
+    dict (the report)
+    """
+    from ..utils.executor import get_executor
+
+    if target is None:
+        ccdfiles = io.get_night_files(date, "ccd.crr")
+    else:
+        ccdfiles = [f_ for target_ in target.split(",") for f_ in io.get_night_files(date, "ccd.crr", target_)]
+    ccdfiles = sorted(set(ccdfiles))
+
+    notrace_mask = get_night_notrace_mask(date)
+
+    def _check_(ccdfile):
+        try:
+            return get_stdobs_stats(ccdfile, notrace_mask, limit=limit, only_std=target is None)
+        except Exception as err:
+            warnings.warn("quality check of %s failed: %s"%(ccdfile, err))
+            return {"filename": ccdfile.split("/")[-1], "success": False, "code": -1, "error": str(err)}
+
+    # threads: the memory-mapped reads and the percentiles release the GIL
+    results = [r_ for r_ in get_executor(backend="thread", nworkers=nworkers).imap(_check_, ccdfiles)
+                   if r_ is not None]
+
+    report = {"date": date, "target": target, "stdobs": results,
+              "nchecked": len(results), "nfailed": int(np.sum([not r_["success"] for r_ in results]))}
+    if savefile:
+        if savefile is True:
+            savefile = io.get_datapath(date)+"%s_%s.json"%(date, QUALITY_ROOT)
+        tmpfile = savefile+".tmp"
+        with open(tmpfile, "w") as f_:
+            json.dump(report, f_, indent=1)
+        os.replace(tmpfile, savefile)
+
+    return report
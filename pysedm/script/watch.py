@@ -0,0 +1,347 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Watch mode: reduce the science exposures of a night as they land.
+
+The night calibrations (tracematch, hexagrid, wavelength solution, flat) are
+loaded once and kept in memory. Every new `crr*.fits` file is pushed through
+background -> trace flexure -> cube (+ flexure) -> flux calibration -> PSF extraction
+by a bounded pool of workers.
+
+- back-pressure: at most `queuesize` exposures wait for a worker, the others
+  stay pending in the directory until there is room.
+- restart safety: the state of every exposure is stored in `<date>_WatchStatus.json`
+  (atomic writes). Exposures that were queued or running when the watcher stopped
+  are processed again at restart, the done ones are skipped.
+- bounded parallelism: the process pools of the background fits share the
+  cpus between the workers (see ncore), instead of one full pool per worker.
+
+Example
+-------
+```
+from pysedm.script.watch import NightWatcher
+watcher = NightWatcher("20180101", nworkers=2)
+watcher.run()                  # until killed
+watcher.run(until_idle=True)   # stops once everything landed is reduced
+```
+"""
+
+import os
+import json
+import time
+import queue
+import threading
+import warnings
+
+from propobject import BaseObject
+
+from .. import io
+
+__all__ = ["NightWatcher", "watch_night"]
+
+STATUS_ROOT = "WatchStatus"
+
+
+def watch_night(date, nworkers=1, queuesize=4, interval=5, until_idle=False, **kwargs):
+    """ Reduce the science exposures of the night as they land (see NightWatcher)
+
+    Parameters
+    ----------
+    date: [string]
+        YYYYMMDD
+
+    nworkers: [int] -optional-
+        number of exposures reduced at the same time.
+
+    queuesize: [int] -optional-
+        maximum number of exposures waiting for a worker (back-pressure).
+
+    interval: [float] -optional-
+        time [s] between two scans of the night directory.
+
+    until_idle: [bool] -optional-
+        stop once every landed exposure is reduced (otherwise run until interrupted)
+
+    **kwargs goes to NightWatcher (e.g. ncore, the number of processes of each background fit)
+
+    Returns
+    -------
+    NightWatcher
+    """
+    watcher = NightWatcher(date, nworkers=nworkers, queuesize=queuesize, interval=interval, **kwargs)
+    watcher.run(until_idle=until_idle)
+    return watcher
+
+
+class NightWatcher( BaseObject ):
+    """ Keep the night calibrations warm and reduce new exposures with a bounded queue """
+    PROPERTIES         = ["date"]
+    SIDE_PROPERTIES    = ["options"]
+    DERIVED_PROPERTIES = ["calibrations", "status", "queue", "lock", "stopevent", "filesizes"]
+
+    def __init__(self, date, nworkers=1, queuesize=4, interval=5,
+                     psf_extraction=True, fluxcalibration=True, savefig=False,
+                     max_retries=1, ncore=None, verbose=True, **kwargs):
+        """ ncore is the number of processes of the background fit of each worker.
+        If None, the pipeline number of workers (see utils.executor.get_nworkers) divided by nworkers.
+
+        **kwargs goes to build_cubes (e.g. flexure_corrected=False) """
+        self._properties["date"] = date
+        self._side_properties["options"] = dict(nworkers=nworkers, queuesize=queuesize,
+                                                interval=interval, psf_extraction=psf_extraction,
+                                                fluxcalibration=fluxcalibration, savefig=savefig,
+                                                max_retries=max_retries, ncore=ncore, verbose=verbose,
+                                                build_kwargs=kwargs)
+        self._derived_properties["queue"]     = queue.Queue(maxsize=queuesize)
+        self._derived_properties["lock"]      = threading.RLock()
+        self._derived_properties["stopevent"] = threading.Event()
+        self._derived_properties["filesizes"] = {}
+        self.load_status()
+
+    # =================== #
+    #   Methods           #
+    # =================== #
+    # --------- #
+    #  LOADER   #
+    # --------- #
+    def load_calibrations(self):
+        """ Load (once) the night calibrations used by every exposure.
+        The tracematch comes with its masks, they are shifted for the trace flexure of each exposure.
+        """
+        date = self.date
+        wavesolution = io.load_nightly_wavesolution(date)
+        wavesolution._load_full_solutions_()
+        self._derived_properties["calibrations"] = {
+            "tracematch":   io.load_nightly_tracematch(date, withmask=True),
+            "hexagrid":     io.load_nightly_hexagonalgrid(date),
+            "wavesolution": wavesolution,
+            "flatfield":    io.load_nightly_flat(date)}
+
+    def load_status(self):
+        """ load <date>_WatchStatus.json. Interrupted exposures are set back to pending """
+        status = {}
+        if os.path.isfile(self.statusfile):
+            with open(self.statusfile) as f_:
+                status = json.load(f_)
+        for filename, info in status.items():
+            if info["state"] in ["queued", "running"]:
+                info["state"] = "pending"
+        self._derived_properties["status"] = status
+
+    # --------- #
+    #  STATUS   #
+    # --------- #
+    def set_state(self, filename, state, **kwargs):
+        """ update the state of the given exposure and write the status file """
+        with self.lock:
+            info = self.status.setdefault(filename, {"state":None, "ntries":0})
+            info["state"]   = state
+            info["updated"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            info.update(kwargs)
+            self.writeto_status()
+
+    def writeto_status(self):
+        """ atomic write of <date>_WatchStatus.json """
+        with self.lock:
+            tmpfile = self.statusfile+".tmp"
+            with open(tmpfile, "w") as f_:
+                json.dump(self.status, f_, indent=1)
+            os.replace(tmpfile, self.statusfile)
+
+    # --------- #
+    #  WATCH    #
+    # --------- #
+    def get_new_exposures(self):
+        """ crr files that are complete (size stable between two scans)
+        and still have to be reduced """
+        from astropy.io.fits import getval
+        exposures = []
+        for filename in sorted(io.get_night_files(self.date, "ccd.crr")):
+            basename = filename.split("/")[-1]
+            info = self.status.get(basename, None)
+            if info is not None and (info["state"] in ["queued", "running", "done", "skipped"] or
+                (info["state"] == "failed" and info["ntries"] > self.options["max_retries"])):
+                continue
+            # - is the file fully written?
+            size = os.path.getsize(filename)
+            if self._filesizes.get(basename, None) != size:
+                self._filesizes[basename] = size
+                continue
+            if info is None:
+                try:
+                    name = getval(filename, "NAME")
+                except Exception:
+                    continue
+                if "Calib" in name:
+                    self.set_state(basename, "skipped")
+                    continue
+            exposures.append(filename)
+        return exposures
+
+    def scan(self):
+        """ queue the new exposures as long as there is room in the queue.
+
+        Returns
+        -------
+        int (number of exposures still pending because of back-pressure)
+        """
+        exposures = self.get_new_exposures()
+        for i, filename in enumerate(exposures):
+            basename = filename.split("/")[-1]
+            try:
+                self.set_state(basename, "queued")
+                self._queue.put_nowait(filename)
+            except queue.Full:
+                self.set_state(basename, "pending")
+                return len(exposures) - i
+        return 0
+
+    def run(self, until_idle=False):
+        """ Scan the night directory every `interval` seconds and reduce the new exposures.
+
+        Parameters
+        ----------
+        until_idle: [bool] -optional-
+            stop when every complete exposure has been processed.
+            Otherwise this runs until stop() is called (or KeyboardInterrupt)
+        """
+        if self.calibrations is None:
+            self.load_calibrations()
+        self._stopevent.clear()
+        workers = [threading.Thread(target=self._worker_, name="pysedm-watch-%d"%i, daemon=True)
+                       for i in range(self.options["nworkers"])]
+        [w.start() for w in workers]
+        try:
+            while not self._stopevent.is_set():
+                npending = self.scan()
+                if self.options["verbose"] and npending > 0:
+                    print("[watch %s] queue full, %d exposure(s) waiting"%(self.date, npending))
+                if until_idle and npending == 0 and self._queue.unfinished_tasks == 0 and \
+                  len(self.get_new_exposures()) == 0 and \
+                  not any(info["state"] == "pending" for info in self.status.values()):
+                    break
+                self._stopevent.wait(self.options["interval"])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            [w.join() for w in workers]
+
+    def stop(self):
+        """ stop the watcher (running exposures are finished first) """
+        self._stopevent.set()
+
+    def _worker_(self):
+        """ worker thread: reduce the queued exposures """
+        while not self._stopevent.is_set() or not self._queue.empty():
+            try:
+                filename = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            basename = filename.split("/")[-1]
+            try:
+                ntries = self.status.get(basename, {}).get("ntries", 0) + 1
+                self.set_state(basename, "running", ntries=ntries, started=time.time())
+                products = self.reduce_exposure(filename)
+                self.set_state(basename, "done", products=products, error=None,
+                               duration=time.time()-self.status[basename]["started"])
+                if self.options["verbose"]:
+                    print("[watch %s] %s reduced"%(self.date, basename))
+            except Exception as e:
+                warnings.warn("[watch %s] %s failed: %s"%(self.date, basename, e))
+                self.set_state(basename, "failed", error=str(e))
+            finally:
+                self._queue.task_done()
+
+    # --------- #
+    #  REDUCE   #
+    # --------- #
+    def reduce_exposure(self, filename):
+        """ background -> trace flexure -> cube (+flexure) -> flux calibration -> PSF extraction
+        using the warm calibrations.
+
+        Returns
+        -------
+        list of the created e3d cubes (flux calibrated included) and extracted spectrum filenames
+        """
+        from glob import glob
+        from .ccd_to_cube import build_cubes
+        from ..ccd import get_ccd
+        from ..background import build_background
+        from ..utils.chaining import ProductChain
+        from ..utils.executor import get_nworkers
+        date, calib, savefig = self.date, self.calibrations, self.options["savefig"]
+        datapath = io.get_datapath(date)
+        basename = filename.split("/")[-1].split(".fits")[0]
+
+        # - Background (the cpus are shared by the workers)
+        if len(glob(io.filename_to_background_name(filename)))==0:
+            ncore = self.options["ncore"] if self.options["ncore"] is not None else \
+                    max(get_nworkers() // self.options["nworkers"], 1)
+            build_background(get_ccd(filename, tracematch=calib["tracematch"], background=0, lazy=True),
+                             notebook=False, ncore=ncore)
+        # - PSF extraction, on the in-memory cube
+        stages = ProductChain()
+        if self.options["psf_extraction"]:
+            from .pipeline import _psf_extraction_stage_
+            stages.add_stage(_psf_extraction_stage_, name="psf_extraction", date=date, savefig=savefig)
+        # - Cube (trace flexure, flexure and flux calibration) -> stages
+        build_cubes([filename], date, tracematch=calib["tracematch"], hexagrid=calib["hexagrid"],
+                    wavesolution=calib["wavesolution"], flatfield=calib["flatfield"],
+                    build_calibrated_cube=self.options["fluxcalibration"],
+                    stages=stages, asyncwrite=True,
+                    savefig=savefig, verbose=False, **self.options["build_kwargs"])
+        # - e3d_<crr>, e3d_defcal_<crr> or e3d_cal_<crr> (see sedm.build_calibrated_sedmcube)
+        products = [c.split("/")[-1] for kind in ["", "_defcal", "_cal"] for c in
+                        sorted(glob(datapath+"%s%s_%s_*.fits"%(io.PROD_CUBEROOT, kind, basename)))]
+        if self.options["psf_extraction"]:
+            products += [f.split("/")[-1] for f in
+                             glob(datapath+"%s_forcepsf_auto__%s*.fits"%(io.PROD_SPECROOT, basename))]
+        return products
+
+    # =================== #
+    #   Properties        #
+    # =================== #
+    @property
+    def date(self):
+        """ YYYYMMDD """
+        return self._properties["date"]
+
+    @property
+    def options(self):
+        """ watcher options (nworkers, queuesize, interval...) """
+        return self._side_properties["options"]
+
+    @property
+    def calibrations(self):
+        """ warm night calibrations (see load_calibrations) """
+        return self._derived_properties["calibrations"]
+
+    @property
+    def status(self):
+        """ state of each exposure (pending, queued, running, done, failed, skipped) """
+        return self._derived_properties["status"]
+
+    @property
+    def statusfile(self):
+        """ file containing the status of the exposures """
+        return io.get_datapath(self.date)+"%s_%s.json"%(self.date, STATUS_ROOT)
+
+    @property
+    def lock(self):
+        """ lock protecting the status """
+        return self._derived_properties["lock"]
+
+    @property
+    def _queue(self):
+        """ bounded queue of the exposures waiting for a worker """
+        return self._derived_properties["queue"]
+
+    @property
+    def _stopevent(self):
+        return self._derived_properties["stopevent"]
+
+    @property
+    def _filesizes(self):
+        """ last seen size of the incoming files """
+        return self._derived_properties["filesizes"]
@@ -5,9 +5,11 @@
 
 import numpy              as np
 import warnings
+import functools
 
 from pyifu.spectroscopy   import Cube, Spectrum
-from .utils.tools         import kwargs_update, is_arraylike
+from .utils.tools         import kwargs_update, is_arraylike, get_dtype
+from .utils.performance   import timed_stage, get_registry
 
 from .io import PROD_CUBEROOT
 
@@ -39,6 +41,7 @@ MLA_ROTMATRIX   = np.asarray([[ np.cos(MLA_ROTATION_RAD),-np.sin(MLA_ROTATION_RA
                               [ np.sin(MLA_ROTATION_RAD), np.cos(MLA_ROTATION_RAD)]] )
 DEFAULT_REFLBDA = 6000 # In Angstrom
 IFU_SCALE_UNIT  = 0.75
+ADR_PARAMETERS  = ["airmass", "parangle", "temperature", "pressure", "relathumidity", "lbdaref"]
 
 
 # --- Palomar Atmosphere
@@ -75,9 +78,46 @@ def get_palomar_extinction():
     spec._source = "Hayes & Latham 1975"
     return spec
 
+def get_adr_trajectory(adrmodel, lbda, unit=1.):
+    """ Position shift caused by the ADR, with respect to the reference wavelength 
+    (adrmodel.lbdaref), i.e. adrmodel.refract(0, 0, lbda, unit=unit).
+
+    The trajectories are memoized on the ADR parameters (see ADR_PARAMETERS),
+    the wavelength grid and the unit, such that they are computed once per cube.
+
+    Parameters
+    ----------
+    adrmodel: [pyifu.adr.ADR]
+        the adr object
+
+    lbda: [float/array]
+        wavelength(s) in Angstrom
+
+    unit: [float] -optional-
+        unit in arcsec of a position shift of 1.
+
+    Returns
+    -------
+    array, array (x and y shifts for each lbda, read-only)
+    """
+    adrparam = tuple((k, None if adrmodel.data.get(k) is None else float(adrmodel.data.get(k)))
+                         for k in ADR_PARAMETERS)
+    lbda = np.atleast_1d(np.asarray(lbda, dtype="float"))
+    return _get_adr_trajectory_(adrparam, lbda.tobytes(), float(unit))
+
+@functools.lru_cache(maxsize=32)
+def _get_adr_trajectory_(adrparam, lbdabytes, unit):
+    """ cached by get_adr_trajectory() """
+    from pyifu.adr import ADR
+    x, y = ADR(**{k:v for k,v in adrparam if v is not None}).refract(0, 0, np.frombuffer(lbdabytes), unit=unit)
+    x, y = np.atleast_1d(x), np.atleast_1d(y)
+    x.flags.writeable, y.flags.writeable = False, False # shared by all the callers
+    return x, y
+
 # ------------------ #
 #  Builder           #
 # ------------------ #
+@timed_stage()
 def build_sedmcube(ccd, date, lbda=None, flatfield=None,
                    wavesolution=None, hexagrid=None,
                    # Flexure
@@ -90,7 +130,7 @@ def build_sedmcube(ccd, date, lbda=None, flatfield=None,
                    build_calibrated_cube=False,
                    # Output
                    savefig=True,verbose=False,
-                   return_cube=False):
+                   return_cube=False, stages=None, asyncwrite=False):
     """ Build a cube from the an IFU ccd image. This image 
     should be bias corrected and cosmic ray corrected.
 
@@ -118,6 +158,15 @@ def build_sedmcube(ccd, date, lbda=None, flatfield=None,
     return_cube: [bool] -optional-
         Shall this function return the cube (True) or save it (False)?
 
+    stages: [ProductChain] -optional-
+        Stages applied in memory to the saved cube (e.g. PSF extraction),
+        see pysedm.utils.chaining.
+
+    asyncwrite: [bool/AsyncWriter] -optional-
+        Shall the cubes be written by the background writer (see chaining.get_writer())?
+        Call get_writer().flush() to wait for them.
+        An AsyncWriter can also be given, such that its flush() only waits for these cubes.
+
     // Cube Calibrator //
     
     wavesolution: [WaveSolution] -optional-
@@ -248,20 +297,55 @@ def build_sedmcube(ccd, date, lbda=None, flatfield=None,
     else:
         cube.header['FLXCORR']  = (False, "Has the Flexure been corrected?")
         cube.header['FLXSCALE'] = (0, "Number of i (ccd-x) pixel shifted")
+
+    # - The ccd data are no longer needed (only affects lazy ccds)
+    ccd.release_memory()
         
     # - Return it.
     if return_cube:
         return cube
-    
-    cube.writeto(fileout)
+
+    get_registry().to_header(cube.header)
+    cube._side_properties["filename"] = fileout
+    _writeto_(cube, fileout, asyncwrite=asyncwrite)
 
     # - Build Also a flux calibrated cube?
     if build_calibrated_cube:
-        build_calibrated_sedmcube(fileout, date=date, calibration_ref=calibration_ref)
+        build_calibrated_sedmcube(cube, date=date, calibration_ref=calibration_ref,
+                                      asyncwrite=asyncwrite)
+    # - Downstream stages
+    if stages is not None:
+        stages.run(cube, date=date)
+        
+def build_calibrated_sedmcube(cube, date=None, calibration_ref=None, kindout=None,
+                                  asyncwrite=False):
+    """ Build the flux calibrated version of the given cube.
+
+    Parameters
+    ----------
+    cube: [string or SEDMCube]
+        cube filename or the (saved) cube itself. The given cube is not modified.
+
+    date: [string] -optional-
+        date in usual YYYYMMDD format (used to fetch the nearest calibration)
+
+    calibration_ref: [None/string] -optional-
+        filename of the spectrum containing the inverse-sensitivity.
+        If None, the nearest fluxcal of the night is used.
+
+    asyncwrite: [bool/AsyncWriter] -optional-
+        Shall the calibrated cube be written by the background writer 
+        (see chaining.get_writer() and build_sedmcube)?
+
+    Returns
+    -------
+    SEDMCube (the calibrated cube, None if no calibration is available)
+    """
+    if type(cube) is str:
+        cubefile, cube = cube, None
+    else:
+        cubefile = cube.filename
         
-def build_calibrated_sedmcube(cubefile, date=None, calibration_ref=None, kindout=None):
-    """ """
-    
     if calibration_ref is None:
         from .io import fetch_nearest_fluxcal
         try:
@@ -275,16 +359,47 @@ def build_calibrated_sedmcube(cubefile, date=None, calibration_ref=None, kindout
         if kindout is None: kindout="cal"
         
     # - Inverse Sensitivity
-    spec = Spectrum(calibration_ref)
-    # - Load it
-    cube = get_sedmcube(cubefile)
+    spec = get_calibration_spectrum(calibration_ref)
+    # - Load it (or copy it, the given cube may still be being written)
+    cube = get_sedmcube(cubefile) if cube is None else cube.copy()
     # - Do it
     cube.scale_by(1./spec.data)
     cube.header['SOURCE']  = (cubefile.split('/')[-1] , "the original cube")
     cube.header['FCALSRC'] = (calibration_ref.split('/')[-1], "the calibration source reference")
     cube.header['PYSEDMT'] = ("Flux Calibrated Cube")
     # - Save it
-    cube.writeto(cubefile.replace("%s"%PROD_CUBEROOT,"%s_%s"%(PROD_CUBEROOT,kindout)))
+    fileout = cubefile.replace("%s"%PROD_CUBEROOT,"%s_%s"%(PROD_CUBEROOT,kindout))
+    cube._side_properties["filename"] = fileout
+    _writeto_(cube, fileout, asyncwrite=asyncwrite)
+    return cube
+
+def get_calibration_spectrum(filename):
+    """ Load the inverse-sensitivity spectrum. 
+    It is only read once per process (as long as the file is unchanged).
+
+    Returns
+    -------
+    Spectrum
+    """
+    import os
+    return _load_calibration_spectrum_(filename, os.path.getmtime(filename))
+
+@functools.lru_cache(maxsize=8)
+def _load_calibration_spectrum_(filename, mtime):
+    """ cached by filename and modification time """
+    return Spectrum(filename)
+
+def _writeto_(product, savefile, asyncwrite=False):
+    """ product.writeto(savefile), by the background writer if asyncwrite
+    (asyncwrite can be the AsyncWriter to use, the process one otherwise) """
+    if asyncwrite is not False and asyncwrite is not None:
+        from .utils.chaining import get_writer, AsyncWriter
+        # - cast in this thread: the product must not change once submitted
+        if isinstance(product, SEDMCube):
+            product._cast_to_precision_()
+        (asyncwrite if isinstance(asyncwrite, AsyncWriter) else get_writer()).submit(product, savefile)
+    else:
+        product.writeto(savefile)
     
 # ------------------ #
 #  Main Functions    #
@@ -459,7 +574,198 @@ def display_on_hexagrid(value, traceindexes,
 #################################
 class SEDMCube( Cube ):
     """ SEDM Cube """
-    DERIVED_PROPERTIES = ["sky"]
+    DERIVED_PROPERTIES = ["sky", "cumulative_sums"]
+
+    # ------------------- #
+    #  Wavelength Slices  #
+    # ------------------- #
+    def get_slice(self, lbda_min=None, lbda_max=None, index=None,
+                      usemean=True, data="data", slice_object=False,
+                      fractional=False, **kwargs):
+        """ Returns a array containing the [weighted] average for the
+        spaxels within the given range.
+
+        Wavelength ranges are measured using the cumulative sums of the
+        cube along wavelength (see get_slices()), other cases (index, **kwargs)
+        are passed to pyifu's Cube.get_slice().
+
+        Parameters
+        ----------
+        lbda_min, lbda_max: [None or float] -optional-
+            lower and higher boundaries of the wavelength (in Angstrom) defining the slice.
+            None means no limit.
+
+        index: [int] -optional-
+            Index of the cube slice you want.
+
+        usemean: [bool] -optional-
+            If the cube has a variance, the slice will be the weighted mean (weighted by
+            inverse of variance) except if 'usemean' is set to True.
+
+        data: [string] -optional-
+            Variable that will be used.
+
+        slice_object: [bool] -optional-
+            Shall this returns a Slice object or jsut the corresponding data?
+
+        fractional: [bool] -optional-
+            see get_slices()
+
+        Returns
+        -------
+        array of float (or Slice)
+        """
+        if index is not None or len(kwargs)>0:
+            return super(SEDMCube, self).get_slice(lbda_min=lbda_min, lbda_max=lbda_max, index=index,
+                                                   usemean=usemean, data=data,
+                                                   slice_object=slice_object, **kwargs)
+
+        return self.get_slices([[lbda_min, lbda_max]], usemean=usemean, data=data,
+                                slice_object=slice_object, fractional=fractional)[0]
+
+    def get_slices(self, lbda_ranges, usemean=True, data="data",
+                       slice_object=False, fractional=False):
+        """ [weighted] average of the spaxels within many wavelength ranges at once.
+
+        This uses the cumulative sums of `data` (and variance) along wavelength,
+        that are computed once and kept as long as data and variance are unchanged,
+        such that each range only costs a difference of two cumulative sums.
+        NaN values are ignored.
+        After an in-place change of data or variance, call _reset_cumulative_sums_().
+
+        Parameters
+        ----------
+        lbda_ranges: [list of [float/None, float/None]]
+            lower and higher boundaries of the wavelength (in Angstrom) of each range.
+            None means no limit.
+
+        usemean: [bool] -optional-
+            If the cube has a variance, the slices will be the weighted mean (weighted by
+            inverse of variance) except if 'usemean' is set to True.
+
+        data: [string] -optional-
+            Variable that will be used.
+            If `data` does not contain 'data' in its name usemean will be forced to True.
+
+        slice_object: [bool] -optional-
+            Shall this returns Slice objects or jsut the corresponding data?
+
+        fractional: [bool] -optional-
+            If False, the wavelength bins entering the range are those having
+            lbda_min <= lbda <= lbda_max (as pyifu's Cube.get_slice).
+            If True, every wavelength bin spreads between the middle of its neighbours
+            and the bins partially within the range are accounted for the fraction
+            they cover (interpolation of the cumulative sums).
+
+        Returns
+        -------
+        2d-array (len(lbda_ranges), nspaxels) (or list of Slices)
+        """
+        lbda = np.asarray(self.lbda)
+        lbda_ranges = np.asarray([[lbda[0]  if l_[0] is None else l_[0],
+                                   lbda[-1] if l_[1] is None else l_[1]] for l_ in lbda_ranges], dtype="float")
+        lbda_ranges = np.sort(lbda_ranges, axis=1)
+        if 'data' not in data or not self.has_variance():
+            usemean = True
+        sums = self._get_cumulative_sums_(data, weighted=not usemean)
+
+        # - Position of the boundaries in the cumulative sums
+        if fractional:
+            edges  = np.concatenate([[1.5*lbda[0]-0.5*lbda[1]], (lbda[1:]+lbda[:-1])/2., [1.5*lbda[-1]-0.5*lbda[-2]]])
+            bounds = np.interp(lbda_ranges, edges, np.arange(len(edges)))
+        else:
+            bounds = np.asarray([np.searchsorted(lbda, lbda_ranges[:,0], side="left"),
+                                 np.searchsorted(lbda, lbda_ranges[:,1], side="right")], dtype="float").T
+
+        def _band_sum_(cumsum):
+            """ cumsum(upper bound) - cumsum(lower bound) with linear interpolation """
+            i0    = np.clip(np.floor(bounds).astype("int"), 0, len(cumsum)-2)
+            frac  = (bounds-i0)[:,:,None]
+            value = cumsum[i0] + frac*(cumsum[i0+1]-cumsum[i0])
+            return value[:,1]-value[:,0]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if usemean:
+                slice_data = _band_sum_(sums["sum"])/_band_sum_(sums["count"])
+            else:
+                slice_data = _band_sum_(sums["wdsum"])/_band_sum_(sums["wsum"])
+            slice_var = _band_sum_(sums["varsum"])/_band_sum_(sums["varcount"]) \
+              if "varsum" in sums else [None]*len(lbda_ranges)
+            slice_lbda = _band_sum_(np.concatenate([[0], np.cumsum(lbda)])[:,None])[:,0]/(bounds[:,1]-bounds[:,0])
+
+        if not slice_object:
+            return slice_data
+
+        from pyifu.spectroscopy import get_slice
+        xy = self.index_to_xy(self.indexes)
+        return [get_slice(data_, xy, spaxel_vertices=self.spaxel_vertices, variance=var_,
+                          indexes=self.indexes, lbda=lbda_)
+                for data_, var_, lbda_ in zip(slice_data, slice_var, slice_lbda)]
+
+    def _get_cumulative_sums_(self, data="data", weighted=False):
+        """ Cumulative sums along wavelength (starting with 0) of the finite values:
+        - sum, count: of `data`
+        - varsum, varcount: of the variance (if `data` contains 'data' and has a variance)
+        - wsum, wdsum: of the 1/variance weights and of data/variance (if weighted)
+
+        They are kept until `data` or the variance change: the cache is reset by
+        set_data, scale_by and remove_flux, and it only stores the id and shape
+        of the arrays it was computed on (not the arrays themselves, that can be freed).
+        In-place changes of the arrays (e.g. cube.data[i] *= 2) cannot be seen:
+        call _reset_cumulative_sums_() after them.
+        """
+        dataref = getattr(self, data)
+        varref  = self.variance if ('data' in data and self.has_variance()) else None
+        key     = (data, weighted)
+        arrayid = tuple((id(a_), np.shape(a_)) if a_ is not None else None for a_ in [dataref, varref])
+        if self._derived_properties["cumulative_sums"] is None:
+            self._derived_properties["cumulative_sums"] = {}
+
+        cached = self._derived_properties["cumulative_sums"].get(key, None)
+        if cached is not None and cached[0] == arrayid:
+            return cached[1]
+
+        def _cumsum_(array_):
+            return np.concatenate([np.zeros((1,)+np.shape(array_)[1:]), np.cumsum(array_, axis=0)])
+
+        values = np.asarray(dataref)
+        finite = np.isfinite(values)
+        sums   = {"sum":   _cumsum_(np.where(finite, values, 0).astype("float64")),
+                  "count": _cumsum_(finite.astype("float64"))}
+        if varref is not None:
+            variance  = np.asarray(varref)
+            finitevar = np.isfinite(variance)
+            sums["varsum"]   = _cumsum_(np.where(finitevar, variance, 0).astype("float64"))
+            sums["varcount"] = _cumsum_(finitevar.astype("float64"))
+            if weighted:
+                flagw = finite * finitevar * (variance>0)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    weights = np.where(flagw, 1./variance, 0).astype("float64")
+                sums["wsum"]  = _cumsum_(weights)
+                sums["wdsum"] = _cumsum_(np.where(flagw, values, 0)*weights)
+
+        self._derived_properties["cumulative_sums"][key] = [arrayid, sums]
+        return sums
+
+    def _reset_cumulative_sums_(self):
+        """ drop the cumulative sums (see _get_cumulative_sums_).
+        Needed after in-place changes of the data or variance arrays """
+        self._derived_properties["cumulative_sums"] = None
+
+    def set_data(self, *args, **kwargs):
+        """ pyifu's Cube.set_data, resetting the cumulative sums """
+        self._reset_cumulative_sums_()
+        return super(SEDMCube, self).set_data(*args, **kwargs)
+
+    def scale_by(self, *args, **kwargs):
+        """ pyifu's Cube.scale_by, resetting the cumulative sums """
+        self._reset_cumulative_sums_()
+        return super(SEDMCube, self).scale_by(*args, **kwargs)
+
+    def remove_flux(self, *args, **kwargs):
+        """ pyifu's Cube.remove_flux, resetting the cumulative sums """
+        self._reset_cumulative_sums_()
+        return super(SEDMCube, self).remove_flux(*args, **kwargs)
 
     def get_aperture_spec(self, xref, yref, radius, bkgd_annulus=None,
                               refindex=None, adr=True, **kwargs):
@@ -537,10 +843,14 @@ class SEDMCube( Cube ):
         if self.adr is None or refindex is not None:
             if refindex is None:
                 refindex = np.argmin(np.abs(self.lbda-DEFAULT_REFLBDA))
-            self.load_adr(lbdaref=self.lbda[refindex])
+            # - only reloaded if the reference wavelength changes
+            if self.adr is None or self.adr.lbdaref != self.lbda[refindex]:
+                self.load_adr(lbdaref=self.lbda[refindex])
 
-        x_default, y_default = self.adr.refract(0, 0, lbda, unit=IFU_SCALE_UNIT)
+        x_default, y_default = get_adr_trajectory(self.adr, lbda, unit=IFU_SCALE_UNIT)
         x, y = np.dot(MLA_ROTMATRIX,np.asarray([x_default,y_default]))
+        if not is_arraylike(lbda):
+            x, y = x[0], y[0]
         
         return x+xref, y+yref
     
@@ -621,6 +931,24 @@ class SEDMCube( Cube ):
                                           usemean=usemean, data=estimate_from)
         self.remove_flux( self._sky.data)
 
+    def writeto(self, savefile, *args, **kwargs):
+        """ Save the cube with data and variance in the pipeline precision
+        (see utils.tools.set_precision). *args and **kwargs go to pyifu's Cube.writeto
+
+        The arrays are cast in place, if needed (see _cast_to_precision_).
+        Cubes handed to the background writer are cast before (see sedm._writeto_),
+        such that the writer thread does not modify them.
+        """
+        self._cast_to_precision_()
+        return super(SEDMCube, self).writeto(savefile, *args, **kwargs)
+
+    def _cast_to_precision_(self):
+        """ data and variance arrays in the pipeline precision (only replaced if their dtype differs) """
+        dtype = get_dtype()
+        for props_, key in [(self._properties, "rawdata"), (self._properties, "rawvariance"),
+                            (self._derived_properties, "data"), (self._derived_properties, "variance")]:
+            if props_.get(key, None) is not None and np.asarray(props_[key]).dtype != dtype:
+                props_[key] = np.asarray(props_[key], dtype=dtype)
 
     # - Improved version allowing to add CCD
     def show(self, toshow="data",
@@ -5,28 +5,22 @@
 
 import warnings
 import numpy as np
-import matplotlib.pyplot as mpl
+from importlib.util import find_spec
 from scipy import sparse
-from astropy.utils.console import ProgressBar
 
 from propobject import BaseObject
 from .ccd import get_dome, ScienceCCD
-from .utils.tools import kwargs_update, is_arraylike
+from .utils.tools import kwargs_update, is_arraylike, get_dtype
 
 from .sedm import SEDM_CCD_SIZE
-try:
-    from shapely import vectorized, geometry
-    _HAS_SHAPELY = True
-except:
+# shapely and skimage are slow to import: they are imported when first used.
+_HAS_SHAPELY = find_spec("shapely") is not None
+if not _HAS_SHAPELY:
     warnings.warn("You do not have Shapely. trace masking will be slower.")
-    _HAS_SHAPELY = False
-    
-try:
-    from skimage import measure
-    _HAS_SKIMAGE = True
-except ImportError:
+
+_HAS_SKIMAGE = find_spec("skimage") is not None
+if not _HAS_SKIMAGE:
     warnings.warn("skimage is not available. Tracing wont use subpixelisation. Moire pattern to be expected.")
-    _HAS_SKIMAGE = False
     
 # ------------------------------- #
 #   Attribute SEDM specific       #
@@ -36,8 +30,8 @@ PURE_DOME_ELLIPSE_SCALING = dict(scaleup_red=2.5,  scaleup_blue=9, fixed_pixel_l
 # ------------------------------- #
 #   PIL Masking tricks            #
 # ------------------------------- #
-EDGES_COLOR  = mpl.cm.binary(0.99,0.5, bytes=True)
-SPECTID_CMAP = mpl.cm.viridis
+EDGES_COLOR  = (1, 1, 1, 127) # mpl.cm.binary(0.99,0.5, bytes=True)
+SPECTID_CMAP = "viridis"
 BACKCOLOR    = (0,0,0,0)
 ZOOMING      = 5 if _HAS_SKIMAGE else 1
 _BASEPIX     = np.asarray([[0,0],[0,1],[1,1],[1,0]])
@@ -105,8 +99,10 @@ def polygon_mask(vertices, width=2048, height=2048,
         vertices = [vertices]
         
     if facecolor is None:
+        from matplotlib import cm
         npoly = len(vertices)
-        facecolor = SPECTID_CMAP(np.linspace(0,1,len(vertices)), bytes=True)
+        cmap  = getattr(cm, SPECTID_CMAP) if type(SPECTID_CMAP) is str else SPECTID_CMAP
+        facecolor = cmap(np.linspace(0,1,len(vertices)), bytes=True)
         
     if edgecolor is None or np.shape(edgecolor) != np.shape(facecolor):
         edgecolor = [EDGES_COLOR]*len(vertices)
@@ -126,6 +122,7 @@ def illustrate_traces(ccdimage, spectralmatch,
                       cmap=None, vmin=None, vmax=None,
                       **kwargs):
     """ """
+    import matplotlib.pyplot as mpl
     from .utils.mpl import figout
     from mpl_toolkits.axes_grid1.inset_locator import zoomed_inset_axes
     from mpl_toolkits.axes_grid1.inset_locator import mark_inset
@@ -201,11 +198,70 @@ def get_boxing_polygone(x, y, rangex, width,
     if get_vertices:
         return vertices
     
+    from shapely import geometry
     return  geometry.Polygon(vertices)
 
 # ------------------------- # 
 #   MultiProcessing Tracing #
 # ------------------------- #
+def points_in_polygons(x, y, vertices):
+    """ Vectorized (ray casting) test of whether the point (x[k], y[k]) 
+    is inside the polygon vertices[k].
+
+    Parameters
+    ----------
+    x, y: [array, array]
+        coordinates of the n points
+
+    vertices: [3d-array]
+        (n, nvertices, 2) polygon vertices. Polygons with less vertices
+        can be padded by repeating their last vertex.
+
+    Returns
+    -------
+    boolean array
+    """
+    xv, yv   = vertices[:,:,0], vertices[:,:,1]
+    xv1, yv1 = np.roll(xv, -1, axis=1), np.roll(yv, -1, axis=1)
+    px, py   = np.asarray(x)[:,None], np.asarray(y)[:,None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        xcross = xv + (py-yv)*(xv1-xv)/(yv1-yv)
+    crossing = ((yv > py) != (yv1 > py)) & (px < xcross)
+    return np.sum(crossing, axis=1) % 2 == 1
+
+def get_verts_bounds(verts):
+    """ [xmin, xmax], [ymin, ymax] pixel bounds of the box containing the given vertices (see verts_to_boxmask) """
+    verts = np.asarray(verts)+np.asarray([0.5,0.5])
+    return np.asarray(np.round(np.percentile(verts, [0,100], axis=0)), dtype="int").T + np.asarray([-1,1])
+
+def verts_to_boxmask(verts):
+    """ Weighted mask of the given vertices within their bounding box (see verts_to_mask)
+
+    = Based on Shapely = 
+
+    Returns
+    -------
+    xlim, ylim, [ylim[1]-ylim[0] x xlim[1]-xlim[0]] array
+    """
+    from shapely import vectorized, geometry
+    xlim, ylim = get_verts_bounds(verts)
+    polytrace  = geometry.Polygon(verts+np.asarray([0.5,0.5]))
+        
+    sqgrid     = np.asarray([[_BASEPIX + np.asarray([x_,y_])
+                                  for y_ in np.arange(*ylim)] for x_ in np.arange(*xlim)]
+                                ).reshape((ylim[1]-ylim[0]) * (xlim[1]-xlim[0]),*np.shape(_BASEPIX))
+    
+    maskins = vectorized.contains(polytrace, *sqgrid.T).T
+    boxmask = np.asarray([  0 if not np.any(maskin_) else 1 if np.all(maskin_) else polytrace.intersection(geometry.Polygon(sq_)).area
+                for maskin_,sq_ in zip(maskins,sqgrid)]).reshape(xlim[1]-xlim[0],ylim[1]-ylim[0])
+    return xlim, ylim, boxmask.T
+
+def boxmask_to_sparse(xlim, ylim, boxmask, shape=SEDM_CCD_SIZE):
+    """ sparse (csr) version of the verts_to_mask from the output of verts_to_boxmask """
+    rows, cols = np.meshgrid(np.arange(*ylim), np.arange(*xlim), indexing="ij")
+    flagok = (boxmask != 0) & (rows>=0) & (rows<shape[0]) & (cols>=0) & (cols<shape[1])
+    return sparse.csr_matrix((boxmask[flagok], (rows[flagok], cols[flagok])), shape=shape)
+
 def verts_to_mask(verts):
     """ Based on the given vertices (and using the CCD size from semd.SEDM_CCD_SIZE)
     this create a weighted mask:
@@ -220,45 +276,235 @@ def verts_to_mask(verts):
     -------
     [NxM] array (size of semd.SEDM_CCD_SIZE)
     """
-    from shapely.vectorized import contains
-    verts = verts+np.asarray([0.5,0.5])
-    
-    xlim, ylim = np.asarray(np.round(np.percentile(verts, [0,100], axis=0)), dtype="int").T + np.asarray([-1,1])
-    polytrace  = geometry.Polygon(verts)
-        
-    sqgrid     = np.asarray([[_BASEPIX + np.asarray([x_,y_])
-                                  for y_ in np.arange(*ylim)] for x_ in np.arange(*xlim)]
-                                ).reshape((ylim[1]-ylim[0]) * (xlim[1]-xlim[0]),*np.shape(_BASEPIX))
-    
-    maskins = vectorized.contains(polytrace, *sqgrid.T).T
-    
+    xlim, ylim, boxmask = verts_to_boxmask(verts)
     maskfull = np.zeros(SEDM_CCD_SIZE)
-    maskfull[xlim[0]:xlim[1],ylim[0]:ylim[1]] = \
-      (np.asarray([  0 if not np.any(maskin_) else 1 if np.all(maskin_) else polytrace.intersection(geometry.Polygon(sq_)).area
-            for maskin_,sq_ in zip(maskins,sqgrid)]).reshape(xlim[1]-xlim[0],ylim[1]-ylim[0]))
-    return maskfull.T
-    
+    maskfull[ylim[0]:ylim[1],xlim[0]:xlim[1]] = boxmask
+    return maskfull
+
+def polygons_to_mask(vertices, shape=SEDM_CCD_SIZE):
+    """ Boolean mask at the native CCD resolution that is True for the pixels
+    touched by any of the given polygons.
+    (a pixel is touched if one of its corners, its center or a polygon vertex is inside)
+
+    Parameters
+    ----------
+    vertices: [list of 2d-arrays]
+        (nvertices, 2) x, y vertices of each polygon.
+
+    shape: [int, int] -optional-
+        (ny, nx) shape of the mask.
+
+    Returns
+    -------
+    [ny x nx] boolean array
+    """
+    ny, nx = shape
+    mask = np.zeros(shape, dtype="bool")
+    for verts in vertices:
+        verts = np.asarray(verts, dtype="float")
+        (xmin, ymin), (xmax, ymax) = np.clip(np.asarray(np.round(np.percentile(verts, [0,100], axis=0)),
+                                                            dtype="int"), 0, [nx-1, ny-1])
+        if xmax < xmin or ymax < ymin:
+            continue
+        # - pixel corners and centers of the bounding box (pixel i spans [i-0.5, i+0.5])
+        xcorner, ycorner = np.meshgrid(np.arange(xmin, xmax+2)-0.5, np.arange(ymin, ymax+2)-0.5)
+        xcenter, ycenter = np.meshgrid(np.arange(xmin, xmax+1), np.arange(ymin, ymax+1))
+        x_, y_ = np.concatenate([xcorner.ravel(), xcenter.ravel()]), np.concatenate([ycorner.ravel(), ycenter.ravel()])
+        inside = points_in_polygons(x_, y_, np.broadcast_to(verts, (len(x_),)+verts.shape))
+        incorner, incenter = inside[:xcorner.size].reshape(xcorner.shape), inside[xcorner.size:].reshape(xcenter.shape)
+        mask[ymin:ymax+1, xmin:xmax+1] |= incenter | incorner[:-1,:-1] | incorner[1:,:-1] | incorner[:-1,1:] | incorner[1:,1:]
+        # - pixels containing vertices
+        xv, yv = np.asarray(np.round(verts), dtype="int").T
+        inccd = (xv>=0) & (xv<nx) & (yv>=0) & (yv<ny)
+        mask[yv[inccd], xv[inccd]] = True
+
+    return mask
+
+
+def _load_shared_trace_mask_(task, shared):
+    """ executor task: writes the verts_to_boxmask weights of the given vertices
+    in the "boxmasks" shared buffer, starting at the given offset.
+    task: (vertices, offset) """
+    verts, offset = task
+    boxmask = verts_to_boxmask(verts)[2]
+    shared["boxmasks"][offset:offset+boxmask.size] = boxmask.ravel()
 
 def load_trace_masks(tmatch, traceindexes=None, multiprocess=True,
                          notebook=True, ncore=None):
-    """ """
+    """ Measure (verts_to_mask) and attach to the tracematch the masks of the given traces.
+    This uses the pipeline executor (see utils.executor); ncore is the number of workers.
+    The workers write the weights within the bounding box of each trace in a shared
+    buffer (no full ccd-size mask is sent back) that is converted into sparse masks. """
+    from .utils.executor import get_executor
     if traceindexes is None:
         traceindexes = tmatch.trace_indexes
+
+    vertices = [np.asarray(tmatch.trace_vertices[i_]) for i_ in traceindexes]
+    bounds   = [get_verts_bounds(v_) for v_ in vertices]
+    sizes    = [(xlim[1]-xlim[0])*(ylim[1]-ylim[0]) for xlim, ylim in bounds]
+    offsets  = np.concatenate([[0], np.cumsum(sizes)])
+    with get_executor(backend=None if multiprocess else "serial", nworkers=ncore) as executor:
+        boxmasks = executor.allocate("boxmasks", offsets[-1])
+        _ = executor.map(_load_shared_trace_mask_, list(zip(vertices, offsets[:-1])),
+                         progress=True, notebook=notebook)
+
+    for traceindex, (xlim, ylim), offset, size in zip(traceindexes, bounds, offsets, sizes):
+        tmatch.set_trace_masks(boxmask_to_sparse(xlim, ylim, boxmasks[offset:offset+size].reshape(ylim[1]-ylim[0],
+                                                                                                 xlim[1]-xlim[0])),
+                               traceindex)
+
+# ------------------------- # 
+#   Image Registration      #
+# ------------------------- #
+def measure_image_shift(image, reference, max_shift=10, apodization=1.):
+    """ (i, j) shift of the image features with respect to the reference ones,
+    i.e. image(x+di, y+dj) ~ reference(x, y), measured by (FFT) cross-correlation.
+
+    Parameters
+    ----------
+    image, reference: [2D arrays]
+        images with the same shape (NaN are ignored)
+
+    max_shift: [int] -optional-
+        largest shift [in pixels] searched along each axis.
+        (traces form a periodic pattern: this should be smaller than the trace spacing)
+
+    apodization: [float] -optional-
+        fraction of the image tapered on its edges (Tukey window, 1 is a Hann window).
+        Features cut by the image edges (e.g. traces crossing a tile border) do not move
+        with the shift and would otherwise bias it towards 0. The cross-correlation is
+        divided by the window autocorrelation, which otherwise biases it the same way.
+
+    Returns
+    -------
+    di, dj, peak (normalized cross-correlation at the best shift)
+    """
+    from scipy.signal.windows import tukey
+    window = np.outer(tukey(np.shape(image)[0], apodization), tukey(np.shape(image)[1], apodization))
+    images = []
+    for im_ in [image, reference]:
+        im_ = np.asarray(im_, dtype="float")
+        im_ = np.nan_to_num(im_ - np.nanmean(im_))*window
+        images.append(np.pad(im_, ((0,max_shift),(0,max_shift)))) # no circular correlation
+    a, b  = images
+    norm  = np.sqrt(np.sum(a**2)*np.sum(b**2))
+    shifts = np.arange(-max_shift, max_shift+1)
+    def _xcorr_(a_, b_):
+        """ cross-correlation at the searched shifts """
+        corr_ = np.fft.irfft2(np.fft.rfft2(a_) * np.conj(np.fft.rfft2(b_)), s=a_.shape)
+        return corr_[np.ix_(shifts % a_.shape[0], shifts % a_.shape[1])]
     
-    if multiprocess:
-        import multiprocessing
-        bar = ProgressBar( len(traceindexes), ipython_widget=notebook)
-        if ncore is None:
-            ncore = np.max([multiprocessing.cpu_count() - 0,1])
-                
-        p = multiprocessing.Pool(ncore)
-        for j, mask in enumerate( p.imap(verts_to_mask, [tmatch.trace_vertices[i_] for i_ in traceindexes])):
-            tmatch.set_trace_masks(sparse.csr_matrix(mask), traceindexes[j])
-            bar.update(j)
-        bar.update( len(traceindexes) )
-        
+    rawcorr = _xcorr_(a, b)
+    wcorr   = _xcorr_(*[np.pad(window, ((0,max_shift),(0,max_shift)))]*2)
+    corr    = rawcorr / wcorr
+    kj, ki = np.unravel_index(np.argmax(corr), corr.shape)
+
+    def _subpixel_(cm, c0, cp):
+        """ parabola vertex """
+        denom = cm - 2*c0 + cp
+        return 0 if denom == 0 else 0.5*(cm - cp)/denom
+    
+    dj = shifts[kj] + (_subpixel_(*corr[kj-1:kj+2, ki]) if 0<kj<len(shifts)-1 else 0)
+    di = shifts[ki] + (_subpixel_(*corr[kj, ki-1:ki+2]) if 0<ki<len(shifts)-1 else 0)
+    return di, dj, rawcorr[kj, ki]/norm if norm>0 else np.nan
+
+def register_images(image, reference, max_shift=10, ntiles=4, fit_rotation=False, min_peak=0.2):
+    """ Global registration of the image on the reference.
+
+    The (i, j) shift is measured on the full images and on ntiles x ntiles tiles
+    (see measure_image_shift). The tile shifts are then either compared to the global shift
+    (fit_rotation=False) or fitted by a translation + rotation + scale transformation
+    about the image center:
+        x_image = center + scale * R(rotation) (x_reference - center) + [i_offset, j_offset]
+
+    Parameters
+    ----------
+    image, reference: [2D arrays]
+        images with the same shape
+
+    max_shift: [int] -optional-
+        largest shift [in pixels] searched along each axis.
+
+    ntiles: [int] -optional-
+        number of tiles along each axis.
+
+    fit_rotation: [bool] -optional-
+        Shall a (small) rotation and scale be fitted in addition to the shift?
+
+    min_peak: [float] -optional-
+        tiles whose normalized cross-correlation peak is lower are ignored (e.g. no trace in the tile)
+
+    Returns
+    -------
+    dict (i_offset, j_offset, rotation [deg], scale, center, residual [rms in pixels], peak, ntiles_used)
+    """
+    image, reference = np.asarray(image), np.asarray(reference)
+    ny, nx = image.shape
+    center = np.asarray([(nx-1)/2., (ny-1)/2.])
+    di, dj, peak = measure_image_shift(image, reference, max_shift=max_shift)
+
+    # - local shifts
+    ybounds, xbounds = np.linspace(0, ny, ntiles+1, dtype="int"), np.linspace(0, nx, ntiles+1, dtype="int")
+    positions, shifts, weights = [], [], []
+    for y0, y1 in zip(ybounds[:-1], ybounds[1:]):
+        for x0, x1 in zip(xbounds[:-1], xbounds[1:]):
+            di_, dj_, peak_ = measure_image_shift(image[y0:y1,x0:x1], reference[y0:y1,x0:x1], max_shift=max_shift)
+            if peak_ >= min_peak:
+                positions.append([(x0+x1-1)/2., (y0+y1-1)/2.])
+                shifts.append([di_, dj_])
+                weights.append(peak_)
+    positions, shifts, weights = np.asarray(positions).reshape(-1,2)-center, np.asarray(shifts).reshape(-1,2), np.asarray(weights)
+
+    registration = {"i_offset": float(di), "j_offset": float(dj), "rotation": 0., "scale": 1.,
+                    "center": center.tolist(), "peak": float(peak), "ntiles_used": len(weights)}
+    if fit_rotation and len(weights) >= 3:
+        # d = t + (M-I) p with M-I = [[a, -b], [b, a]] (small rotation and scale)
+        x, y = positions.T
+        design = np.concatenate([np.asarray([np.ones_like(x), np.zeros_like(x), x, -y]).T,
+                                 np.asarray([np.zeros_like(x), np.ones_like(x), y,  x]).T])
+        sqw    = np.sqrt(np.concatenate([weights, weights]))
+        (ti, tj, a, b) = np.linalg.lstsq(design*sqw[:,None], np.concatenate(shifts.T)*sqw, rcond=None)[0]
+        registration.update({"i_offset": float(ti), "j_offset": float(tj),
+                             "rotation": float(np.degrees(np.arctan2(b, 1+a))), "scale": float(np.hypot(1+a, b))})
+        model = np.asarray([ti + a*x - b*y, tj + b*x + a*y]).T
     else:
-        raise NotImplementedError("Use multiprocess = True (load_trace_masks)")
+        model = np.asarray([di, dj])[None,:]
+
+    registration["residual"] = float(np.sqrt(np.average(np.sum((shifts-model)**2, axis=1), weights=weights))) \
+      if len(weights)>0 else np.inf
+    return registration
+
+def get_registration_shifts(registration, positions):
+    """ (i, j) displacements, at the given (reference) x, y positions, of the registration transformation
+    (see register_images) 
+
+    Returns
+    -------
+    (N, 2) array
+    """
+    center = np.asarray(registration["center"])
+    theta  = np.radians(registration["rotation"])
+    matrix = registration["scale"]*np.asarray([[np.cos(theta), -np.sin(theta)],[np.sin(theta), np.cos(theta)]])
+    positions = np.atleast_2d(positions) - center
+    return np.dot(positions, (matrix - np.eye(2)).T) + np.asarray([registration["i_offset"], registration["j_offset"]])
+
+def shift_sparse_mask(mask, i_offset, j_offset, shape=SEDM_CCD_SIZE):
+    """ Sparse mask moved by the given (i, j) offsets (pixels moved out of the ccd are dropped).
+    Fractional offsets share the mask weights linearly between the two neighboring pixels
+    (as the coverage of a pixel by a trace edge moving within it). """
+    mask   = mask.tocoo()
+    i0, j0 = int(np.floor(i_offset)), int(np.floor(j_offset))
+    rows, cols, data = [], [], []
+    for di, wi in [(0, 1-(i_offset-i0)), (1, i_offset-i0)]:
+        for dj, wj in [(0, 1-(j_offset-j0)), (1, j_offset-j0)]:
+            if wi*wj == 0:
+                continue
+            rows.append(mask.row + j0+dj)
+            cols.append(mask.col + i0+di)
+            data.append((mask.data*(wi*wj)).astype(mask.data.dtype))
+    rows, cols, data = np.concatenate(rows), np.concatenate(cols), np.concatenate(data)
+    flagok = (rows>=0) & (rows<shape[0]) & (cols>=0) & (cols<shape[1])
+    return sparse.csr_matrix((data[flagok], (rows[flagok], cols[flagok])), shape=shape)
 
 #####################################
 #                                   #
@@ -276,7 +522,8 @@ class TraceMatch( BaseObject ):
     SIDE_PROPERTIES    = ["trace_masks","ij_offset"]
     DERIVED_PROPERTIES = ["tracecolor", "facecolor", "maskimage",
                           "rmap", "gmap", "bmap",
-                          "trace_polygons"]
+                          "trace_polygons", "extraction_matrix", "vertices_array",
+                          "notrace_mask"]
 
     # ===================== #
     #   Main Methods        #
@@ -334,14 +581,50 @@ class TraceMatch( BaseObject ):
         
         if "trace_masks" in data.keys():
             self._side_properties['trace_masks'] = data["trace_masks"]
+            self._derived_properties['extraction_matrix'] = None
             
 
+    def add_trace_transformation(self, i_offset, j_offset, rotation=0, scale=1, center=None):
+        """ Move the traces by the given translation + rotation + scale transformation:
+        new_vertices = center + scale * R(rotation) (vertices - center) + [i_offset, j_offset]
+        (see register_images). The trace masks are reset.
+
+        Parameters
+        ----------
+        i_offset, j_offset: [float]
+            translation [in pixels]
+
+        rotation: [float] -optional-
+            rotation angle [in degree]
+
+        scale: [float] -optional-
+            scale factor
+
+        center: [2-array/None] -optional-
+            center of the rotation and scale. The ccd center if None.
+
+        Returns
+        -------
+        Void
+        """
+        if rotation == 0 and scale == 1:
+            return self.add_trace_offset(i_offset, j_offset)
+        
+        registration = {"i_offset": i_offset, "j_offset": j_offset, "rotation": rotation, "scale": scale,
+                        "center": (np.asarray(SEDM_CCD_SIZE[::-1])-1)/2. if center is None else center}
+        new_verts = {i:v + get_registration_shifts(registration, v) for i,v in self.trace_vertices.items()}
+        self._side_properties['ij_offset'] = np.asarray([i_offset, j_offset])
+        self.set_trace_vertices(new_verts)
+        self._side_properties['trace_masks'] = None
+        self._derived_properties['extraction_matrix'] = None
+        
     def add_trace_offset(self, i_offset, j_offset):
         """ """
         new_verts = {i:v + np.asarray([i_offset, j_offset]) for i,v in self.trace_vertices.items()}
         self._side_properties['ij_offset'] = np.asarray([i_offset, j_offset])
         self.set_trace_vertices(new_verts)
         self._side_properties['trace_masks'] = None
+        self._derived_properties['extraction_matrix'] = None
         
     # --------- #
     #  SETTER   #
@@ -356,22 +639,26 @@ class TraceMatch( BaseObject ):
             self._properties["trace_vertices"] = {i:np.asarray(v) for i,v in zip(traceindexes, vertices)}
         else:
             self._properties["trace_vertices"] = vertices
+        self._derived_properties["vertices_array"] = None
+        self._derived_properties["notrace_mask"] = None
             
         if _HAS_SHAPELY:
+            from shapely import geometry
             self._derived_properties["trace_polygons"] = {i:geometry.Polygon(self.trace_vertices[i]) for i in self.trace_indexes}
             
         if build_masking:
             self.build_tracemasking(**kwargs)
 
     def set_trace_masks(self, masks, traceindexes):
-        """ Attach to the current instance masks. """
+        """ Attach to the current instance masks (stored in the pipeline precision, see utils.tools.get_dtype) """
         if is_arraylike(traceindexes):
             if len(masks) != len(traceindexes):
                 raise ValueError("masks and traceindexes do not have the same size.")
             for i,v in zip(traceindexes, masks):
-                self.trace_masks[i] = v
+                self.trace_masks[i] = v.astype(get_dtype(), copy=False)
         else:
-            self.trace_masks[traceindexes] = masks
+            self.trace_masks[traceindexes] = masks.astype(get_dtype(), copy=False)
+        self._derived_properties['extraction_matrix'] = None
 
     # --------- #
     #  GETTER   #
@@ -394,11 +681,13 @@ class TraceMatch( BaseObject ):
         -------
         list of indexes
         """
+        from shapely import geometry
         line = geometry.LineString([[xpixel,ymin],[xpixel,ymax]])
         mpoly = geometry.MultiPolygon([self.trace_polygons[i_]
                             for i_ in self.get_traces_crossing_x(xpixel, ymin=ymin, ymax=ymax) ])
         
-        return np.asarray([m.intersection(line).xy[1]for m in mpoly])
+        # - shapely>=2 multi-geometries are not iterable, their parts are in .geoms
+        return np.asarray([m.intersection(line).xy[1] for m in getattr(mpoly, "geoms", mpoly)])
             
         
     def get_traces_crossing_y(self, ypixel, xmin=-1, xmax=1e5):
@@ -421,6 +710,7 @@ class TraceMatch( BaseObject ):
         -------
         list of indexes
         """
+        from shapely import geometry
         line = geometry.LineString([pointa,pointb])
         return [idx for idx in self.trace_indexes if self.trace_polygons[idx].crosses(line)]
 
@@ -535,12 +825,64 @@ class TraceMatch( BaseObject ):
             
         return mask
 
+    def get_extraction_matrix(self, traceindexes=None):
+        """ Sparse matrix converting a flatten CCD image into the spectra
+        of the given traces (all at once).
+
+        Row `k*ncolumns + i` contains the weights of the `i`-th column of
+        the `k`-th trace such that:
+        `(matrix * ccddata.ravel()).reshape(len(traceindexes), ncolumns)`
+        is equivalent to stacking `np.sum(ccddata*get_trace_mask(k), axis=0)`.
+
+        The matrix is cached and reused as long as the same traceindexes
+        are requested and the trace masks are unchanged.
+
+        Parameters
+        ----------
+        traceindexes: [list of int] -optional-
+            Traces to extract. If None, all the trace_indexes are used.
+            (Missing trace masks are built and stored on the fly.)
+
+        Returns
+        -------
+        scipy.sparse.csr_matrix
+        """
+        if traceindexes is None:
+            traceindexes = self.trace_indexes
+        key = tuple(traceindexes)
+        
+        cached = self._derived_properties["extraction_matrix"]
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        
+        rows, cols, weights = [], [], []
+        for k, idx in enumerate(traceindexes):
+            if idx not in self.trace_masks:
+                self.get_trace_mask(idx, update=True, updateonly=True)
+            mask = self.trace_masks[idx].tocoo()
+            nrows, ncols = mask.shape
+            rows.append(k*ncols + mask.col)
+            cols.append(mask.row*ncols + mask.col)
+            weights.append(mask.data)
+
+        if len(weights) == 0:
+            raise ValueError("No traceindexes given, cannot build an extraction matrix")
+        
+        matrix = sparse.csr_matrix((np.asarray(np.concatenate(weights), dtype=get_dtype()),
+                                        (np.concatenate(rows), np.concatenate(cols))),
+                                    shape=(len(key)*ncols, nrows*ncols))
+        # set_trace_masks may have reset the cache while building missing masks
+        self._derived_properties["extraction_matrix"] = [key, matrix]
+        return matrix
+        
     def _get_color_trace_mask_(self, traceindex):
         """ Use the tracebuild colors trick
         = Time depends on the subpixelization, 5 takes about 1s =
         """
         r, g, b, a = self._tracecolor[traceindex]
         mask = ((self._rmap==r)*(self._gmap==g)*(self._bmap==b)).reshape(*self._mapshape)
+        if self.subpixelization != 1:
+            from skimage import measure
         final_mask = mask if self.subpixelization == 1 else \
               measure.block_reduce(mask, (self.subpixelization, self.subpixelization) )/float(self.subpixelization**2)
               
@@ -554,12 +896,34 @@ class TraceMatch( BaseObject ):
         """ """
         _ = self.get_trace_mask(traceindexe, updateonly=True)
     
-    def get_notrace_mask(self):
-        """ a 2D boolean mask that is True for places in the CCD without trace. """
-        if self._maskimage is None:
-            self.build_tracemasking(5)
+    def get_notrace_mask(self, subpixelization=None):
+        """ a 2D boolean mask that is True for places in the CCD without trace.
+
+        Parameters
+        ----------
+        subpixelization: [int/None] -optional-
+            If None, the mask is measured at the native CCD resolution (see polygons_to_mask)
+            and cached until the trace vertices change.
+            Otherwise, the (slow) RGBA rasterisation of the traces is used with this subpixelization
+            (see build_tracemasking).
+
+        Returns
+        -------
+        2D boolean array
+        """
+        if subpixelization is None:
+            if self._derived_properties["notrace_mask"] is None:
+                mask = ~polygons_to_mask([self.trace_vertices[i] for i in self.trace_indexes])
+                mask.flags.writeable = False
+                self._derived_properties["notrace_mask"] = mask
+            return self._derived_properties["notrace_mask"]
+        
+        if self._maskimage is None or self.subpixelization != subpixelization:
+            self.build_tracemasking(subpixelization)
             
         mask = (self._rmap > 0 ).reshape(*self._mapshape)
+        if self.subpixelization != 1:
+            from skimage import measure
         final_mask =  mask if self.subpixelization == 1 else \
           measure.block_reduce(mask, (self.subpixelization, self.subpixelization) )/float(self.subpixelization**2)
 
@@ -619,6 +983,7 @@ class TraceMatch( BaseObject ):
         list of trace indexes
         """
         if _HAS_SHAPELY:
+            from shapely import geometry
             globalpoly = geometry.Polygon(polyverts)
             return [idx_ for idx_ in self.trace_indexes if globalpoly.contains(geometry.Polygon(self.trace_vertices[idx_]))]
         else:
@@ -627,6 +992,41 @@ class TraceMatch( BaseObject ):
             return [idx_ for idx_ in self.trace_indexes if
                     np.all([globalpoly.contains_point(vtr) for vtr in self.trace_vertices[idx_]])]
 
+    def get_points_traceindex(self, x, y):
+        """ Which trace contains the given (x,y) ccd positions.
+        All the points are assigned at once: traces bounding boxes are used 
+        to select candidate (point, trace) pairs that are then tested
+        using a vectorized point-in-polygon test.
+
+        Parameters
+        ----------
+        x, y: [array, array]
+            ccd coordinates of the points
+
+        Returns
+        -------
+        array (traceindex, -1 if not in any trace). 
+        If a point is in several traces, one of them is returned.
+        """
+        x, y = np.atleast_1d(np.asarray(x, dtype="float")), np.atleast_1d(np.asarray(y, dtype="float"))
+        traceindexes, verts = self._vertices_array
+        xmin, xmax = np.nanmin(verts[:,:,0], axis=1), np.nanmax(verts[:,:,0], axis=1)
+        ymin, ymax = np.nanmin(verts[:,:,1], axis=1), np.nanmax(verts[:,:,1], axis=1)
+        # - Candidates within the trace x-bounds
+        order   = np.argsort(x)
+        lo, hi  = np.searchsorted(x[order], xmin, side="left"), np.searchsorted(x[order], xmax, side="right")
+        counts  = hi - lo
+        tpairs  = np.repeat(np.arange(len(traceindexes)), counts)
+        ppairs  = order[np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts, counts)]
+        # - and y-bounds
+        flagin  = (y[ppairs] >= ymin[tpairs]) & (y[ppairs] <= ymax[tpairs])
+        tpairs, ppairs = tpairs[flagin], ppairs[flagin]
+        # - Actual test
+        inside  = points_in_polygons(x[ppairs], y[ppairs], verts[tpairs])
+        pointtraces = np.full(len(x), -1, dtype="int")
+        pointtraces[ppairs[inside]] = traceindexes[tpairs[inside]]
+        return pointtraces
+        
     # --------- #
     #  PLOTTER  #
     # --------- #
@@ -744,6 +1144,18 @@ class TraceMatch( BaseObject ):
             raise ImportError("You do not have shapely. this porpoerty needs it. pip install Shapely")
         return self._derived_properties["trace_polygons"]
 
+    @property
+    def _vertices_array(self):
+        """ sorted trace indexes and their vertices stacked as a (ntraces, nvertices, 2) array
+        (polygons with less vertices are padded by repeating their last vertex) """
+        if self._derived_properties["vertices_array"] is None:
+            traceindexes = np.sort(self.trace_indexes)
+            verts  = [np.asarray(self.trace_vertices[i], dtype="float") for i in traceindexes]
+            nverts = np.max([len(v) for v in verts])
+            self._derived_properties["vertices_array"] = [traceindexes,
+                    np.asarray([np.concatenate([v, np.repeat(v[-1:], nverts-len(v), axis=0)]) for v in verts])]
+        return self._derived_properties["vertices_array"]
+    
     @property
     def ij_offset(self):
         """ By how much the traces are offseted in comparison to the night_tracematch """
@@ -0,0 +1,214 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" In-memory chaining of the products of an exposure.
+
+The products (e.g. cubes) are handed from one stage to the next in memory,
+while their files are written on a background thread (see get_writer()),
+such that a product is never read back from disk within the same run.
+
+Example
+-------
+```
+from pysedm.utils import chaining
+chain = chaining.ProductChain()
+chain.add_stage(my_stage, name="my_stage", savefig=False) # my_stage(cube, savefig=False)
+build_sedmcube(ccd, date, stages=chain)
+chaining.get_writer().flush() # wait for the files to be written
+
+# files of one call only (e.g. when several threads build cubes)
+writer = chaining.AsyncWriter()
+build_sedmcube(ccd, date, stages=chain, asyncwrite=writer)
+writer.close() # waits for (and raises the errors of) these files only
+```
+"""
+
+import queue
+import atexit
+import threading
+import warnings
+
+from propobject import BaseObject
+
+from .performance import stage
+
+__all__ = ["get_writer", "AsyncWriter", "ProductChain"]
+
+
+def get_writer():
+    """ The background writer of the current process """
+    global _WRITER
+    if _WRITER is None:
+        _WRITER = AsyncWriter()
+        atexit.register(_WRITER.flush, raise_errors=False)
+    return _WRITER
+
+_WRITER = None
+
+
+class AsyncWriter( BaseObject ):
+    """ Writes the products on a background thread, in submission order. """
+    SIDE_PROPERTIES    = ["maxsize"]
+    DERIVED_PROPERTIES = ["queue", "thread", "errors"]
+
+    def __init__(self, maxsize=4):
+        """
+        Parameters
+        ----------
+        maxsize: [int] -optional-
+            Maximum number of products waiting to be written.
+            submit() blocks when reached, such that products do not pile up in memory.
+        """
+        self._side_properties["maxsize"] = maxsize
+
+    # =================== #
+    #   Methods           #
+    # =================== #
+    def submit(self, product, savefile, *args, **kwargs):
+        """ Call product.writeto(savefile, *args, **kwargs) on the writer thread.
+
+        = The product must not be modified afterwards, give a copy to stages that do. =
+
+        Returns
+        -------
+        Void
+        """
+        if self._derived_properties["thread"] is None or not self._derived_properties["thread"].is_alive():
+            self._derived_properties["thread"] = threading.Thread(target=self._run_, name="pysedm-writer")
+            self._derived_properties["thread"].daemon = True
+            self._derived_properties["thread"].start()
+        self.queue.put((product, savefile, args, kwargs))
+
+    def close(self, raise_errors=True):
+        """ flush() and stop the writer thread (it is restarted by the next submit)
+
+        Returns
+        -------
+        list of the savefiles that failed
+        """
+        if self._derived_properties["thread"] is not None and self._derived_properties["thread"].is_alive():
+            self.queue.put(None) # written after every product already submitted
+            self._derived_properties["thread"].join()
+        self._derived_properties["thread"] = None
+        return self.flush(raise_errors=raise_errors)
+
+    def flush(self, raise_errors=True):
+        """ Wait until every submitted product is written.
+
+        Parameters
+        ----------
+        raise_errors: [bool] -optional-
+            Shall an IOError be raised if some products could not be written?
+            (the errors are reset in any case)
+
+        Returns
+        -------
+        list of the savefiles that failed
+        """
+        self.queue.join()
+        failed, self._derived_properties["errors"] = self.errors, []
+        return self._raise_failed_(failed) if raise_errors else [f_ for f_, e_ in failed]
+
+    @staticmethod
+    def _raise_failed_(failed):
+        """ """
+        if len(failed)>0:
+            raise IOError("Failed to write: %s"%", ".join(["%s (%s)"%(f_, e_) for f_, e_ in failed]))
+        return []
+
+    def _run_(self):
+        """ writer thread (stopped by a None item, see close) """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            product, savefile, args, kwargs = item
+            try:
+                product.writeto(savefile, *args, **kwargs)
+            except Exception as err:
+                warnings.warn("Failed to write %s: %s"%(savefile, err))
+                self.errors.append((savefile, err))
+            finally:
+                self.queue.task_done()
+
+    # =================== #
+    #   Properties        #
+    # =================== #
+    @property
+    def maxsize(self):
+        """ maximum number of products waiting to be written """
+        return self._side_properties["maxsize"]
+
+    @property
+    def queue(self):
+        """ products waiting to be written """
+        if self._derived_properties["queue"] is None:
+            self._derived_properties["queue"] = queue.Queue(maxsize=self.maxsize)
+        return self._derived_properties["queue"]
+
+    @property
+    def errors(self):
+        """ list of (savefile, exception) that failed since the last flush """
+        if self._derived_properties["errors"] is None:
+            self._derived_properties["errors"] = []
+        return self._derived_properties["errors"]
+
+
+class ProductChain( BaseObject ):
+    """ Stages applied in memory, one after the other, to a product.
+
+    A stage is a function called as `func(product, **kwargs)`. It returns the
+    product given to the next stage (None means the product is passed on unchanged).
+    Stages must not modify the product in place: it may still be being written.
+    """
+    DERIVED_PROPERTIES = ["stages"]
+
+    def add_stage(self, func, name=None, **kwargs):
+        """ Append a stage to the chain.
+
+        Parameters
+        ----------
+        func: [function]
+            called as func(product, **kwargs)
+
+        name: [string] -optional-
+            name of the stage (for the performance log). func.__name__ if None.
+
+        Returns
+        -------
+        self (such that add_stage calls can be chained)
+        """
+        self.stages.append([func.__name__ if name is None else name, func, kwargs])
+        return self
+
+    def run(self, product, **info):
+        """ Apply the stages to the product.
+
+        **info goes to the performance stage records (e.g. date=)
+
+        Returns
+        -------
+        the product returned by the last stage
+        """
+        for name, func, kwargs in self.stages:
+            with stage(name, **info):
+                output = func(product, **kwargs)
+            if output is not None:
+                product = output
+        return product
+
+    # =================== #
+    #   Properties        #
+    # =================== #
+    @property
+    def stages(self):
+        """ list of [name, func, kwargs] """
+        if self._derived_properties["stages"] is None:
+            self._derived_properties["stages"] = []
+        return self._derived_properties["stages"]
+
+    @property
+    def nstages(self):
+        """ number of stages """
+        return len(self.stages)
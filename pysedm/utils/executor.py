@@ -0,0 +1,429 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Unified execution backend of the parallel loops of the pipeline.
+
+Backends:
+- serial        : plain loop in the current process
+- thread        : pool of threads (for GIL-releasing numpy/C code or closures)
+- process       : pool of processes (tasks are pickled, the `shared` arrays
+                  are pickled once per worker)
+- sharedprocess : pool of processes that attach to the `shared` arrays
+                  copied once in (stdlib) shared memory (see SharedArray)
+
+Output buffers allocated with Executor.allocate() are in shared memory for
+the process backends, such that workers write their results in place
+instead of sending them back.
+
+When an executor has shared arrays, the task function is called as func(task, shared)
+with shared the {name: array} dict of that executor, such that several
+executors can run at once (e.g. in different threads).
+
+The backend and the number of workers are set by the PYSEDM_EXECUTOR and
+PYSEDM_NWORKERS environment variables (see set_executor), such that they can
+be pinned per node. The PYSEDM_* environment variables are passed to the worker processes.
+Pools only live within the Executor context (or the imap/map call) and are always closed.
+
+The worker processes are not forked from the calling process (see PROCESS_START_METHODS):
+pools are started from threads (e.g. the watch mode workers) and forking a
+multithreaded process may deadlock.
+
+Example
+-------
+```
+from pysedm.utils.executor import get_executor
+with get_executor(nworkers=4) as executor:
+    results = executor.map(func, tasks, progress=True)
+
+# zero-copy (func(task, shared) reads shared["data"] and writes in shared["out"])
+with get_executor("sharedprocess", shared={"data": data}) as executor:
+    out = executor.allocate("out", (len(tasks), 3))
+    executor.map(func, tasks)
+```
+"""
+
+import os
+import functools
+import numpy as np
+
+from propobject import BaseObject
+
+__all__ = ["set_executor", "get_executor", "Executor", "SharedArray"]
+
+BACKENDS         = ["serial", "thread", "process", "sharedprocess"]
+DEFAULT_BACKEND  = "process"
+# start method of the worker processes: the first available one
+PROCESS_START_METHODS = ["forkserver", "spawn"]
+
+# arrays published to the worker processes of a pool (set by the pool initializer)
+_WORKER_SHARED = {}
+
+
+def set_executor(backend=None, nworkers=None):
+    """ Set the default backend and/or number of workers of the pipeline.
+
+    Parameters
+    ----------
+    backend: [string/None] -optional-
+        serial, thread, process or sharedprocess.
+        This is stored in the PYSEDM_EXECUTOR environment variable.
+
+    nworkers: [int/None] -optional-
+        number of workers. Values <=0 are relative to the number of cpus (e.g. -2 means all but 2).
+        This is stored in the PYSEDM_NWORKERS environment variable.
+
+    Returns
+    -------
+    Void
+    """
+    if backend is not None:
+        if backend not in BACKENDS:
+            raise ValueError("backend must be one of %s, %s given"%(BACKENDS, backend))
+        os.environ["PYSEDM_EXECUTOR"] = backend
+    if nworkers is not None:
+        os.environ["PYSEDM_NWORKERS"] = "%d"%nworkers
+
+def get_backend(backend=None):
+    """ The given backend or, if None, the one of the PYSEDM_EXECUTOR environment variable """
+    if backend is None:
+        backend = os.getenv("PYSEDM_EXECUTOR", default=DEFAULT_BACKEND)
+    if backend not in BACKENDS:
+        raise ValueError("backend must be one of %s, %s given"%(BACKENDS, backend))
+    return backend
+
+def get_nworkers(nworkers=None):
+    """ Number of workers (>=1).
+
+    Parameters
+    ----------
+    nworkers: [int/None] -optional-
+        If None, the PYSEDM_NWORKERS environment variable is used (number of cpus if not set).
+        Values <=0 are relative to the number of cpus (e.g. -2 means all but 2).
+
+    Returns
+    -------
+    int
+    """
+    if nworkers is None:
+        nworkers = int(os.getenv("PYSEDM_NWORKERS", default="0"))
+    if nworkers <= 0:
+        nworkers = (os.cpu_count() or 1) + nworkers
+    return max(int(nworkers), 1)
+
+def get_process_context():
+    """ multiprocessing context of the process pools (see PROCESS_START_METHODS) """
+    import multiprocessing
+    available = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context([m for m in PROCESS_START_METHODS if m in available][0])
+
+def get_executor(backend=None, nworkers=None, **kwargs):
+    """ Executor following the pipeline configuration (see set_executor)
+
+    **kwargs goes to Executor.__init__ (chunksize, shared)
+
+    Returns
+    -------
+    Executor
+    """
+    return Executor(backend=backend, nworkers=nworkers, **kwargs)
+
+def _set_worker_shared_(shared, environ):
+    """ initializer of the worker processes: shared arrays and PYSEDM_* environment """
+    global _WORKER_SHARED
+    _WORKER_SHARED = shared
+    os.environ.update(environ)
+
+def _call_with_shared_(func, shared, task):
+    """ func(task, shared) """
+    return func(task, shared)
+
+def _call_with_worker_shared_(func, task):
+    """ func(task, shared) with the arrays published to this worker process """
+    return func(task, _WORKER_SHARED)
+
+
+def _attach_shared_array_(shape, dtype, name):
+    """ unpickling of SharedArray """
+    return SharedArray(shape, dtype=dtype, name=name)
+
+
+class SharedArray( np.ndarray ):
+    """ numpy array stored in (stdlib) shared memory.
+
+    It is pickled by name: unpickling it in another process attaches to
+    the same memory (no copy). The memory stays mapped as long as the array
+    or any of its views exist, and is freed once unlinked by its creator
+    and unmapped by every process.
+    """
+    def __new__(cls, shape, dtype="float64", name=None):
+        """
+        Parameters
+        ----------
+        shape: [tuple]
+            shape of the array.
+
+        dtype: [numpy dtype] -optional-
+            type of the array.
+
+        name: [string/None] -optional-
+            name of an existing shared memory block to attach to.
+            If None, a new (zero-filled) block is created.
+        """
+        from multiprocessing import shared_memory
+        dtype = np.dtype(dtype)
+        if name is None:
+            shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape))*dtype.itemsize, 1))
+        else:
+            shm = shared_memory.SharedMemory(name=name)
+        array = super(SharedArray, cls).__new__(cls, shape, dtype=dtype, buffer=shm.buf)
+        array._shm, array._is_block = shm, True
+        return array
+
+    def __array_finalize__(self, obj):
+        """ views keep the shared memory block alive """
+        self._shm, self._is_block = getattr(obj, "_shm", None), False
+
+    def __reduce__(self):
+        """ pickled by name (views and derived arrays are pickled as copies) """
+        if not self._is_block:
+            return np.asarray(self).copy().__reduce__()
+        return (_attach_shared_array_, (self.shape, self.dtype.str, self._shm.name))
+
+    @classmethod
+    def from_array(cls, array):
+        """ copy of the given array in shared memory """
+        array = np.asarray(array)
+        shared = cls(array.shape, dtype=array.dtype)
+        shared[...] = array
+        return shared
+
+    def unlink(self):
+        """ free the shared memory block once it is no longer mapped (to be called by its creator) """
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    @property
+    def name(self):
+        """ name of the shared memory block """
+        return self._shm.name
+
+
+class Executor( BaseObject ):
+    """ Ordered (streaming) parallel map over a pool of workers.
+
+    Within a context, the pool is created by the first imap/map call and closed
+    when exiting. Outside a context, a pool is created (and closed) for each imap/map call.
+    """
+    SIDE_PROPERTIES    = ["backend", "nworkers", "chunksize", "shared"]
+    DERIVED_PROPERTIES = ["pool", "published", "sharedmemory", "incontext"]
+
+    def __init__(self, backend=None, nworkers=None, chunksize=None, shared=None):
+        """
+        Parameters
+        ----------
+        backend: [string/None] -optional-
+            serial, thread, process or sharedprocess. (see get_backend)
+
+        nworkers: [int/None] -optional-
+            number of workers. (see get_nworkers)
+
+        chunksize: [int/None] -optional-
+            number of tasks sent at once to a worker process.
+            If None, about 4 chunks per worker for process backends, 1 otherwise.
+
+        shared: [dict/None] -optional-
+            {name: array} made available to the task functions, that are then
+            called as func(task, shared) (see imap).
+        """
+        self._side_properties["backend"]   = get_backend(backend)
+        self._side_properties["nworkers"]  = get_nworkers(nworkers) if self._side_properties["backend"] != "serial" else 1
+        self._side_properties["chunksize"] = chunksize
+        self._side_properties["shared"]    = {} if shared is None else shared
+
+    def __enter__(self):
+        """ the pool starts with the first imap/map call and is closed when exiting """
+        self._derived_properties["incontext"] = True
+        return self
+
+    def __exit__(self, *exc):
+        self._derived_properties["incontext"] = False
+        self.close()
+
+    # =================== #
+    #   Methods           #
+    # =================== #
+    def open(self):
+        """ Publish the shared arrays and start the pool of workers (if any) """
+        if self._published is not None:
+            return
+        self._derived_properties["published"] = {k: SharedArray.from_array(v)
+                                                     if self.backend == "sharedprocess" and self.is_parallel()
+                                                     and isinstance(v, np.ndarray) and not isinstance(v, SharedArray) else v
+                                                     for k, v in self.shared.items()}
+        self._sharedmemory.extend([v for k, v in self._published.items()
+                                       if isinstance(v, SharedArray) and v is not self.shared[k]])
+        if not self.is_parallel():
+            return
+        from multiprocessing.pool import ThreadPool
+        if self.backend == "thread":
+            self._derived_properties["pool"] = ThreadPool(self.nworkers)
+        else:
+            environ = {k: v for k, v in os.environ.items() if k.startswith("PYSEDM_")}
+            self._derived_properties["pool"] = get_process_context().Pool(self.nworkers,
+                                                    initializer=_set_worker_shared_, initargs=(self._published, environ))
+
+    def close(self):
+        """ Close the pool of workers (waiting for the running tasks) and
+        unlink the shared memory created by this executor.
+        (arrays returned by allocate() remain valid in the current process) """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self._derived_properties["pool"] = None
+        for shared_ in self._sharedmemory:
+            shared_.unlink()
+        for name in [k for k, v in self.shared.items() if any(v is s_ for s_ in self._sharedmemory)]:
+            self.shared.pop(name)
+        self._derived_properties["sharedmemory"] = None
+        self._derived_properties["published"]    = None
+
+    def allocate(self, name, shape, dtype="float64"):
+        """ Zero-filled output buffer published to the workers as shared[name].
+
+        It is in shared memory for the process backends, such that the workers
+        write in place. To be called before the pool starts (i.e. before entering
+        imap/map); it is published to that pool only.
+
+        Returns
+        -------
+        numpy array (view of the buffer in the current process)
+        """
+        if self._published is not None:
+            raise ValueError("allocate() must be called before the pool of workers starts.")
+        if self.is_parallel() and self.backend in ["process", "sharedprocess"]:
+            buffer = SharedArray(shape, dtype=dtype)
+            self._sharedmemory.append(buffer)
+        else:
+            buffer = np.zeros(shape, dtype=dtype)
+        self.shared[name] = buffer
+        return np.asarray(buffer)
+
+    def imap(self, func, tasks, progress=False, notebook=False, ntasks=None):
+        """ Generator of func(task) for the given tasks, in the tasks order.
+
+        Parameters
+        ----------
+        func: [function]
+            called as func(task), or as func(task, shared) if the executor has shared arrays
+            (shared argument or allocate). Must be picklable (module-level) for the process backends.
+
+        tasks: [iterable]
+            arguments of func.
+
+        progress: [bool] -optional-
+            Shall the progress be shown (astropy's ProgressBar)?
+
+        notebook: [bool] -optional-
+            Shall the ProgressBar be an ipython widget?
+
+        ntasks: [int/None] -optional-
+            number of tasks (for the progress bar and the chunksize) if tasks has no len().
+
+        Returns
+        -------
+        generator
+        """
+        if ntasks is None and hasattr(tasks, "__len__"):
+            ntasks = len(tasks)
+        results = self._imap_(func, tasks, ntasks)
+        if progress:
+            results = self._progress_(results, ntasks, notebook)
+        return results
+
+    def map(self, func, tasks, **kwargs):
+        """ list of func(task) for the given tasks (see imap) """
+        return list(self.imap(func, tasks, **kwargs))
+
+    def is_parallel(self):
+        """ Does this executor use a pool of workers? """
+        return self.backend != "serial" and self.nworkers > 1
+
+    # - internal
+    def _imap_(self, func, tasks, ntasks):
+        """ """
+        owner = self._published is None and not self._derived_properties["incontext"]
+        if self._published is None:
+            self.open()
+        if len(self._published) > 0:
+            # each executor sends its own arrays: nothing is global to the calling process
+            func = functools.partial(_call_with_worker_shared_, func) if self.backend in ["process", "sharedprocess"] \
+              and self.is_parallel() else functools.partial(_call_with_shared_, func, self._published)
+        try:
+            if not self.is_parallel():
+                for task in tasks:
+                    yield func(task)
+            else:
+                for result in self.pool.imap(func, tasks, chunksize=self._get_chunksize_(ntasks)):
+                    yield result
+        finally:
+            if owner:
+                self.close()
+
+    def _get_chunksize_(self, ntasks):
+        """ """
+        if self.chunksize is not None:
+            return self.chunksize
+        if self.backend == "thread" or ntasks is None:
+            return 1
+        return max(ntasks // (4*self.nworkers), 1)
+
+    @staticmethod
+    def _progress_(results, ntasks, notebook):
+        """ """
+        from astropy.utils.console import ProgressBar
+        with ProgressBar(ntasks, ipython_widget=notebook) as bar:
+            for result in results:
+                yield result
+                bar.update()
+
+    # =================== #
+    #   Properties        #
+    # =================== #
+    @property
+    def backend(self):
+        """ serial, thread, process or sharedprocess """
+        return self._side_properties["backend"]
+
+    @property
+    def nworkers(self):
+        """ number of workers """
+        return self._side_properties["nworkers"]
+
+    @property
+    def chunksize(self):
+        """ number of tasks sent at once to a worker process (None means automatic) """
+        return self._side_properties["chunksize"]
+
+    @property
+    def shared(self):
+        """ {name: array} published to the workers (see imap) """
+        return self._side_properties["shared"]
+
+    @property
+    def pool(self):
+        """ current pool of workers (None if closed or serial) """
+        return self._derived_properties["pool"]
+
+    @property
+    def _published(self):
+        """ arrays sent to the workers (None if not opened) """
+        return self._derived_properties["published"]
+
+    @property
+    def _sharedmemory(self):
+        """ SharedArrays created by this executor (unlinked when closed) """
+        if self._derived_properties["sharedmemory"] is None:
+            self._derived_properties["sharedmemory"] = []
+        return self._derived_properties["sharedmemory"]
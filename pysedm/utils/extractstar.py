@@ -12,7 +12,7 @@ from propobject          import BaseObject
 from pyifu                import adr
 from pyifu.spectroscopy   import Slice
 
-from ..sedm          import IFU_SCALE_UNIT # This is the only SEDM part.
+from ..sedm          import IFU_SCALE_UNIT, get_adr_trajectory # This is the only SEDM part.
 from .tools   import kwargs_update, is_arraylike, make_method, fit_intrinsic
 
 from modefit.baseobjects import BaseFitter, BaseModel
@@ -225,6 +225,53 @@ def fit_force_spectroscopy(cube, psfmodel, savefig=None, show=False):
     return spec, bkgd, forcepsf
 
 
+#############################
+#                           #
+#  PSF Profiles             #
+#                           #
+#############################
+def get_elliptical_distance(x, y, xcentroid=0, ycentroid=0, ell=0, theta=0):
+    """ Elliptical distance of the x, y positions to the centroid.
+    (all the inputs are broadcasted against each other)
+
+    Parameters
+    ----------
+    x, y: [float/array]
+        positions
+
+    xcentroid, ycentroid: [float/array] -optional-
+        position of the centroid
+
+    ell: [float/array] -optional-
+        ellipticity [0<= ell <1]
+
+    theta: [float/array] -optional-
+        rotation angle [in radian]
+
+    Returns
+    -------
+    array
+    """
+    dx, dy = np.asarray(x)-xcentroid, np.asarray(y)-ycentroid
+    cos_, sin_ = np.cos(theta), np.sin(theta)
+    return np.sqrt((cos_*dx + sin_*dy)**2 + ((-sin_*dx + cos_*dy)*(1-ell))**2)
+
+def binormal_profile(x, y, stddev, stddev_ratio, amplitude_ratio,
+                         theta, ell, xcentroid, ycentroid, amplitude=1):
+    """ Sum of two concentric (elliptical) normal profiles:
+    amplitude * [amplitude_ratio*N(stddev) + N(stddev*stddev_ratio)] / (1+amplitude_ratio)
+    (all the inputs are broadcasted against each other)
+
+    Returns
+    -------
+    array
+    """
+    r = get_elliptical_distance(x, y, xcentroid=xcentroid, ycentroid=ycentroid, ell=ell, theta=theta)
+    coef1 = amplitude_ratio/(1.+amplitude_ratio)
+    coef2 = 1./(1+amplitude_ratio)
+    return amplitude * (coef1 * norm.pdf(r, loc=0, scale=stddev) +
+                        coef2 * norm.pdf(r, loc=0, scale=np.asarray(stddev)*stddev_ratio))
+
 
 #############################
 #                           #
@@ -450,10 +497,13 @@ class _PSF3D_( BaseObject ):
     #  GETTER   #
     # --------- #
     def get_psf_param(self, lbda):
-        """ """
+        """ Position and shape parameters of the PSF at the given wavelength(s).
+        (the ADR trajectory is cached, see sedm.get_adr_trajectory) """
         psf = {}
-        psf["xcentroid"], psf["ycentroid"] = self.adr.refract(self.refposition[0], self.refposition[1],
-                                                  lbda, unit=self.unit)
+        xshift, yshift = get_adr_trajectory(self.adr, lbda, unit=self.unit)
+        if not is_arraylike(lbda):
+            xshift, yshift = xshift[0], yshift[0]
+        psf["xcentroid"], psf["ycentroid"] = self.refposition[0]+xshift, self.refposition[1]+yshift
         for k in self.PROFILE_PARAMETERS:            
             psf[k]  = self.profile_param[k](lbda) if callable(self.profile_param[k]) else self.profile_param[k]
         return psf
@@ -552,8 +602,15 @@ class PSF3D_BiNormalCont( _PSF3D_ ):
     # GETTER   #
     # -------- #
     def get_psf(self, x, y, lbda):
-        """ """
-        return binormal_profile(x, y, **self.get_psf_param(lbda))
+        """ PSF at the x, y positions for the given wavelength.
+        If lbda is an array, this returns the (nlbda, npositions) array at once.
+        """
+        if not is_arraylike(lbda):
+            return binormal_profile(x, y, **self.get_psf_param(lbda))
+        # - single broadcast over (nlbda, npositions)
+        param = {k: np.asarray(v)[:,None] if is_arraylike(v) else v
+                     for k,v in self.get_psf_param(np.asarray(lbda)).items()}
+        return binormal_profile(np.asarray(x)[None,:], np.asarray(y)[None,:], **param)
         
     def get_stddev(self, lbda, rho=None):
         """ """
@@ -675,8 +732,10 @@ class ForcePSF( BaseObject ):
         
         flux,errors = [],[]
         bkgd,bkgderrors = [],[]
+        # - the psf of every slice at once
+        psfs = self.psfmodel.get_psf(x_, y_, np.asarray(self.cube.lbda))
         for i,lbda_ in enumerate(self.cube.lbda):
-            fitvalue = fit_forcepsf_slice(self.cube.data[i][flagok], self.psfmodel.get_psf(x, y, lbda_), variance=self.cube.variance[i][flagok])
+            fitvalue = fit_forcepsf_slice(self.cube.data[i][flagok], psfs[i][flagok], variance=self.cube.variance[i][flagok])
             # recording
             flux.append(fitvalue["amplitude"])
             errors.append(fitvalue["amplitude.err"])
@@ -686,8 +745,7 @@ class ForcePSF( BaseObject ):
         self._derived_properties['spec_source']  =  get_spectrum(self.cube.lbda, np.asarray(flux), variance=np.asarray(errors)**2, header=self.cube.header)
         self._derived_properties['spec_bkgd'] =  get_spectrum(self.cube.lbda, np.asarray(bkgd), variance=np.asarray(bkgderrors)**2, header=self.cube.header)
         if store_cubemodel:
-            datamodel = [self.psfmodel.get_psf(x_, y_, lbda_)*self.spec_source.data[i] + self.spec_bkgd.data[i]
-                             for i, lbda_ in enumerate(self.cube.lbda)]
+            datamodel = psfs*np.asarray(self.spec_source.data)[:,None] + np.asarray(self.spec_bkgd.data)[:,None]
             self._derived_properties['cubemodel'] = get_cube(datamodel, header=None, variance=None, lbda=self.cube.lbda,
                                      spaxel_mapping=self.cube.spaxel_mapping, spaxel_vertices=self.cube.spaxel_vertices)
             
@@ -854,8 +912,11 @@ class FitPSF( BaseObject ):
         self._side_properties["profile"] = profile
         
         # - Da fit
+        # all the metaslices at once if the cube can (SEDMCube.get_slices)
+        slices = self.cube.get_slices(self.lbdas, slice_object=True) if hasattr(self.cube, "get_slices") else\
+                 [self.cube.get_slice(l[0],l[1], slice_object=True) for l in self.lbdas]
         for i,l in enumerate(self.lbdas):
-            self.slicefits[i] = {"fit": fit_slice( self.cube.get_slice(l[0],l[1], slice_object=True),
+            self.slicefits[i] = {"fit": fit_slice( slices[i],
                                                 psfmodel=profile,
                                                 centroids=centroid_guesses[i],
                                                 centroids_err=[centroid_errors,centroid_errors],
@@ -39,7 +39,8 @@ class HexagoneProjection( BaseObject ):
     SIDE_PROPERTIES    = ["ref_idx","index_ids"]
     DERIVED_PROPERTIES = ["hexafilled",
                               "tree","multipoint","rotmatrix",
-                              "ids_index"]
+                              "ids_index", "ids_lookup", "xy_grid",
+                              "lattice_basis", "misplaced"]
 
     def __init__(self, xy, qdistance=None, load=True, ids=None,
                      empty=False):
@@ -60,8 +61,10 @@ class HexagoneProjection( BaseObject ):
         from .tools import dump_pkl
         data = {
             "neighbors": self.neighbors,
-            "ids":       self.index_ids,
+            "ids":       np.asarray(self.index_ids),
             "hexgrid":   self.hexgrid,
+            "xy_grid":   self.xy_grid,
+            "grid_theta":self.grid_theta,
             "ref_idx":   self.ref_idx,
             "qdistance": self.qdistance
             }
@@ -83,7 +86,10 @@ class HexagoneProjection( BaseObject ):
             self.set_hexgrid(data["hexgrid"])
         #  Valuable information
         if "ref_idx" in data.keys():
-            self.set_grid_reference(*data["ref_idx"])
+            self.set_grid_reference(*data["ref_idx"], theta=data.get("grid_theta", None))
+        #  Already rotated (x,y) coordinates
+        if "xy_grid" in data.keys():
+            self._derived_properties["xy_grid"] = np.asarray(data["xy_grid"])
             
         if "ids" in data.keys():
             self.set_ids(data["ids"])
@@ -103,7 +109,7 @@ class HexagoneProjection( BaseObject ):
         else:
             fig = ax.figure
 
-        indexes = list(self.ids_index.keys())
+        indexes = self.index_ids
         colors = mpl.cm.viridis(np.random.uniform(size=len(indexes)))
         ps = [patches.Polygon(SEDMSPAXELS + np.asarray(self.index_to_xy(self.ids_to_index(id_))),
                         facecolor=colors[i], alpha=0.8, **kwargs) for i,id_  in enumerate(indexes)]
@@ -137,7 +143,9 @@ class HexagoneProjection( BaseObject ):
 
     def set_ids(self, ids):
         """ The id corresponding the given coordinates (xy). """
-        self._side_properties["index_ids"] = ids
+        self._side_properties["index_ids"] = np.asarray(ids) if ids is not None else None
+        self._derived_properties["ids_index"]  = None
+        self._derived_properties["ids_lookup"] = None
         
     def fetch_neighbors(self):
         """ """
@@ -148,18 +156,25 @@ class HexagoneProjection( BaseObject ):
         self._properties["neighbors"] = neighbors
         
     def set_hexgrid(self, hexgrid):
-        """ directly provide the (Q,R) coordinates for the indexes. """
-        self._properties["hexgrid"] = hexgrid
+        """ directly provide the (Q,R) coordinates for the indexes. 
+        
+        Parameters
+        ----------
+        hexgrid: [2d-array or list]
+            (npoints, 2) array of (Q,R) coordinates (NaN if unknown). 
+            A list of [Q,R] (None if unknown) is also accepted.
+        """
+        if np.asarray(hexgrid, dtype="object").ndim == 1: # list of [q,r] or None
+            hexgrid = [qr_ if qr_ is not None else [np.nan, np.nan] for qr_ in hexgrid]
+        self._properties["hexgrid"] = np.asarray(hexgrid, dtype="float")
+        self._derived_properties["xy_grid"] = None
         
     # ---------- #
     #   GETTER   #
     # ---------- #
     def get_central_index(self):
         """ the closest point to the centroid """
-        if self.centroid is None:
-            raise ValueError("This cannot estimate the centroid (no Shapely?).")
-        
-        return np.argmin([distance.euclidean(xydata_,self.centroid) for xydata_ in self.xy])
+        return np.argmin(np.sum((self.xy-self.centroid)**2, axis=1))
 
     def get_default_grid_reference(self):
         """ Look For the central value and 3 neightbors to define the 
@@ -173,6 +188,42 @@ class HexagoneProjection( BaseObject ):
         r10 = self.get_shared_neighbors(r00,r01)[0]
         return r00, r01, r10
     
+    def get_neighbor_pairs(self):
+        """ All the (index1, index2) neighbor pairs (index1 < index2)
+        
+        Returns
+        -------
+        2d-array (npairs, 2)
+        """
+        index1 = np.repeat(np.arange(self.npoints), [len(n_) for n_ in self.neighbors])
+        index2 = np.concatenate([np.asarray(n_, dtype="int") for n_ in self.neighbors])
+        return np.asarray([index1, index2]).T[index1<index2]
+        
+    def get_lattice_basis(self, ref_idx=None):
+        """ Estimate the (x,y) vectors of the unit Q and R steps of the hexagonal grid.
+        The reference indexes provide a first guess that is then refined
+        using all the neighbor offsets.
+
+        Parameters
+        ----------
+        ref_idx: [3 ints] -optional-
+            The three indexes defining (0,0),(0,1),(1,0). If None, self.ref_idx is used
+
+        Returns
+        -------
+        2d-array [q_vector, r_vector]
+        """
+        ref_00, ref_01, ref_10 = self.ref_idx if ref_idx is None else ref_idx
+        basis  = np.asarray([self.xy[ref_10]-self.xy[ref_00], self.xy[ref_01]-self.xy[ref_00]], dtype="float")
+        pairs  = self.get_neighbor_pairs()
+        offsets= self.xy[pairs[:,1]] - self.xy[pairs[:,0]]
+        # - Offsets in lattice units
+        dqr    = np.round(np.dot(offsets, np.linalg.inv(basis)))
+        unit   = (np.abs(dqr).max(axis=1) == 1) & (np.abs(dqr.sum(axis=1)) <= 1)
+        if unit.sum() < 2:
+            return basis
+        return np.linalg.lstsq(dqr[unit], offsets[unit], rcond=None)[0]
+    
     def get_idx_neighbors(self, index):
         """ Gives the name of all the `index` neightbors.
         There should be 6 (since it is an haxagonal grid) but less is expected
@@ -217,27 +268,39 @@ class HexagoneProjection( BaseObject ):
         return self.index_ids[index]
 
     def ids_to_index(self, ids):
-        """ given the id of the given index """        
+        """ given the id of the given index.
+        For arrays, unknown ids get the index -1 """
         if is_arraylike(ids):
-            return np.asarray([self.ids_to_index(ids_) for ids_ in ids])
+            ids = np.asarray(ids)
+            if len(ids) == 0:
+                return np.asarray([], dtype="int")
+            if self._ids_lookup is None or ids.dtype.kind not in "iu":
+                return np.asarray([self.ids_index.get(ids_, -1) for ids_ in ids])
+            
+            inrange = (ids>=0) & (ids<len(self._ids_lookup))
+            return np.where(inrange, self._ids_lookup[np.clip(ids, 0, len(self._ids_lookup)-1)], -1)
         
         return self.ids_index[ids]
     
     def index_to_qr(self, index):
-        """ get the (Q,R) hexagonal coordinates of the given index"""
-        return self.hexgrid[index]
+        """ get the (Q,R) hexagonal coordinates of the given index
+        (NaN if not known or if the index is -1) """
+        index = np.asarray(index)
+        return np.where((index<0)[...,None], np.nan, self.hexgrid[index])
 
     def index_to_xy(self, index, invert_rotation=True):
-        """ """
-        qr = np.asarray(self.index_to_qr(index)).T
+        """ get the (x,y) coordinates of the given index (NaN if not known or if the index is -1)
 
-        if not is_arraylike(index):
-            q,r = qr if qr is not None else [np.NaN, np.NaN]
-        else:
-            q,r = np.asarray([qr_ if qr_ is not None else [np.NaN, np.NaN]
-                                  for qr_ in qr]).T
-            
-        return self.qr_to_xy(q,r, invert_rotation=invert_rotation)
+        Returns
+        -------
+        x,y
+        """
+        index = np.asarray(index)
+        if not invert_rotation:
+            q,r = np.moveaxis(self.index_to_qr(index), -1, 0)
+            return np.asarray(self.qr_to_xy(q,r, invert_rotation=False))
+        
+        return np.moveaxis(np.where((index<0)[...,None], np.nan, self.xy_grid[index]), -1, 0)
     
     def qr_to_xy(self, q,r, invert_rotation=True):
         """ Convert (q,r) hexagonal grid coordinates into (x,y) system 
@@ -270,6 +333,7 @@ class HexagoneProjection( BaseObject ):
         self._side_properties["ref_idx"] = [ref_00,ref_01,ref_10]
         self._derived_properties["hexafilled"] = None
         
+        self._derived_properties["xy_grid"] = None
         # - derived the baseline rotation matrix
         x,y = np.asarray(self.index_to_xy([ref_00,ref_01,ref_10], invert_rotation=False))
         if theta is None:
@@ -307,11 +371,11 @@ class HexagoneProjection( BaseObject ):
         """
         
         # - No Reference
-        if self.hexgrid[ref] is None:
+        if not self._has_qr(ref):
             return 0
-        if self.hexgrid[idx] is not None:
+        if self._has_qr(idx):
             return -1
-        if self.hexgrid[neighbor0] is None or self.hexgrid[neighbor1] is None:
+        if not self._has_qr(neighbor0) or not self._has_qr(neighbor1):
             return -2
         
         q_ref, r_ref = self.hexgrid[ref]
@@ -325,9 +389,9 @@ class HexagoneProjection( BaseObject ):
         """ """
         neightbors = self.get_idx_neighbors(hexcentral)
         for n1 in neightbors:
-            if self.hexgrid[n1] is not None:
+            if self._has_qr(n1):
                 n2 = [n2_ for n2_ in self.get_shared_neighbors(hexcentral, n1)
-                          if self.hexgrid[n2_] is not None]
+                          if self._has_qr(n2_)]
                 if len(n2)>0:
                     return n1,n2[0]
         return None
@@ -352,37 +416,73 @@ class HexagoneProjection( BaseObject ):
         self._hexafilled[central_hexagon] = True
         return neighbors
 
-    def build_qr_grid(self, ref_idx):
-        """ 
+    def build_qr_grid(self, ref_idx, max_residual=0.3):
+        """ Assign the (Q,R) coordinates to all the points.
+
+        The (Q,R) step between each point and its parent in a breadth first walk of the 
+        neighbor graph (starting from the (0,0) reference) is obtained by projecting their
+        offset on the lattice basis (see get_lattice_basis) and rounding. All the steps are then
+        accumulated at once. This is deterministic and robust to a moderate distortion 
+        of the grid.
+        
         Parameters
         ----------
         ref_idx: [3 ints]
             The three indexes defining (0,0),(0,1),(1,0).
             They must be neighbors. (see `set_grid_reference`)
+
+        max_residual: [float] -optional-
+            Neighbor offsets deviating by more than this (in unit of grid spacing) 
+            from their assigned (Q,R) offset flag their points as misplaced 
+            (see the `misplaced` attribute).
+
+        Returns
+        -------
+        Void
         """
+        from scipy.sparse import csgraph, coo_matrix
         if len(ref_idx) != 3:
             raise TypeError("The given ref_idx must be a list of 3 indexes")
         # - Defining the Axis
         self.set_grid_reference(*ref_idx)
-
-
-        # - How will that be built?
-        n0, n1, ref1 = self.ref_idx
-        goahead      = True
-        running_i    = 0
-        next_to_run  = [n0]
+        basis = self.get_lattice_basis()
+        self._derived_properties["lattice_basis"] = basis
         
-        while(goahead and running_i<self.npoints):
-            potential_next = self.populate_hexagon(n0)
-            next_          = [n for n in potential_next if not self._hexafilled[n]] if potential_next is not None\
-              else []                
-            next_to_run    = [n_ for n_ in next_to_run if n_ not in [n0]] + next_
-            if len(next_to_run)>1:
-                n0 = np.random.choice(next_to_run)
-                running_i +=1
-            else:
-                goahead = False
-
+        # - Walk the neighbor graph
+        pairs = self.get_neighbor_pairs()
+        graph = coo_matrix((np.ones(len(pairs)), (pairs[:,0], pairs[:,1])), shape=(self.npoints, self.npoints))
+        order, parents = csgraph.breadth_first_order(graph, self.ref_idx[0], directed=False, return_predecessors=True)
+        reached = np.zeros(self.npoints, dtype="bool")
+        reached[order] = True
+        parents[~reached | (parents<0)] = -1
+        
+        # - (Q,R) steps from the parents
+        steps = np.zeros((self.npoints, 2))
+        haveparent = parents >= 0
+        steps[haveparent] = np.round(np.dot(self.xy[haveparent]-self.xy[parents[haveparent]], np.linalg.inv(basis)))
+        # - Accumulate along the walk (pointer jumping)
+        while np.any(parents >= 0):
+            haveparent = parents >= 0
+            steps[haveparent]   = steps[haveparent] + steps[parents[haveparent]]
+            parents[haveparent] = parents[parents[haveparent]]
+        qr = np.asarray(steps, dtype="int") + np.asarray(self.hexgrid[self.ref_idx[0]])
+        
+        # - Residual check
+        dqr      = qr[pairs[:,1]] - qr[pairs[:,0]]
+        spacing  = np.mean(np.linalg.norm(basis, axis=1))
+        residual = np.linalg.norm(self.xy[pairs[:,1]] - self.xy[pairs[:,0]] - np.dot(dqr, basis), axis=1) / spacing
+        misplaced = np.zeros(self.npoints, dtype="bool")
+        misplaced[pairs[residual>max_residual].ravel()] = True
+        _, first_index, counts = np.unique(qr[reached], axis=0, return_index=True, return_counts=True)
+        duplicated = np.ones(reached.sum(), dtype="bool")
+        duplicated[first_index[counts==1]] = False
+        misplaced[np.argwhere(reached).ravel()[duplicated]] = True
+        if np.any(misplaced):
+            warnings.warn("%d points may be misplaced on the hexagonal grid (see `misplaced`)"%misplaced.sum())
+        self._derived_properties["misplaced"] = misplaced
+        
+        self.hexgrid[reached] = qr[reached]
+        self._derived_properties["xy_grid"] = None
 
     # ----------- #
     #   PLOTTER   #
@@ -427,6 +527,20 @@ class HexagoneProjection( BaseObject ):
             
         return self._derived_properties["ids_index"]
 
+    @property
+    def _ids_lookup(self):
+        """ array such that _ids_lookup[id] is the index of the id (-1 if unknown).
+        None if the ids are not positive integers. """
+        if self._derived_properties["ids_lookup"] is None:
+            ids = np.asarray(self.index_ids)
+            if ids.dtype.kind not in "iu" or len(ids)==0 or ids.min()<0:
+                return None
+            lookup = np.full(ids.max()+1, -1, dtype="int")
+            lookup[ids] = np.arange(len(ids))
+            self._derived_properties["ids_lookup"] = lookup
+            
+        return self._derived_properties["ids_lookup"]
+
     # ----------
     # Derived
     @property
@@ -442,11 +556,34 @@ class HexagoneProjection( BaseObject ):
     # - Building the Q,R grid
     @property
     def hexgrid(self):
-        """ List containing the relation between index and (Q,R) """
+        """ (npoints, 2) array containing the (Q,R) coordinates of the indexes (NaN if unknown) """
         if self._properties["hexgrid"] is None:
-            self._properties["hexgrid"] = np.asarray([None for i in range(self.npoints)])
+            self._properties["hexgrid"] = np.full((self.npoints, 2), np.nan)
         return self._properties["hexgrid"]
 
+    def _has_qr(self, index):
+        """ Are the (Q,R) coordinates of the given index known? """
+        return not np.any(np.isnan(self.hexgrid[index]))
+    
+    @property
+    def xy_grid(self):
+        """ (npoints, 2) array containing the (rotated) (x,y) coordinates of the indexes (NaN if unknown).
+        (see qr_to_xy) """
+        if self._derived_properties["xy_grid"] is None:
+            self._derived_properties["xy_grid"] = np.asarray(self.qr_to_xy(*self.hexgrid.T, invert_rotation=True)).T
+        return self._derived_properties["xy_grid"]
+
+    @property
+    def lattice_basis(self):
+        """ (x,y) vectors of the unit Q and R steps used by `build_qr_grid` """
+        return self._derived_properties["lattice_basis"]
+    
+    @property
+    def misplaced(self):
+        """ boolean array flagging the points whose (Q,R) coordinates are inconsistent 
+        with their neighbors' ones (see build_qr_grid) """
+        return self._derived_properties["misplaced"]
+    
     @property
     def _hexafilled(self):
         """ Dictionary containing the relation between index and (Q,R)"""
@@ -474,10 +611,8 @@ class HexagoneProjection( BaseObject ):
     # Centroid 
     @property
     def centroid(self):
-        """ """
-        if self._multipoint is not None:
-            return np.asarray(self._multipoint.centroid.xy).T[0]
-        return None
+        """ mean (x,y) position of the points """
+        return np.nanmean(self.xy, axis=0)
 
     @property
     def _multipoint(self):
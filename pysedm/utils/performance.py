@@ -0,0 +1,332 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Lightweight stage instrumentation: wall time, cpu time and peak memory (RSS).
+
+Stages are recorded in a run-scoped registry (see get_registry()).
+- `stage(name)` is a context manager
+- `timed_stage(name)` is the equivalent decorator
+Stages are nested per thread: concurrent stages (e.g. the watcher threads) each
+have their own parents. When a top-level stage ends, its records (and those of
+its nested stages) are appended to the per-night performance log
+`<date>_PerfLog.jsonl` (one JSON record per line) and `<date>_PerfLog.csv`.
+The logs are append-only and written under a (file) lock, such that several
+threads and processes can share them (see read_night_log()).
+
+peak_rss is the peak RSS of the whole process so far (getrusage's ru_maxrss)
+and delta_rss its increase during the stage: it is 0 for a stage whose
+memory use stays below a previous peak, and it includes the memory used by
+concurrent stages of other threads. It is thus an upper bound of the stage
+memory footprint, not a per-stage measurement.
+
+Example
+-------
+```
+from pysedm.utils import performance
+with performance.stage("build_wavesolution", date="20180101"):
+    ...
+performance.get_registry().to_header(cube.header)
+```
+"""
+
+import os
+import sys
+import time
+import json
+import warnings
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from propobject import BaseObject
+
+try:
+    import resource
+    _HAS_RESOURCE = True
+except ImportError:
+    _HAS_RESOURCE = False
+
+__all__ = ["stage", "timed_stage", "get_registry", "read_night_log"]
+
+PERFLOG_ROOT = "PerfLog"
+CSV_COLUMNS  = ["run", "date", "stage", "parent", "depth", "start",
+                "wall", "cpu", "peak_rss", "delta_rss", "info"]
+# finished records kept in memory by a registry (older ones are only in the night log)
+MAX_RECORDS  = 10000
+
+
+def get_peak_rss():
+    """ Peak resident set size of the current process in MB (None if unknown) """
+    if not _HAS_RESOURCE:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return maxrss/1024.**2 if sys.platform == "darwin" else maxrss/1024.
+
+def read_night_log(date):
+    """ records of the night performance log (see PerfRegistry.writeto_night)
+
+    Returns
+    -------
+    list of dict
+    """
+    from .. import io
+    logfile = io.get_datapath(date)+"%s_%s.jsonl"%(date, PERFLOG_ROOT)
+    if not os.path.isfile(logfile):
+        return []
+    with open(logfile) as f_:
+        return [json.loads(l_) for l_ in f_ if len(l_.strip())>0]
+
+def get_registry():
+    """ The registry of the current run """
+    global _REGISTRY
+    with _REGISTRY_LOCK:
+        if _REGISTRY is None:
+            _REGISTRY = PerfRegistry()
+    return _REGISTRY
+
+def new_run():
+    """ Start a new registry (new run id) and returns it """
+    global _REGISTRY
+    _REGISTRY = PerfRegistry()
+    return _REGISTRY
+
+@contextmanager
+def stage(name, date=None, registry=None, **info):
+    """ Context manager recording the wall time, cpu time and peak RSS of the block.
+
+    Parameters
+    ----------
+    name: [string]
+        name of the stage (e.g. build_wavesolution)
+
+    date: [string/None] -optional-
+        YYYYMMDD of the night. If None, this is inherited from the parent stage.
+        The performance log is written only for stages with a date.
+
+    registry: [PerfRegistry/None] -optional-
+        registry to use. If None, the one of the current run (get_registry())
+
+    **info: additional information stored with the record (e.g. filename)
+
+    Returns
+    -------
+    dict (the record, filled when the stage ends)
+    """
+    registry = get_registry() if registry is None else registry
+    record = registry.start_stage(name, date=date, **info)
+    try:
+        yield record
+    finally:
+        registry.end_stage(record)
+
+def timed_stage(name=None, date_arg="date"):
+    """ Decorator recording the decorated function as a stage (see stage()).
+
+    Parameters
+    ----------
+    name: [string/None] -optional-
+        name of the stage. The function name if None.
+
+    date_arg: [string] -optional-
+        name of the function argument containing the YYYYMMDD date (if any).
+    """
+    def decorator(func):
+        import inspect
+        signature = inspect.signature(func)
+        stagename = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                date = signature.bind_partial(*args, **kwargs).arguments.get(date_arg, None)
+            except TypeError:
+                date = None
+            with stage(stagename, date=date if isinstance(date, str) else None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class PerfRegistry( BaseObject ):
+    """ Run-scoped record of the pipeline stages (thread-safe: the running
+    stages are tracked per thread, see stack). Only the last `max_records`
+    finished records are kept in memory, such that a long-running process
+    (e.g. the watcher) does not grow all night. """
+    PROPERTIES         = ["records"]
+    SIDE_PROPERTIES    = ["runid", "write_log", "max_records"]
+    DERIVED_PROPERTIES = ["local", "lock"]
+
+    def __init__(self, runid=None, write_log=True, max_records=MAX_RECORDS):
+        """ """
+        self._side_properties["runid"] = "%s-%d"%(time.strftime("%Y%m%dT%H%M%S"), os.getpid()) \
+          if runid is None else runid
+        self._side_properties["write_log"]   = write_log
+        self._side_properties["max_records"] = max_records
+        self._derived_properties["local"]  = threading.local()
+        self._derived_properties["lock"]   = threading.Lock()
+
+    # =================== #
+    #   Methods           #
+    # =================== #
+    def start_stage(self, name, date=None, **info):
+        """ open a new stage (see end_stage) and returns its record """
+        parent = self.stack[-1] if len(self.stack)>0 else None
+        record = {"run":self.runid, "stage":name,
+                  "date": date if date is not None or parent is None else parent["date"],
+                  "parent": None if parent is None else parent["stage"],
+                  "depth": len(self.stack),
+                  "start": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "info": info,
+                  "_t0": time.perf_counter(), "_cpu0": time.process_time(),
+                  "_rss0": get_peak_rss()}
+        if parent is None:
+            self._local.finished = [] # records of this top-level stage (and its nested stages)
+        self.stack.append(record)
+        return record
+
+    def end_stage(self, record):
+        """ close the given stage, store it and write the night log if top-level """
+        record.update(self.get_elapsed(record))
+        if record in self.stack:
+            self.stack.remove(record)
+        for key in ["_t0", "_cpu0", "_rss0"]:
+            record.pop(key)
+        with self._lock:
+            self.records.append(record)
+        finished = getattr(self._local, "finished", [])
+        finished.append(record)
+
+        if record["depth"] == 0:
+            self._local.finished = []
+            if record["date"] is not None and self._side_properties["write_log"]:
+                try:
+                    self.writeto_night(record["date"], finished)
+                except (IOError, OSError) as e:
+                    warnings.warn("Cannot write the performance log of %s: %s"%(record["date"], e))
+
+    # --------- #
+    #  GETTER   #
+    # --------- #
+    def get_elapsed(self, record):
+        """ wall time [s], cpu time [s], process peak RSS [MB] and its increase
+        since the stage started (delta_rss, see the module doc) of a (running) stage """
+        peak_rss = get_peak_rss()
+        return {"wall": time.perf_counter() - record["_t0"],
+                "cpu":  time.process_time() - record["_cpu0"],
+                "peak_rss": peak_rss,
+                "delta_rss": None if peak_rss is None else peak_rss - record["_rss0"]}
+
+    def get_records(self, stage=None, date=None):
+        """ list of the (last max_records) finished records
+        (optionally only those of a given stage and/or date) """
+        with self._lock:
+            records = list(self.records)
+        return [r for r in records
+                    if (stage is None or r["stage"]==stage) and (date is None or r["date"]==date)]
+
+    def to_header(self, header):
+        """ Store the timings of the stages currently running in this thread in the given (fits) header.
+
+        Stage of depth i is stored in PERFNi (name), PERFWi (wall [s]),
+        PERFCi (cpu [s]) and PERFMi (peak RSS [MB]).
+
+        Returns
+        -------
+        header
+        """
+        for record in self.stack:
+            elapsed = self.get_elapsed(record)
+            depth   = record["depth"]
+            header["PERFN%d"%depth] = (record["stage"], "pipeline stage")
+            header["PERFW%d"%depth] = (round(elapsed["wall"],3), "[s] wall time of %s"%record["stage"])
+            header["PERFC%d"%depth] = (round(elapsed["cpu"],3), "[s] cpu time of %s"%record["stage"])
+            if elapsed["peak_rss"] is not None:
+                header["PERFM%d"%depth] = (round(elapsed["peak_rss"],1), "[MB] peak RSS during %s"%record["stage"])
+        return header
+
+    # --------- #
+    #  I/O      #
+    # --------- #
+    def writeto_night(self, date, records):
+        """ append the given records to the night JSON-lines and CSV performance logs.
+        The logs are only appended to, under an exclusive lock of the JSON-lines file
+        (threads of this process and other processes wait for each other).
+        """
+        import io as io_
+        import csv
+        from .. import io
+        logroot = io.get_datapath(date)+"%s_%s"%(date, PERFLOG_ROOT)
+        
+        lines = "".join([json.dumps(record, default=str)+"\n" for record in records])
+        csvbuffer = io_.StringIO()
+        writer = csv.DictWriter(csvbuffer, fieldnames=CSV_COLUMNS)
+        for record in records:
+            writer.writerow({**record, "info":json.dumps(record["info"], default=str)})
+            
+        with self._lock, open(logroot+".jsonl", "a") as f_:
+            _lock_file_(f_)
+            try:
+                f_.write(lines)
+                f_.flush()
+                new_file = not os.path.isfile(logroot+".csv") or os.path.getsize(logroot+".csv")==0
+                with open(logroot+".csv", "a") as fcsv_:
+                    if new_file:
+                        csv.DictWriter(fcsv_, fieldnames=CSV_COLUMNS).writeheader()
+                    fcsv_.write(csvbuffer.getvalue())
+            finally:
+                _unlock_file_(f_)
+
+    # =================== #
+    #   Properties        #
+    # =================== #
+    @property
+    def records(self):
+        """ last finished stage records (deque of at most max_records) """
+        if self._properties["records"] is None:
+            self._properties["records"] = deque(maxlen=self._side_properties["max_records"])
+        return self._properties["records"]
+
+    @property
+    def runid(self):
+        """ identifier of the run """
+        return self._side_properties["runid"]
+
+    @property
+    def stack(self):
+        """ stages currently running in this thread """
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @property
+    def _local(self):
+        """ per-thread state (running stages) """
+        return self._derived_properties["local"]
+
+    @property
+    def _lock(self):
+        """ lock of the records and of the log writing """
+        return self._derived_properties["lock"]
+
+
+def _lock_file_(f_):
+    """ exclusive (blocking) lock of an opened file, if supported """
+    try:
+        import fcntl
+    except ImportError:
+        return
+    fcntl.flock(f_.fileno(), fcntl.LOCK_EX)
+
+def _unlock_file_(f_):
+    """ """
+    try:
+        import fcntl
+    except ImportError:
+        return
+    fcntl.flock(f_.fileno(), fcntl.LOCK_UN)
+
+
+_REGISTRY      = None
+_REGISTRY_LOCK = threading.Lock()
@@ -0,0 +1,473 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Synthetic SEDM nights.
+
+This module builds a self-consistent fake night (dome, arcs and science ccds)
+with a known ground truth so the pipeline stages, from `build_tracematcher`
+to `extract_star`, can be timed and validated without real data.
+
+Example
+-------
+```
+from pysedm.utils.simulation import simulate_night
+sim = simulate_night("20000101", nscience=2, hexradius=8)
+# sim.reduxpath is now the SEDMREDUXPATH and sim.truth the ground truth
+```
+"""
+
+import os
+import warnings
+import numpy             as np
+from scipy.special       import erf
+from propobject          import BaseObject
+
+from ..sedm              import SEDM_CCD_SIZE, TRACE_DISPERSION, IFU_SCALE_UNIT, \
+     MLA_ROTMATRIX, DEFAULT_REFLBDA
+from ..wavesolution      import LINES, REFWAVELENGTH, SODIUM_SKYLINE_LBDA
+
+__all__ = ["simulate_night", "NightSimulator"]
+
+# ------------------ #
+#  Default Geometry  #
+# ------------------ #
+# Pixel position of a wavelength along a trace with respect to its position at REFWAVELENGTH
+# (polynomial in lbda-REFWAVELENGTH, like the WaveSolution). Fitted on the LINES "mu" entries.
+SIM_DISPERSION_COEFS = [7.84150816e-10, -3.29932906e-06, 3.07903821e-02, 0]
+SIM_LBDA_RANGE       = [3600, 9500]
+# Hexagonal lattice of the lenslets on the CCD (in pixels / degrees).
+# Chosen such that traces do not overlap up to hexradius=15
+SIM_LATTICE_SPACING  = 58.
+SIM_LATTICE_ROTATION = 25.25
+SIM_TRACE_TILT       = 0.2 # degree
+SIM_ARCLINE_WIDTH    = 1.0 # pixel (sigma)
+_COLUMN_OFFSETS      = np.arange(-72, 178)
+_PROFILE_HALFWIDTH   = 5
+
+
+def simulate_night(date="20000101", reduxpath=None, nscience=2, hexradius=10,
+                   lamps=["Hg","Cd","Xe"], noise=True, seed=None,
+                   set_environ=True, **kwargs):
+    """ Build and write a synthetic SEDM night.
+
+    Parameters
+    ----------
+    date: [string] -optional-
+        YYYYMMDD of the fake night.
+
+    reduxpath: [string/None] -optional-
+        Directory used as SEDMREDUXPATH. A temporary one is created if None.
+
+    nscience: [int] -optional-
+        Number of science ccds. The first one is a standard star.
+
+    hexradius: [int] -optional-
+        Radius (in lenslets) of the hexagonal IFU.
+        10 means 331 traces, 15 means 721 traces.
+
+    lamps: [list of string] -optional-
+        Arc lamps to simulate (should be keys of wavesolution.LINES)
+
+    noise: [bool] -optional-
+        Add poisson and read noise to the ccds.
+
+    seed: [int/None] -optional-
+        Seed of the random generator.
+
+    set_environ: [bool] -optional-
+        Set the SEDMREDUXPATH environment variable and pysedm.io.REDUXPATH
+        such that the pipeline reads the fake night.
+
+    **kwargs goes to NightSimulator.write_night()
+
+    Returns
+    -------
+    NightSimulator
+    """
+    sim = NightSimulator(date, reduxpath=reduxpath, hexradius=hexradius, seed=seed)
+    sim.write_night(nscience=nscience, lamps=lamps, noise=noise, **kwargs)
+    if set_environ:
+        sim.set_environ()
+    return sim
+
+
+class NightSimulator( BaseObject ):
+    """ Simulate the SEDM ccds of a night with a known ground truth. """
+    PROPERTIES         = ["date", "reduxpath", "hexradius"]
+    SIDE_PROPERTIES    = ["rng"]
+    DERIVED_PROPERTIES = ["qr", "trace_ref", "throughput", "truth"]
+
+    def __init__(self, date, reduxpath=None, hexradius=10, seed=None):
+        """ """
+        self._properties["date"] = date
+        self.set_reduxpath(reduxpath)
+        self._side_properties["rng"] = np.random.default_rng(seed)
+        self.build_lattice(hexradius)
+
+    # =================== #
+    #   Methods           #
+    # =================== #
+    # --------- #
+    #  SETTER   #
+    # --------- #
+    def set_reduxpath(self, reduxpath=None):
+        """ Directory containing the night directory. A temporary one is created if None """
+        if reduxpath is None:
+            import tempfile
+            reduxpath = tempfile.mkdtemp(prefix="sedmsim_")
+        self._properties["reduxpath"] = reduxpath
+        if not os.path.isdir(self.nightpath):
+            os.makedirs(self.nightpath)
+
+    def set_environ(self):
+        """ Set SEDMREDUXPATH and pysedm.io.REDUXPATH to the simulated reduxpath """
+        from .. import io
+        os.environ["SEDMREDUXPATH"] = self.reduxpath
+        io.REDUXPATH = self.reduxpath
+
+    def build_lattice(self, hexradius):
+        """ Build the (q,r) lenslet lattice and the CCD position of each trace
+        (at REFWAVELENGTH) and the relative throughput of each trace.
+        """
+        q, r = np.mgrid[-hexradius:hexradius+1,-hexradius:hexradius+1]
+        q, r = q.ravel(), r.ravel()
+        flagin = np.max(np.abs([q, r, -q-r]), axis=0) <= hexradius
+        q, r = q[flagin], r[flagin]
+
+        u, v = q + r/2., r*np.sqrt(3)/2.
+        theta = SIM_LATTICE_ROTATION*np.pi/180
+        x = SIM_LATTICE_SPACING * (np.cos(theta)*u - np.sin(theta)*v)
+        y = SIM_LATTICE_SPACING * (np.sin(theta)*u + np.cos(theta)*v)
+        # - Center the trace footprint on the CCD
+        x += (SEDM_CCD_SIZE[0] - (x.min()+_COLUMN_OFFSETS[0]) - (x.max()+_COLUMN_OFFSETS[-1]))/2.
+        y += SEDM_CCD_SIZE[1]/2. - (y.min()+y.max())/2.
+        if x.min()+_COLUMN_OFFSETS[0] < 0 or x.max()+_COLUMN_OFFSETS[-1] >= SEDM_CCD_SIZE[0] or \
+          y.min()<_PROFILE_HALFWIDTH or y.max() >= SEDM_CCD_SIZE[1]-_PROFILE_HALFWIDTH:
+            raise ValueError("hexradius=%d is too large, the traces do not fit in the CCD"%hexradius)
+        if hexradius>15:
+            warnings.warn("hexradius>15, simulated traces will overlap")
+
+        self._properties["hexradius"] = hexradius
+        self._derived_properties["qr"] = np.asarray([q, r]).T
+        self._derived_properties["trace_ref"] = np.asarray([x, y]).T
+        self._derived_properties["throughput"] = self.rng.uniform(0.9, 1.1, len(q))
+        self._derived_properties["truth"] = None
+
+    # --------- #
+    #  GETTER   #
+    # --------- #
+    def lbda_to_i(self, lbda, di=0):
+        """ CCD i-position of the given wavelength(s) for every trace.
+        (ntraces, nlbda) """
+        return (self.trace_ref[:,0] + di)[:,None] - \
+          np.polyval(SIM_DISPERSION_COEFS, np.atleast_1d(lbda)-REFWAVELENGTH)[None,:]
+
+    def get_columns(self, di=0):
+        """ Columns covered by each trace and their central wavelength and
+        pixel size in Angstrom (NaN outside SIM_LBDA_RANGE).
+
+        Returns
+        -------
+        columns, lbda, dlbda (each ntraces x ncolumns)
+        """
+        columns = np.floor(self.trace_ref[:,0]+di).astype(int)[:,None] + _COLUMN_OFFSETS[None,:]
+        pixels  = (self.trace_ref[:,0]+di)[:,None] - columns
+        lbdagrid = np.linspace(SIM_LBDA_RANGE[0], SIM_LBDA_RANGE[1], 1000)
+        pixgrid  = np.polyval(SIM_DISPERSION_COEFS, lbdagrid-REFWAVELENGTH)
+        lbda     = np.interp(pixels, pixgrid, lbdagrid, left=np.nan, right=np.nan)
+        dlbda    = 1./np.polyval(np.polyder(SIM_DISPERSION_COEFS), lbda-REFWAVELENGTH)
+        return columns, lbda, dlbda
+
+    def get_trace_vertices(self, width=None):
+        """ Polygon vertices of the traces, in the TraceMatch format [(4,2),...]. """
+        if width is None:
+            width = 2*TRACE_DISPERSION
+        imin, imax = self.lbda_to_i(SIM_LBDA_RANGE).T[::-1]
+        jmin, jmax = [self.trace_ref[:,1] + np.tan(SIM_TRACE_TILT*np.pi/180)*(i_-self.trace_ref[:,0])
+                          for i_ in [imin, imax]]
+        return [np.asarray([[i0,j0+width],[i1,j1+width],[i1,j1-width],[i0,j0-width]])
+                    for i0,i1,j0,j1 in zip(imin-1, imax+1, jmin, jmax)]
+
+    def get_tracematch(self, width=None, build_masks=False, **kwargs):
+        """ TraceMatch built on the true trace vertices (bypassing the dome sep extraction).
+
+        Parameters
+        ----------
+        build_masks: [bool] -optional-
+            load the trace masks (spectralmatching.load_trace_masks, **kwargs goes there)
+
+        Returns
+        -------
+        TraceMatch
+        """
+        from ..spectralmatching import TraceMatch, load_trace_masks
+        tmatch = TraceMatch()
+        tmatch.set_trace_vertices(self.get_trace_vertices(width=width))
+        if build_masks:
+            load_trace_masks(tmatch, **kwargs)
+        return tmatch
+
+    def get_wavesolution(self):
+        """ WaveSolution containing the true dispersion relation of every trace """
+        from ..wavesolution import WaveSolution
+        wsol = WaveSolution()
+        for traceindex, i_ref in enumerate(self.trace_ref[:,0]):
+            # WaveSolution pixels are counted from the right side of the CCD.
+            coefs = np.asarray(SIM_DISPERSION_COEFS, dtype="float")
+            coefs[-1] = (SEDM_CCD_SIZE[0]-1) - i_ref
+            wsol.add_trace_wavesolution(traceindex, {"wavesolution":coefs, "usedlines":None,
+                                                     "fit_linepos":None, "fit_linepos.err":None})
+        return wsol
+
+    def get_source_position(self, lbda, xref=0, yref=0, airmass=1.2, parangle=0,
+                                temperature=10, relathumidity=30, pressure=630,
+                                lbdaref=DEFAULT_REFLBDA):
+        """ IFU position (in lenslet unit) of a point source as a function of wavelength
+        (see SEDMCube.get_source_position) """
+        from pyifu.adr import get_adr
+        adr = get_adr(airmass=airmass, parangle=parangle, temperature=temperature,
+                      relathumidity=relathumidity, pressure=pressure, lbdaref=lbdaref)
+        lbda = np.asarray(lbda, dtype="float")
+        x_default, y_default = np.reshape(adr.refract(0, 0, np.ravel(lbda), unit=IFU_SCALE_UNIT), (2,)+lbda.shape)
+        x, y = np.tensordot(MLA_ROTMATRIX, np.asarray([x_default, y_default]), axes=1)
+        return x+xref, y+yref
+
+    # --------- #
+    #  CCDs     #
+    # --------- #
+    def render(self, flux, di=0, dj=0, columns=None):
+        """ Project the trace fluxes on the CCD.
+
+        Parameters
+        ----------
+        flux: [array]
+            (ntraces, ncolumns) flux of each trace in each of its columns
+            (see get_columns()).
+
+        di, dj: [float] -optional-
+            flexure offset (in pixel) of the traces.
+
+        Returns
+        -------
+        2D array [j,i]
+        """
+        if columns is None:
+            columns = self.get_columns(di)[0]
+        jc = (self.trace_ref[:,1] + dj)[:,None] + \
+          np.tan(SIM_TRACE_TILT*np.pi/180)*(columns - (self.trace_ref[:,0]+di)[:,None])
+        rows = np.round(jc).astype(int)[...,None] + np.arange(-_PROFILE_HALFWIDTH, _PROFILE_HALFWIDTH+1)
+        norm = np.sqrt(2)*TRACE_DISPERSION
+        weights = 0.5*(erf((rows+0.5-jc[...,None])/norm) - erf((rows-0.5-jc[...,None])/norm))
+
+        flagin = (rows>=0) & (rows<SEDM_CCD_SIZE[1]) & (columns>=0)[...,None] & (columns<SEDM_CCD_SIZE[0])[...,None]
+        flatindex = (rows*SEDM_CCD_SIZE[0] + columns[...,None])[flagin]
+        values    = (np.nan_to_num(flux)[...,None]*weights)[flagin]
+        return np.bincount(flatindex, weights=values,
+                               minlength=SEDM_CCD_SIZE[0]*SEDM_CCD_SIZE[1]).reshape(SEDM_CCD_SIZE[1],SEDM_CCD_SIZE[0])
+
+    def get_lines_flux(self, lines, amplitudes, di=0, width=SIM_ARCLINE_WIDTH):
+        """ (ntraces, ncolumns) flux of emission lines (pixel-integrated gaussians) """
+        columns = self.get_columns(di)[0]
+        i_lines = self.lbda_to_i(lines, di=di)
+        norm    = np.sqrt(2)*width
+        delta   = columns[...,None] - i_lines[:,None,:]
+        return np.sum(0.5*(erf((delta+0.5)/norm)-erf((delta-0.5)/norm))*np.asarray(amplitudes), axis=-1)
+
+    def get_ccd_background(self, level=20, bump=30):
+        """ Smooth scattered-light background of the CCD """
+        j, i = np.mgrid[0:SEDM_CCD_SIZE[1], 0:SEDM_CCD_SIZE[0]]/float(SEDM_CCD_SIZE[0])
+        return level*(1 + 0.2*i - 0.1*j) + bump*np.exp(-((i-0.55)**2+(j-0.5)**2)/(2*0.25**2))
+
+    def get_dome(self, level=2e4, lbda_peak=6800, lbda_width=1500):
+        """ Dome-flat ccd (smooth lamp spectrum times the trace throughput) """
+        _, lbda, _ = self.get_columns()
+        flux = level*self.throughput[:,None]*np.exp(-0.5*((lbda-lbda_peak)/lbda_width)**2)
+        return self.render(flux)
+
+    def get_arc(self, lamp, level=2e3):
+        """ Arc-lamp ccd using the lines of wavesolution.LINES[lamp] """
+        lines = np.asarray(list(LINES[lamp].keys()))
+        amplitudes = np.asarray([LINES[lamp][l_]["ampl"] for l_ in lines])
+        return self.render(level*self.throughput[:,None]*self.get_lines_flux(lines, amplitudes))
+
+    def get_science(self, source_xy=[0,0], source_amplitude=5e3, source_slope=-2,
+                        seeing=1.5, sky_level=1., sodium_amplitude=200.,
+                        di=0, dj=0, background=None, **kwargs):
+        """ Science ccd with a point source (with ADR), a sky continuum,
+        the sodium sky line and a smooth ccd background.
+
+        Parameters
+        ----------
+        source_xy: [float, float] -optional-
+            IFU position (lenslet unit) of the source at DEFAULT_REFLBDA.
+
+        source_amplitude, source_slope: [float] -optional-
+            The source spectrum is source_amplitude*(lbda/DEFAULT_REFLBDA)**source_slope
+            (counts per Angstrom)
+
+        seeing: [float] -optional-
+            FWHM in arcsec at DEFAULT_REFLBDA (scales as lbda**-0.2)
+
+        di, dj: [float] -optional-
+            Flexure offset of the traces in ccd pixels.
+
+        background: [dict/None] -optional-
+            kwargs of get_ccd_background(). None means default.
+
+        **kwargs goes to get_source_position() (airmass, parangle...)
+
+        Returns
+        -------
+        2D array, dict (truth)
+        """
+        _, lbda, dlbda = self.get_columns(di)
+        u, v = self.lenslet_xy.T
+
+        xs, ys = self.get_source_position(lbda, *source_xy, **kwargs)
+        sigma  = seeing/2.355/IFU_SCALE_UNIT*(lbda/DEFAULT_REFLBDA)**(-0.2)
+        spaxel_fraction = np.sqrt(3)/2./(2*np.pi*sigma**2) * \
+          np.exp(-0.5*((u[:,None]-xs)**2+(v[:,None]-ys)**2)/sigma**2)
+        source = source_amplitude*(lbda/DEFAULT_REFLBDA)**source_slope
+        flux   = (source*spaxel_fraction + sky_level)*dlbda \
+          + self.get_lines_flux([SODIUM_SKYLINE_LBDA], [sodium_amplitude], di=di)
+
+        data = self.render(self.throughput[:,None]*flux, di=di, dj=dj) + \
+          self.get_ccd_background(**({} if background is None else background))
+
+        lbda_truth = np.linspace(SIM_LBDA_RANGE[0], SIM_LBDA_RANGE[1], 300)
+        truth = {"flexure":{"i":di,"j":dj},
+                 "source_xy_ref":source_xy, "lbdaref":DEFAULT_REFLBDA,
+                 "source_trajectory":np.asarray([lbda_truth]+list(self.get_source_position(lbda_truth, *source_xy, **kwargs))),
+                 "source_spectrum":np.asarray([lbda_truth, source_amplitude*(lbda_truth/DEFAULT_REFLBDA)**source_slope]),
+                 "seeing":seeing, "sky_level":sky_level, "sodium_amplitude":sodium_amplitude,
+                 "adr":kwargs}
+        return data, truth
+
+    # --------- #
+    #  I/O      #
+    # --------- #
+    def add_noise(self, data, readnoise=5.):
+        """ poisson + gaussian read noise """
+        return self.rng.poisson(np.clip(data,0,None)).astype("float") + self.rng.normal(0, readnoise, np.shape(data))
+
+    def writeto(self, data, filename, header=None, noise=True):
+        """ Write a ccd in the night directory and returns its full path """
+        from astropy.io import fits
+        if noise:
+            data = self.add_noise(data)
+        hdu = fits.PrimaryHDU(np.asarray(data, dtype="float32"))
+        hdu.header["SIMULATE"] = (True, "pysedm synthetic night")
+        for k,v in (header if header is not None else {}).items():
+            hdu.header[k] = v
+        fullpath = self.nightpath+filename
+        hdu.writeto(fullpath, overwrite=True)
+        return fullpath
+
+    def write_night(self, nscience=2, lamps=["Hg","Cd","Xe"], noise=True,
+                        flexure_scale=1.5, airmass_range=[1.05, 1.8], mjd_start=51544.15):
+        """ Write the dome, arcs and science ccds of the night
+        as well as the ground truth (`<date>_SimTruth.pkl`)
+
+        Parameters
+        ----------
+        flexure_scale: [float] -optional-
+            Maximum (absolute) i and j flexure offset of the science ccds.
+
+        Returns
+        -------
+        dict (truth)
+        """
+        from .tools import dump_pkl
+        truth = {"date":self.date, "hexradius":self.hexradius,
+                 "traceindexes":np.arange(self.ntraces), "qr":self.qr, "lenslet_xy":self.lenslet_xy,
+                 "trace_ref":self.trace_ref, "refwavelength":REFWAVELENGTH,
+                 "dispersion_coefs":np.asarray(SIM_DISPERSION_COEFS), "lbda_range":SIM_LBDA_RANGE,
+                 "trace_tilt":SIM_TRACE_TILT, "trace_dispersion":TRACE_DISPERSION,
+                 "trace_vertices":self.get_trace_vertices(), "throughput":self.throughput,
+                 "lamps":{}, "science":{}}
+
+        self.writeto(self.get_dome(), "dome.fits", noise=noise,
+                    header={"OBJECT":"Calib: dome", "NAME":"Calib: dome", "EXPTIME":10., "MJD_OBS":mjd_start-0.1})
+        for lamp in lamps:
+            self.writeto(self.get_arc(lamp), "%s.fits"%lamp, noise=noise,
+                    header={"OBJECT":"Calib: %s"%lamp, "NAME":"Calib: %s"%lamp, "EXPTIME":60., "MJD_OBS":mjd_start-0.1})
+            truth["lamps"][lamp] = {l_:LINES[lamp][l_]["ampl"] for l_ in LINES[lamp].keys()}
+
+        for i in range(nscience):
+            name   = "STD-SIM%d"%i if i==0 else "SIM%d"%i
+            mjd    = mjd_start + i*0.02
+            obsprop = dict(airmass=self.rng.uniform(*airmass_range), parangle=self.rng.uniform(-180,180),
+                           temperature=self.rng.uniform(5,15), relathumidity=self.rng.uniform(10,60))
+            data, truth_ = self.get_science(source_xy=self.rng.uniform(-self.hexradius/3., self.hexradius/3., 2),
+                                            di=self.rng.uniform(-flexure_scale,flexure_scale),
+                                            dj=self.rng.uniform(-flexure_scale,flexure_scale),
+                                            **obsprop)
+            filename = "crr_b_ifu%s_%s.fits"%(self.date, "%02d_%02d_%02d"%(3+i//60, i%60, 0))
+            self.writeto(data, filename, noise=noise,
+                         header={"OBJECT":name, "NAME":name, "EXPTIME":300., "MJD_OBS":mjd,
+                                 "AIRMASS":obsprop["airmass"], "TEL_PA":obsprop["parangle"],
+                                 "IN_AIR":obsprop["temperature"], "IN_HUM":obsprop["relathumidity"]})
+            truth["science"][filename] = truth_
+
+        dump_pkl(truth, self.nightpath+"%s_SimTruth.pkl"%self.date)
+        self._derived_properties["truth"] = truth
+        return truth
+
+    # =================== #
+    #   Properties        #
+    # =================== #
+    @property
+    def date(self):
+        """ YYYYMMDD of the simulated night """
+        return self._properties["date"]
+
+    @property
+    def reduxpath(self):
+        """ Directory to be used as SEDMREDUXPATH """
+        return self._properties["reduxpath"]
+
+    @property
+    def nightpath(self):
+        """ Directory containing the night files """
+        return self.reduxpath+"/%s/"%self.date
+
+    @property
+    def hexradius(self):
+        """ Radius (in lenslet) of the hexagonal IFU """
+        return self._properties["hexradius"]
+
+    @property
+    def rng(self):
+        """ numpy random Generator """
+        return self._side_properties["rng"]
+
+    @property
+    def qr(self):
+        """ (q,r) lattice coordinates of the traces """
+        return self._derived_properties["qr"]
+
+    @property
+    def lenslet_xy(self):
+        """ IFU positions (in lenslet unit) of the traces """
+        q, r = self.qr.T
+        return np.asarray([q + r/2., r*np.sqrt(3)/2.]).T
+
+    @property
+    def trace_ref(self):
+        """ (i,j) CCD position of the traces at REFWAVELENGTH """
+        return self._derived_properties["trace_ref"]
+
+    @property
+    def ntraces(self):
+        """ number of simulated traces """
+        return len(self.qr)
+
+    @property
+    def throughput(self):
+        """ relative transmission of the traces (what the flat should recover) """
+        return self._derived_properties["throughput"]
+
+    @property
+    def truth(self):
+        """ Ground truth of the written night (see write_night()) """
+        return self._derived_properties["truth"]
@@ -3,9 +3,35 @@
 
 """ Internal small toolbox"""
 
+import os
 import numpy as np
 
-__all__ = ["kwargs_update","shape_ajustment", "is_arraylike"]
+__all__ = ["kwargs_update","shape_ajustment", "is_arraylike", "set_precision", "get_dtype"]
+
+# Floating precision of the image-sized arrays (ccd, variance, background, trace masks, cubes).
+# Least-square accumulations stay in float64. Environment variable such that worker processes inherit it.
+PRECISIONS = ["float64", "float32"]
+
+def set_precision(precision):
+    """ Set the pipeline floating precision of the image-sized arrays and cubes.
+
+    Parameters
+    ----------
+    precision: [string]
+        float64 (default) or float32 (half the memory and file sizes).
+        This is stored in the PYSEDM_PRECISION environment variable.
+
+    Returns
+    -------
+    Void
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("precision must be one of %s, %s given"%(PRECISIONS, precision))
+    os.environ["PYSEDM_PRECISION"] = precision
+
+def get_dtype():
+    """ numpy dtype of the image-sized arrays (see set_precision) """
+    return np.dtype(os.getenv("PYSEDM_PRECISION", default="float64"))
 
 
 def kwargs_update(default,**kwargs):
@@ -54,6 +80,30 @@ def is_arraylike(a):
     return isinstance(a, (list, tuple, np.ndarray) )
 
 
+def polyval_rows(coefs, x):
+    """ Evaluate a set of polynomials, one per row of `coefs`, at once.
+
+    Parameters
+    ----------
+    coefs: [2d-array]
+        (n, degree+1) polynomial coefficients in decreasing powers (as np.polyval)
+
+    x: [array]
+        values where to evaluate the polynomials. The first axis must have the
+        length n (or 1), such that out[k] = np.polyval(coefs[k], x[k])
+
+    Returns
+    -------
+    array
+    """
+    coefs = np.asarray(coefs, dtype="float")
+    x     = np.asarray(x, dtype="float")
+    shape = (len(coefs),) + (1,)*(np.ndim(x)-1)
+    out   = np.zeros(np.broadcast(x, coefs[:,0].reshape(shape)).shape)
+    for c in coefs.T:
+        out = out*x + c.reshape(shape)
+    return out
+
 def fig_backend_test(backup='Agg'):
     """ """
     try:
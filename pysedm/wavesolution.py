@@ -5,9 +5,7 @@
 
 import warnings
 import numpy as np
-import matplotlib.pyplot as mpl
 from scipy         import optimize
-from astropy.utils.console import ProgressBar
 
 try:
     from pynverse import inversefunc
@@ -21,6 +19,7 @@ from pyifu.spectroscopy      import Spectrum
 
 # - Internal Modules
 from .ccd import CCD
+from .utils.tools import polyval_rows
 
 # Vacuum wavelength
 # from KECK https://www2.keck.hawaii.edu/inst/lris/arc_calibrations.html
@@ -171,12 +170,31 @@ def get_arcspectrum(x, y, databound, dy=None, name=None):
     spec.set_databounds(*databound)
     return spec
 
-def get_arccollection(traceindex, lamps):
-    """ """
+def get_arccollection(traceindex, lamps, spectra=None):
+    """ Build the ArcSpectrumCollection of the given trace.
+
+    Parameters
+    ----------
+    traceindex: [int]
+        index of the trace
+
+    lamps: [list of CCD]
+        lamp ccds (with tracematch) from which the arcspectra are extracted.
+
+    spectra: [list of array] -optional-
+        already extracted (and pixel-flipped) spectra, one per lamp. 
+        If None, they are extracted here using lamp.get_spectrum().
+        (see get_arccollections() to extract many traces at once)
+
+    Returns
+    -------
+    ArcSpectrumCollection
+    """
     sol_ = ArcSpectrumCollection()
-    
-    for lamp in lamps:
-        spec_ = lamp.get_spectrum(traceindex, on="data")[::-1]
+    if spectra is None:
+        spectra = [lamp.get_spectrum(traceindex, on="data")[::-1] for lamp in lamps]
+        
+    for lamp, spec_ in zip(lamps, spectra):
         lbda_ = np.arange(len(spec_))
         sol_.add_arcspectrum( get_arcspectrum(x=lbda_, y=spec_,
                                             databound= np.sort(len(spec_) - lamp.tracematch.get_trace_xbounds(traceindex)),
@@ -184,6 +202,20 @@ def get_arccollection(traceindex, lamps):
     sol_.set_databounds(*np.sort(len(spec_) - lamp.tracematch.get_trace_xbounds(traceindex)))
     return sol_
 
+def get_arccollections(traceindexes, lamps):
+    """ Build the ArcSpectrumCollections of many traces at once.
+    
+    Each lamp is extracted only once for all the traces (see CCD.get_spectra) 
+    and the collections are built on views of these extracted spectra.
+
+    Returns
+    -------
+    list of ArcSpectrumCollection (same order as traceindexes)
+    """
+    spectra = [lamp.get_spectra(traceindexes, on="data")[:,::-1] for lamp in lamps]
+    return [get_arccollection(traceindex, lamps, spectra=[spec_[i] for spec_ in spectra])
+                for i, traceindex in enumerate(traceindexes)]
+
 # ==================== #
 #   Subprocessing      #
 # ==================== #
@@ -242,43 +274,25 @@ def fit_spaxel_wavelesolution(arccollection, sequential=True,
     arccollection.fit_wavelengthsolution(wavedegree, legendre=False)
     return arccollection
 
-def fit_wavesolution(lamps, indexes, multiprocess=True, notebook=False):
-    """ """
-    if notebook:
-        print("RUNNING FROM NOTEBOOK")
-        try:
-            return _fit_background_notebook_(lamps, indexes, multiprocess=True)
-        except:
-            warnings.warn("FAILING fit_background for notebooks")
-            
-    # Running from ipython/python    
-    arccollections = [get_arccollection(id_, lamps) for id_ in indexes]
-    
-    wsolutions = ProgressBar.map(fit_spaxel_wavelesolution,
-                                arccollections,
-                                multiprocess=multiprocess, step=2)
+def fit_wavesolution(lamps, indexes, multiprocess=True, notebook=False, nworkers=None):
+    """ Fit the wavelength solution (fit_spaxel_wavelesolution) of the given traces.
+    This uses the pipeline executor (see utils.executor).
+
+    Returns
+    -------
+    dict {traceindex: wavesolution data}
+    """
+    from .utils.executor import get_executor
+    arccollections = get_arccollections(indexes, lamps)
+    executor = get_executor(backend=None if multiprocess else "serial", nworkers=nworkers)
+    wsolutions = executor.imap(fit_spaxel_wavelesolution, arccollections,
+                               progress=True, notebook=notebook, ntasks=len(indexes))
     #  these are the wavesolutions
-    return {i_:wsol_.data for i_,wsol_ in zip(indexes, contval)}
+    return {i_:wsol_.data for i_,wsol_ in zip(indexes, wsolutions)}
 
 def _fit_wavesolution_notebook_(lamps, indexes, multiprocess=True):
-    """ """
-    arccollections = [get_arccollection(id_, lamps) for id_ in indexes]
-    
-    # - Multiprocessing 
-    if multiprocess:
-        bar = ProgressBar( len(indexes), ipython_widget=True)
-        import multiprocessing
-        p = multiprocessing.Pool()
-        res = {}
-        for j, result in enumerate( p.imap(fit_spaxel_wavelesolution, arccollections)):
-            res[indexes[j]] = result
-            bar.update(j)
-        bar.update(len(indexes))
-        return res
-    
-    # - No multiprocessing 
-    return {indexes[i_]: fit_spaxel_wavelesolution(arccollection)
-                for i_,arccollection in enumerate(arccollections)}
+    """ fit_wavesolution with an ipython widget progress bar """
+    return fit_wavesolution(lamps, indexes, multiprocess=multiprocess, notebook=True)
 
 
 ###########################
@@ -289,7 +303,7 @@ def _fit_wavesolution_notebook_(lamps, indexes, multiprocess=True):
 class Flexure( BaseObject ):
     """ """
     PROPERTIES = ["cube","mapper"]
-    DERIVED_PROPERTIES = ["fitvalues_sodiumlines"]
+    DERIVED_PROPERTIES = ["fitvalues_sodiumlines", "sodiumline_batch_difference"]
 
     def __init__(self, cube, mapper=None):
         """ """
@@ -323,10 +337,11 @@ class Flexure( BaseObject ):
         """
         mu_eff, mu_efferr = self.get_cube_sodiumline_wavelength(array=False)
         
-        ijs_eff  = self.mapper.get_lbda_ij(mu_eff)
-        ijs_reff = self.mapper.get_lbda_ij(sodium_reference)
-        delta_i  = [ijs_reff[traceindex][0]-ijs_eff[traceindex][0]
-                        for traceindex in self.mapper.traceindexes]
+        from .mapping import INVERTED_LBDA_X
+        # ccd-i are pixel-inverted with respect to the wavesolution pixels, hence eff-ref
+        i_eff, _ = self.mapper.traceindex_lbda_to_ij(self.mapper.traceindexes, mu_eff)
+        i_ref, _ = self.mapper.traceindex_lbda_to_ij(self.mapper.traceindexes, sodium_reference)
+        delta_i  = i_eff-i_ref if INVERTED_LBDA_X else i_ref-i_eff
         if not as_slice:
             return {i:d for i,d in zip(self.mapper.traceindexes, delta_i)}
 
@@ -400,21 +415,141 @@ class Flexure( BaseObject ):
             
         return nfit.fitvalues
     
+    def fit_sodiumlines_batch(self, lbda, fluxes, variances=None, sodium_reference=SODIUM_SKYLINE_LBDA,
+                                  lbda_buffer=400, degree=3):
+        """ fit the sodium line on many spectra at once.
+        Same model as fit_sodiumlines() (gaussian + polynomial continuum on the normalized
+        spectra) but all the spectra are fitted simultaneously by a single (block sparse)
+        scipy.optimize.least_squares call. The initial line position is the flux 
+        weighted centroid of the continuum subtracted spectra around the sodium line.
+
+        Parameters
+        ----------
+        lbda: [array]
+            wavelength [in angstrom] shared by all the spectra
+
+        fluxes, variances: [2d-array, 2d-array or None]
+            (nspectra, len(lbda)) fluxes and variances of the spectra
+
+        sodium_reference: [float] -optional-
+            wavelength of the sodium sky line. 
+
+        lbda_buffer: [float] -optional-
+            how many wavelength above and below the sodium_reference will be used for the fit.
+
+        degree: [int] -optional-
+            degree of the polynomial continuum.
+            
+        Returns
+        -------
+        list of dict (fitvalues, same keys as fit_sodiumlines)
+        """
+        from scipy import sparse
+        from scipy.optimize import least_squares
+        from scipy.stats import norm as normal
+        
+        flagin  = (lbda>=sodium_reference-lbda_buffer) * (lbda<=sodium_reference+lbda_buffer)
+        lbda_   = lbda[flagin]
+        flux_   = np.atleast_2d(fluxes)[:,flagin]
+        var_    = np.atleast_2d(variances)[:,flagin] if variances is not None else np.ones(flux_.shape)
+        nspec, nlbda = flux_.shape
+        # - normalization and masking
+        norm    = np.nanmean(flux_, axis=1)[:,None]
+        valid   = np.isfinite(flux_*var_)
+        data    = np.where(valid, flux_/norm, 0)
+        weights = np.where(valid, 1./np.sqrt(np.abs(var_)/norm**2*2), 0)
+        xpoly   = np.vander((lbda_-lbda_.mean())/(lbda_.max()-lbda_.min())*2, degree+1)
+        
+        # - parameters: ampl, mu, sig, a_degree...a_0 per spectrum
+        npar    = 3 + degree + 1
+        mu_bounds = [sodium_reference-lbda_buffer/2., sodium_reference+lbda_buffer/2.]
+        cont_   = np.nanmedian(np.where(valid, data, np.nan), axis=1)[:,None]
+        linewin = np.abs(lbda_-sodium_reference) < 50
+        excess  = np.clip(data - cont_, 0, None) * linewin
+        mu_guess= np.where(excess.sum(axis=1)>0, (excess*lbda_).sum(axis=1)/np.where(excess.sum(axis=1)>0,excess.sum(axis=1),1), sodium_reference)
+        guesses = np.zeros((nspec, npar))
+        guesses[:,0] = 100
+        guesses[:,1] = np.clip(mu_guess, *mu_bounds)
+        guesses[:,2] = 30
+        guesses[:,-1]= 1
+        lower   = np.tile(np.concatenate([[1, mu_bounds[0], 15], -np.inf*np.ones(degree+1)]), nspec)
+        upper   = np.tile(np.concatenate([[1000, mu_bounds[1], 50], np.inf*np.ones(degree+1)]), nspec)
+        
+        def model(params):
+            params = params.reshape(nspec, npar)
+            return params[:,0:1]*normal.pdf(lbda_, loc=params[:,1:2], scale=params[:,2:3]) + params[:,3:].dot(xpoly.T)
+        
+        def residuals(params):
+            return np.ravel((model(params)-data)*weights)
+        
+        sparsity = sparse.block_diag([np.ones((nlbda, npar))]*nspec)
+        res   = least_squares(residuals, np.ravel(guesses), bounds=(lower, upper),
+                              jac_sparsity=sparsity, method="trf", x_scale="jac")
+        
+        values = res.x.reshape(nspec, npar)
+        chi2   = np.sum(res.fun.reshape(nspec, nlbda)**2, axis=1)
+        jac    = res.jac.tocsr() if sparse.issparse(res.jac) else sparse.csr_matrix(res.jac)
+        names  = ["ampl0","mu0","sig0"] + ["a%d"%k for k in range(degree,-1,-1)]
+        fitvalues = []
+        for k in range(nspec):
+            jac_k = jac[k*nlbda:(k+1)*nlbda, k*npar:(k+1)*npar].toarray()
+            errors = np.sqrt(np.abs(np.diag(np.linalg.pinv(jac_k.T.dot(jac_k)))))
+            fv = {}
+            for name, v, err in zip(names, values[k], errors):
+                fv[name], fv[name+".err"] = v, err
+            fv["chi2"] = chi2[k]
+            fitvalues.append(fv)
+            
+        return fitvalues
+    
     def fit_cube_sodiumlines(self, sodium_reference=SODIUM_SKYLINE_LBDA,
-                                 nspaxels=50, averaging=20):
-        """ """
+                                 nspaxels=50, averaging=20, batch=True,
+                                 compare_to_sequential=False):
+        """ Fit the sodium sky line on `nspaxels` spectra, each being the average of `averaging`
+        of the faintest spaxels of the cube.
+
+        Parameters
+        ----------
+        batch: [bool] -optional-
+            Fit all the spectra at once (fit_sodiumlines_batch, fast).
+            Otherwise they are fitted one by one using fit_sodiumlines (modefit).
+
+        compare_to_sequential: [bool] -optional-
+            (if batch) also run the one-by-one fit and report the median absolute
+            difference between the two sodium line positions (stored as 
+            `sodiumline_batch_difference`)
+
+        Returns
+        -------
+        Void
+        """
         index_to_fit = np.asarray(self.cube.get_faintest_spaxels(nspaxels*averaging))
         np.random.shuffle(index_to_fit)
         self._indexes = index_to_fit.reshape(nspaxels,averaging)
-        self._derived_properties["fitvalues_sodiumlines"] = []
-        for index_ in self._indexes:
-            try:
-                fv = self.fit_sodiumlines(self.cube.get_spectrum(index_,"data"),
-                                          sodium_reference=sodium_reference, show=False)
-            except:
-                warnings.warn("FAILING the %i ")
-            self.fitvalues_sodiumlines.append(fv)
+        spectra = [self.cube.get_spectrum(index_,"data") for index_ in self._indexes]
+        
+        if not batch or compare_to_sequential:
+            fitvalues = []
+            for spec_ in spectra:
+                try:
+                    fv = self.fit_sodiumlines(spec_, sodium_reference=sodium_reference, show=False)
+                except:
+                    warnings.warn("FAILING to fit one of the sodium lines")
+                    fv = {"mu0":np.nan, "mu0.err":np.nan}
+                fitvalues.append(fv)
+            self._derived_properties["fitvalues_sodiumlines"] = fitvalues
+            if not batch:
+                return
+        
+        fitvalues = self.fit_sodiumlines_batch(spectra[0].lbda, [spec_.data for spec_ in spectra],
+                                    [spec_.variance for spec_ in spectra] if spectra[0].has_variance() else None,
+                                    sodium_reference=sodium_reference)
+        if compare_to_sequential:
+            mus_seq, _ = self.get_cube_sodiumline_wavelength(array=True)
+            self._derived_properties["sodiumline_batch_difference"] = np.nanmedian(np.abs(np.asarray([fv["mu0"] for fv in fitvalues]) - mus_seq))
             
+        self._derived_properties["fitvalues_sodiumlines"] = fitvalues
+        
     # --------- #
     #  PLOTTER  #
     # --------- #
@@ -481,6 +616,12 @@ class Flexure( BaseObject ):
             raise AttributeError("fitvalues_sodiumlines has not yet be derived. See the `fit_cube_sodiumlines()` method")
         return self._derived_properties["fitvalues_sodiumlines"]
 
+    @property
+    def sodiumline_batch_difference(self):
+        """ median absolute difference [in angstrom] between the batch and sequential sodium line fits
+        (see fit_cube_sodiumlines(compare_to_sequential=True)) """
+        return self._derived_properties["sodiumline_batch_difference"]
+
 ###########################
 #                         #
 #  WaveSolution           #
@@ -489,7 +630,7 @@ class Flexure( BaseObject ):
 class WaveSolution( BaseObject ):
     """ """
     PROPERTIES = ["lamps"]
-    DERIVED_PROPERTIES = ["wavesolutions","solutions"]
+    DERIVED_PROPERTIES = ["wavesolutions","solutions","arccollections"]
 
     # ================== #
     #  Main Methods      #
@@ -555,8 +696,10 @@ class WaveSolution( BaseObject ):
         -------
         None
         """
-         # <0.1s # with saved masks
-        wsol_ = get_arccollection(traceindex, [self.lampccds[i] for i in self.lampnames])
+        if traceindex in self.arccollections:
+            wsol_ = self.arccollections.pop(traceindex)
+        else:
+            wsol_ = get_arccollection(traceindex, [self.lampccds[i] for i in self.lampnames])
         # 3s 
         wsol_.fit_lineposition(contdegree=contdegree, sequential=sequential)
         # 0.01s
@@ -597,6 +740,91 @@ class WaveSolution( BaseObject ):
     def lbda_to_pixels(self, lbda, traceindex):
         """ Pick the requested spaxel and get the pixel that goes with the given wavelength [in angstrom] """
         return self.get_spaxel_wavesolution(traceindex).lbda_to_pixels(lbda)
+
+    def get_wavesolution_coefs(self, traceindexes):
+        """ Polynomial coefficients (decreasing powers) of the given traces
+        stacked in a single array. Lower degree solutions are zero-padded 
+        and unknown traces are set to NaN.
+
+        Returns
+        -------
+        2d-array (len(traceindexes), maxdegree+1)
+        """
+        coefs = [np.asarray(self.wavesolutions[i]["wavesolution"], dtype="float")
+                    if i in self.wavesolutions else None for i in traceindexes]
+        ncoefs = np.max([len(c) for c in coefs if c is not None]+[1])
+        table  = np.full((len(coefs), ncoefs), np.nan)
+        for k, c in enumerate(coefs):
+            if c is not None:
+                table[k] = 0
+                table[k, ncoefs-len(c):] = c
+        return table
+    
+    def lbda_to_pixels_array(self, lbda, traceindexes):
+        """ Vectorized version of lbda_to_pixels.
+        
+        Parameters
+        ----------
+        lbda, traceindexes: [float/array, int/array]
+            wavelength [in angstrom] and traceindexes. They are broadcasted 
+            against each other.
+
+        Returns
+        -------
+        array (NaN for traces without wavelength solution)
+        """
+        traceindexes, lbda = np.broadcast_arrays(traceindexes, np.asarray(lbda, dtype="float"))
+        uindexes, inverse  = np.unique(traceindexes, return_inverse=True)
+        coefs = self.get_wavesolution_coefs(uindexes)[np.ravel(inverse)]
+        return polyval_rows(coefs, np.ravel(lbda)-REFWAVELENGTH).reshape(lbda.shape)
+
+    def pixels_to_lbda_array(self, pixels, traceindexes, lbdarange=[3000,11000],
+                                 ngrid=100, niter=5):
+        """ Vectorized version of pixels_to_lbda.
+
+        The polynomial wavelength solutions are inverted numerically: a first guess
+        is interpolated on a wavelength grid and then refined using Newton iterations.
+        
+        Parameters
+        ----------
+        pixels, traceindexes: [float/array, int/array]
+            pixels and traceindexes. They are broadcasted against each other.
+
+        lbdarange: [float, float] -optional-
+            wavelength range [in angstrom] used for the first guess
+
+        ngrid: [int] -optional-
+            number of wavelength used for the first guess
+
+        niter: [int] -optional-
+            number of Newton iterations
+            
+        Returns
+        -------
+        array (NaN for traces without wavelength solution)
+        """
+        traceindexes, pixels = np.broadcast_arrays(traceindexes, np.asarray(pixels, dtype="float"))
+        uindexes, inverse    = np.unique(traceindexes, return_inverse=True)
+        inverse, pix_        = np.ravel(inverse), np.ravel(pixels)
+        
+        ucoefs  = self.get_wavesolution_coefs(uindexes)
+        dcoefs  = ucoefs[:,:-1]*np.arange(ucoefs.shape[1]-1, 0, -1)
+        # - First guess 
+        lgrid   = np.linspace(lbdarange[0], lbdarange[1], ngrid)-REFWAVELENGTH
+        pgrid   = polyval_rows(ucoefs, lgrid[None,:])
+        lbda_   = np.full(len(pix_), np.nan)
+        for k in np.unique(inverse):
+            if np.any(np.isnan(pgrid[k])):
+                continue
+            flagk = inverse==k
+            order = np.argsort(pgrid[k])
+            lbda_[flagk] = np.interp(pix_[flagk], pgrid[k][order], lgrid[order])
+            
+        # - Newton refinement
+        for _ in range(niter):
+            lbda_ = lbda_ - (polyval_rows(ucoefs[inverse], lbda_)-pix_)/polyval_rows(dcoefs[inverse], lbda_)
+
+        return (lbda_+REFWAVELENGTH).reshape(pixels.shape)
     
     # -------- #
     #  I/O     #
@@ -615,8 +843,45 @@ class WaveSolution( BaseObject ):
         
         self.wavesolutions[traceindex] = data
         self._solution[traceindex]     = SpaxelWaveSolution(data["wavesolution"], datafitted=[data["usedlines"], data["fit_linepos"], data['fit_linepos.err']])
-        
 
+    def add_pixel_offset(self, offsets):
+        """ Move the wavelength solutions along the (arc) pixel axis:
+        lbda_to_pixels(lbda) becomes lbda_to_pixels(lbda) + offset.
+
+        Remark: arc pixels run opposite to the ccd x-axis, so a trace moved by
+        +di on the ccd needs an offset of -di.
+
+        Parameters
+        ----------
+        offsets: [float or dict]
+            pixel offset applied to every trace, or {traceindex: offset}
+            (traces not in the dict are unchanged)
+
+        Returns
+        -------
+        Void
+        """
+        if not hasattr(offsets, "items"):
+            offsets = {traceindex: offsets for traceindex in self.traceindexes}
+
+        for traceindex, offset in offsets.items():
+            if traceindex not in self.wavesolutions or offset == 0:
+                continue
+            data = self.wavesolutions[traceindex].copy()
+            data["wavesolution"] = np.asarray(data["wavesolution"], dtype="float").copy()
+            data["wavesolution"][-1] += offset # decreasing powers: last is the constant term
+            if data["fit_linepos"] is not None:
+                data["fit_linepos"] = np.asarray(data["fit_linepos"], dtype="float") + offset
+            self.add_trace_wavesolution(traceindex, data, replace=True)
+
+    def load_arccollections(self, traceindexes):
+        """ Extract at once the arcspectra of the given traces for all the lamps.
+        
+        fit_wavelesolution() will then use (and release) these instead of
+        extracting the lamps trace by trace.
+        """
+        self.arccollections.update({traceindex: arccol for traceindex, arccol in 
+                                    zip(traceindexes, get_arccollections(traceindexes, [self.lampccds[i] for i in self.lampnames]))})
         
     def add_lampccd(self, lampccd, name=None):
         """ """
@@ -672,6 +937,13 @@ class WaveSolution( BaseObject ):
             self._derived_properties["wavesolutions"] = {}
         return self._derived_properties["wavesolutions"]
     @property
+    def arccollections(self):
+        """ dictionary containing the pre-extracted ArcSpectrumCollections (see load_arccollections) """
+        if self._derived_properties["arccollections"] is None:
+            self._derived_properties["arccollections"] = {}
+        return self._derived_properties["arccollections"]
+    
+    @property
     def _solution(self):
         """ WaveSolution object. use get_wavesolution() """
         if self._derived_properties["solutions"] is None:
@@ -777,6 +1049,7 @@ class SpaxelWaveSolution( BaseObject ):
     def show(self, ax=None, savefile=None, show=True, ecolor="0.3",
                  xrange=None, **kwargs):
         """ """
+        import matplotlib.pyplot as mpl
         from astrobject.utils.mpladdon import figout, errorscatter
         from astrobject.utils.tools    import kwargs_update
         
@@ -1455,6 +1728,7 @@ class ArcSpectrumCollection( VirtualArcSpectrum ):
                     fig=None, stampsloc="right", traceindex=None,
                         show_guesses=False, **kwargs):
         """ """
+        import matplotlib.pyplot as mpl
         from astrobject.utils.mpladdon import figout
         if fig is None:
             fig = mpl.figure(figsize=[10,5]) if stampsloc in ["left", "right"] \
@@ -1485,6 +1759,7 @@ class ArcSpectrumCollection( VirtualArcSpectrum ):
                            show_gaussian=True, show_guesses=False,
                            remove_xticks=False, **kwargs):
         """ """
+        import matplotlib.pyplot as mpl
         from astrobject.utils.mpladdon import figout
         if not self._sequentialfit:
             # - Non Sequential
@@ -1533,6 +1808,7 @@ class ArcSpectrumCollection( VirtualArcSpectrum ):
                                 show_legend=True, show_model=True,
                                 ecolor="0.3", xrange=None,**kwargs):
         """ """
+        import matplotlib.pyplot as mpl
         from astrobject.utils.mpladdon import figout, errorscatter
         from astrobject.utils.tools    import kwargs_update
         
@@ -38,7 +38,7 @@ if __name__ == "__main__":
     install_requires = check_dependencies()
 
     if _has_setuptools:
-        packages = find_packages()
+        packages = find_packages(exclude=["benchmarks", "benchmarks.*"])
         print(packages)
     else:
         # This should be updated if new submodules are added
@@ -63,7 +63,8 @@ if __name__ == "__main__":
                    "bin/extract_star.py",
                    "bin/cube_quality.py",
                    "bin/derive_wavesolution.py",
-                   "bin/quality_check.py"],
+                   "bin/quality_check.py",
+                   "bin/watch_night.py"],
           packages=packages,
           include_package_data=True,
           package_data={'pysedm': ['data/*.*']},
@@ -0,0 +1,53 @@
+""" Shared fixtures: a small simulated night (see pysedm.utils.simulation) """
+
+import pytest
+
+DATE      = "20000101"
+HEXRADIUS = 4          # 61 traces
+SEED      = 1234
+
+
+@pytest.fixture(scope="session")
+def simnight(tmp_path_factory):
+    """ NightSimulator whose dome, arcs and standard star ccds are written """
+    pytest.importorskip("pyifu")
+    from pysedm.utils.simulation import NightSimulator
+    sim = NightSimulator(DATE, reduxpath=str(tmp_path_factory.mktemp("simnight")),
+                         hexradius=HEXRADIUS, seed=SEED)
+    sim.write_night(nscience=1)
+    return sim
+
+@pytest.fixture(scope="session")
+def simtracematch(simnight):
+    """ TraceMatch built on the true vertices, with its masks """
+    pytest.importorskip("shapely")
+    return simnight.get_tracematch(build_masks=True, notebook=False)
+
+@pytest.fixture(scope="session")
+def simwavesolution(simnight):
+    """ true WaveSolution of the night """
+    return simnight.get_wavesolution()
+
+@pytest.fixture(scope="session")
+def simhexagrid(simtracematch):
+    """ HexagoneProjection of the traces """
+    return simtracematch.extract_hexgrid()
+
+@pytest.fixture
+def simccd(simnight, simtracematch):
+    """ ScienceCCD of the standard star (no background), with the tracematch attached """
+    from pysedm.ccd import get_ccd
+    ccd = get_ccd(simnight.nightpath+list(simnight.truth["science"].keys())[0],
+                  tracematch=simtracematch, background=0)
+    ccd.set_default_variance()
+    return ccd
+
+@pytest.fixture(scope="session")
+def simcube(simnight, simtracematch, simwavesolution, simhexagrid):
+    """ SEDMCube of the standard star (no flat, flexure or atmosphere correction) """
+    from pysedm.ccd import get_ccd
+    from pysedm.sedm import SEDM_LBDA
+    ccd = get_ccd(simnight.nightpath+list(simnight.truth["science"].keys())[0],
+                  tracematch=simtracematch, background=0)
+    ccd.set_default_variance()
+    return ccd.extract_cube(simwavesolution, SEDM_LBDA, hexagrid=simhexagrid)
@@ -0,0 +1,43 @@
+""" Tests of the batched standard star background fit (pysedm.background.get_contvalues_sdt_batch) """
+
+import numpy as np
+import pytest
+
+from pysedm import background
+
+COLUMNS = [2, 512, 1002, 1502, 2002]
+
+
+def get_model(contvalue, x):
+    """ continuum + gaussian model of the given contvalues (as Background.contvalue_to_polynome) """
+    from modefit.basics import normal_and_polynomial_model
+    poly = normal_and_polynomial_model(background.CONTDEGREE_GAUSS, background.NGAUSS)
+    poly.use_legendre = background.LEGENDRE_GAUSS
+    poly.setup([contvalue[k] for k in poly.FREEPARAMETERS])
+    return poly.get_model(x)
+
+
+def test_batch_matches_minuit(simccd):
+    """ the batch background model agrees with the Minuit one (get_contvalue_sdt) and is as good a fit.
+    The gaussian is almost degenerate with the polynomial, so the two fits may land on
+    different (mu0, sig0) with the same chi2: the evaluated models are compared, not the parameters. """
+    xslices = [simccd.get_xslice(i) for i in COLUMNS]
+    batch   = background.get_contvalues_sdt_batch(xslices)
+    for slice_, contvalue in zip(xslices, batch):
+        assert sorted(contvalue) == sorted(background.get_contvalue_names(True))
+        minuit = background.get_contvalue_sdt(slice_)
+        x      = np.arange(len(slice_.data))
+        noise  = np.sqrt(np.nanmedian(slice_.variance))
+        assert np.max(np.abs(get_model(contvalue, x) - get_model(minuit, x))) < 0.3*noise
+        assert contvalue["chi2"] <= minuit["chi2"] + 1e-3*minuit["chi2"]
+
+def test_batch_chi2(simccd):
+    """ the chi2 key is the chi2 of the model on the clipped data out of the traces """
+    slice_ = simccd.get_xslice(COLUMNS[1])
+    contvalue = background.get_contvalues_sdt_batch([slice_])[0]
+    lbda, data, var = [k[slice_.tracemaskout] for k in [slice_.lbda, slice_.data, slice_.variance]]
+    median = np.nanmedian(data)
+    nmad   = 1.4826 * np.nanmedian(np.abs(data - median))
+    flagin = (median - 2*nmad < data) & (data < median + 2*nmad)
+    chi2 = np.sum((data[flagin] - get_model(contvalue, lbda[flagin]))**2/var[flagin])
+    assert contvalue["chi2"] == pytest.approx(chi2, rel=1e-6)
@@ -0,0 +1,86 @@
+""" Tests of the ccd fast paths (pysedm.ccd) against their baselines, on the simulated night """
+
+import numpy as np
+import pytest
+
+
+def test_get_spectra_matches_get_spectrum(simccd, simtracematch):
+    """ one sparse product (get_spectra) == one masked sum per trace (get_spectrum) """
+    traceindexes = simtracematch.trace_indexes
+    spectra = simccd.get_spectra(traceindexes)
+    assert spectra.shape[0] == len(traceindexes)
+    assert np.allclose(spectra, np.asarray([simccd.get_spectrum(i) for i in traceindexes]))
+    assert np.allclose(simccd.get_spectra(traceindexes[:5], on="var"),
+                       np.asarray(simccd.get_spectrum(traceindexes[:5], on="var")))
+
+@pytest.mark.parametrize("lbdarange", [[7000, 9000], [4500, 5500]])
+def test_band_flux_matches_cube_slice(simccd, simcube, simwavesolution, lbdarange):
+    """ band flux measured on the ccd == mean of the cube slice """
+    slice_   = simcube.get_slice(*lbdarange, usemean=True)
+    bandflux = simccd.get_band_flux(simwavesolution, *lbdarange, traceindexes=simcube.indexes)
+    flagok   = np.isfinite(slice_) & np.isfinite(bandflux)
+    assert flagok.sum() > 0.9*len(slice_)
+    assert np.allclose(bandflux[flagok], slice_[flagok], rtol=1e-2)
+
+def test_sep_extract_tiled_matches_sep(simnight):
+    """ tiled (threaded) extraction == sep.extract on the full image """
+    sep = pytest.importorskip("sep")
+    from astropy.io import fits
+    from pysedm.ccd import sep_extract_tiled
+    data = np.ascontiguousarray(fits.getdata(simnight.nightpath+"Hg.fits"), dtype="float")
+    data = data - np.median(data)
+    err  = np.sqrt(np.clip(data, 0, None) + 25)
+    full  = np.sort(sep.extract(data, 5, err=err), order=["y", "x"])
+    tiled = np.sort(sep_extract_tiled(data, 5, err=err, ntiles=(8,1), nworkers=2), order=["y", "x"])
+    assert len(full) > 0
+    assert len(tiled) == len(full)
+    assert np.allclose(tiled["x"], full["x"]) and np.allclose(tiled["y"], full["y"])
+    # - the deblending of blended lines may share their flux slightly differently
+    assert np.allclose(tiled["flux"], full["flux"], rtol=1e-3)
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_float32_precision(simnight, simtracematch, simwavesolution, simhexagrid, simcube, monkeypatch, lazy):
+    """ float32 mode: image-sized arrays and cube in float32, fluxes as in float64 """
+    from pysedm.ccd import get_ccd
+    from pysedm.sedm import SEDM_LBDA
+    monkeypatch.setenv("PYSEDM_PRECISION", "float32") # see utils.tools.set_precision
+    ccd = get_ccd(simnight.nightpath+list(simnight.truth["science"].keys())[0],
+                  tracematch=simtracematch, background=0, lazy=lazy)
+    ccd.set_default_variance()
+    for key in ["data", "var", "background"]:
+        assert getattr(ccd, key).dtype == np.float32, key
+    cube = ccd.extract_cube(simwavesolution, SEDM_LBDA, hexagrid=simhexagrid)
+    assert cube.data.dtype == np.float32 and cube.variance.dtype == np.float32
+    assert simcube.data.dtype == np.float64
+    flagok = np.isfinite(simcube.data)
+    assert np.array_equal(flagok, np.isfinite(cube.data))
+    assert np.allclose(cube.data[flagok], simcube.data[flagok], rtol=1e-4, atol=1e-4*np.nanmax(simcube.data))
+
+def test_lazy_matches_eager(simnight, simtracematch):
+    """ lazy mode (memory-mapped rawdata, data and default variance derived on access)
+    gives the data and variance of the eager mode, before and after a background and after release_memory """
+    from pysedm.ccd import get_ccd
+    filename = simnight.nightpath+list(simnight.truth["science"].keys())[0]
+    eager, lazy = [get_ccd(filename, tracematch=simtracematch, background=0, lazy=lazy_)
+                       for lazy_ in [False, True]]
+    assert lazy.is_lazy() and not eager.is_lazy()
+    assert lazy._derived_properties["data"] is None
+    [ccd.set_default_variance() for ccd in [eager, lazy]]
+    assert lazy._properties["var"] is None
+    assert lazy._derived_properties["variance_offset"] == eager._derived_properties["variance_offset"]
+
+    def assert_same():
+        assert np.array_equal(lazy.data, eager.data)
+        assert np.array_equal(lazy.var, eager.var)
+
+    assert_same()
+    # - background
+    background = np.linspace(0, 10, eager.shape[0])[:,None] * np.ones(eager.shape)
+    [ccd.set_background(background, force_it=True) for ccd in [eager, lazy]]
+    assert lazy._derived_properties["data"] is None
+    assert_same()
+    # - release
+    [ccd.release_memory() for ccd in [eager, lazy]]
+    assert lazy._derived_properties["data"] is None and lazy._properties["var"] is None
+    assert eager._derived_properties["data"] is not None
+    assert_same()
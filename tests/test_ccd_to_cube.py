@@ -0,0 +1,60 @@
+""" Tests of the night calibration scripts (pysedm.script.ccd_to_cube) on simulated nights """
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pyifu")
+
+from pysedm import io
+from pysedm.sedm import SEDM_CCD_SIZE
+from pysedm.utils.simulation import NightSimulator
+
+REFDATE, DATE = "20000101", "20000102"
+IJ_OFFSET     = [3, -2]
+
+
+@pytest.fixture
+def nights(tmp_path, monkeypatch, simtracematch, simwavesolution, simhexagrid):
+    """ reference night with its calibrations, and a night whose dome is moved by IJ_OFFSET """
+    monkeypatch.setattr(io, "REDUXPATH", str(tmp_path))
+    ref = NightSimulator(REFDATE, reduxpath=str(tmp_path), hexradius=4, seed=1)
+    ref.writeto(ref.get_dome(), "dome.fits", noise=False, header={"OBJECT":"Calib: dome", "NAME":"Calib: dome"})
+    simtracematch.writeto(ref.nightpath+"%s_TraceMatch.pkl"%REFDATE, savemasks=False)
+    simtracematch.writeto(ref.nightpath+"%s_TraceMatch_WithMasks.pkl"%REFDATE)
+    simhexagrid.writeto(ref.nightpath+"%s_HexaGrid.pkl"%REFDATE)
+    simwavesolution.writeto(ref.nightpath+"%s_WaveSolution.pkl"%REFDATE)
+
+    night = NightSimulator(DATE, reduxpath=str(tmp_path), hexradius=4, seed=2)
+    night.writeto(np.roll(ref.get_dome(), IJ_OFFSET[::-1], axis=(0,1)), "dome.fits", noise=False,
+                  header={"OBJECT":"Calib: dome", "NAME":"Calib: dome"})
+    return ref, night
+
+def test_bootstrap_night_calibrations(nights, simtracematch, simwavesolution):
+    """ the reference calibrations follow the dome offset and are up-to-date for the pipeline """
+    from pysedm.script.ccd_to_cube import bootstrap_night_calibrations
+    from pysedm.script.pipeline import NightPipeline
+    registration = bootstrap_night_calibrations(DATE, REFDATE, fit_rotation=False)
+    assert registration["success"]
+    assert np.allclose([registration["i_offset"], registration["j_offset"]], IJ_OFFSET, atol=0.05)
+
+    # - TraceMatch: vertices and masks moved by the offset
+    tracematch = io.load_nightly_tracematch(DATE, withmask=True)
+    traceindexes = simtracematch.trace_indexes
+    for i in traceindexes:
+        assert np.allclose(tracematch.trace_vertices[i], np.asarray(simtracematch.trace_vertices[i])+IJ_OFFSET, atol=0.05)
+    i = traceindexes[len(traceindexes)//2]
+    assert np.allclose(tracematch.get_trace_mask(i),
+                       np.roll(simtracematch.get_trace_mask(i), IJ_OFFSET[::-1], axis=(0,1)))
+
+    # - WaveSolution: arc pixels run opposite to the ccd x-axis
+    wsol = io.load_nightly_wavesolution(DATE)
+    for i in simwavesolution.traceindexes:
+        shift = wsol.wavesolutions[i]["wavesolution"][-1] - simwavesolution.wavesolutions[i]["wavesolution"][-1]
+        assert shift == pytest.approx(-IJ_OFFSET[0], abs=0.05)
+    lbda = np.asarray([5000, 7000])
+    assert np.allclose((SEDM_CCD_SIZE[0]-1) - wsol.lbda_to_pixels(lbda, i),
+                       (SEDM_CCD_SIZE[0]-1) - simwavesolution.lbda_to_pixels(lbda, i) + IJ_OFFSET[0], atol=0.05)
+
+    # - the make-style pipeline does not rebuild them
+    status = NightPipeline(DATE).run(targets="^(tracematch|hexagrid|wavesolution)$", dry_run=True)
+    assert status == {"tracematch":"up-to-date", "hexagrid":"up-to-date", "wavesolution":"up-to-date"}
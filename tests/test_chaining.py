@@ -0,0 +1,60 @@
+""" Tests of the in-memory chaining tools (pysedm.utils.chaining) """
+
+import time
+import threading
+import pytest
+
+from pysedm.utils.chaining import AsyncWriter, ProductChain
+
+
+class _Product_( object ):
+    """ product whose writeto records the savefile (or fails) """
+    def __init__(self, written, fails=False, delay=0):
+        self.written, self.fails, self.delay = written, fails, delay
+
+    def writeto(self, savefile):
+        time.sleep(self.delay)
+        if self.fails:
+            raise IOError("disk full")
+        self.written.append(savefile)
+
+
+def test_writer_order_and_close():
+    written = []
+    writer  = AsyncWriter()
+    for k in range(10):
+        writer.submit(_Product_(written), "file%d"%k)
+    assert writer.close() == []
+    assert written == ["file%d"%k for k in range(10)]
+    # restarted by the next submit
+    writer.submit(_Product_(written), "file10")
+    writer.close()
+    assert written[-1] == "file10"
+
+def test_writers_are_independent():
+    """ a writer only waits for and raises the errors of its own products """
+    written = []
+    failing, working = AsyncWriter(), AsyncWriter()
+    failing.submit(_Product_(written, fails=True, delay=0.2), "bad")
+    working.submit(_Product_(written), "good")
+    assert working.close() == []
+    assert "good" in written
+    with pytest.raises(IOError):
+        failing.close()
+
+def test_writers_in_threads():
+    results = {}
+    def _run_(name, fails):
+        writer = AsyncWriter()
+        writer.submit(_Product_([], fails=fails, delay=0.05), name)
+        results[name] = writer.close(raise_errors=False)
+
+    threads = [threading.Thread(target=_run_, args=("exp%d"%k, k%2==1)) for k in range(4)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert results == {"exp0": [], "exp1": ["exp1"], "exp2": [], "exp3": ["exp3"]}
+
+def test_productchain():
+    chain = ProductChain().add_stage(lambda x, n=1: x+n, name="add", n=2).add_stage(lambda x: None)
+    assert chain.nstages == 2
+    assert chain.run(1) == 3
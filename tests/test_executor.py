@@ -0,0 +1,65 @@
+""" Tests of the unified executor backend (pysedm.utils.executor) """
+
+import os
+import threading
+import numpy as np
+import pytest
+
+from pysedm.utils.executor import get_executor, get_process_context, BACKENDS
+
+
+def _square_(task):
+    return task**2
+
+def _getenv_(task):
+    return os.getenv(task)
+
+def _read_shared_(task, shared):
+    """ returns the task-th element of the shared data and writes it (x2) in out """
+    value = shared["data"][task]
+    shared["out"][task] = 2*value
+    return value
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_map_ordered(backend):
+    tasks = list(range(50))
+    assert get_executor(backend, nworkers=2).map(_square_, tasks) == [t**2 for t in tasks]
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_shared_and_allocate(backend):
+    data = np.arange(20, dtype="float")
+    with get_executor(backend, nworkers=2, shared={"data": data}) as executor:
+        out = executor.allocate("out", data.shape)
+        values = executor.map(_read_shared_, range(len(data)))
+    assert np.allclose(values, data)
+    assert np.allclose(out, 2*data)
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_concurrent_executors(backend):
+    """ executors running at once in different threads do not see each other's arrays """
+    nloops = 20 if backend in ["serial", "thread"] else 3
+    errors = []
+    def _run_(offset):
+        try:
+            for _ in range(nloops):
+                data = np.arange(30, dtype="float") + offset
+                with get_executor(backend, nworkers=2, shared={"data": data}) as executor:
+                    out = executor.allocate("out", data.shape)
+                    values = executor.map(_read_shared_, range(len(data)))
+                assert np.allclose(values, data) and np.allclose(out, 2*data)
+                # an executor without shared arrays opened and closed meanwhile
+                get_executor("thread", nworkers=2).map(_square_, range(5))
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=_run_, args=(100*k,)) for k in range(3)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert errors == []
+
+def test_process_workers_are_not_forked(monkeypatch):
+    """ the worker processes are not forked (pools started from threads) and get the PYSEDM_* environment """
+    assert get_process_context().get_start_method() in ["forkserver", "spawn"]
+    monkeypatch.setenv("PYSEDM_PRECISION", "float32")
+    assert get_executor("process", nworkers=2).map(_getenv_, ["PYSEDM_PRECISION"]*4) == ["float32"]*4
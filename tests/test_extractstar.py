@@ -0,0 +1,52 @@
+""" Tests of the ADR trajectory cache and of the broadcast PSF evaluation against direct evaluations """
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pyifu")
+pytest.importorskip("modefit")
+
+from pyifu.adr import ADR
+from pysedm.sedm import get_adr_trajectory, SEDM_LBDA
+
+ADRPARAM = dict(airmass=1.3, parangle=40, temperature=10, pressure=630, relathumidity=20, lbdaref=6000)
+
+
+def test_adr_trajectory_matches_refract():
+    """ cached trajectory == adr.refract, and follows the changes of the ADR parameters """
+    adrmodel = ADR(**ADRPARAM)
+    for _ in range(2):
+        x, y = get_adr_trajectory(adrmodel, SEDM_LBDA, unit=0.55)
+        assert np.allclose([x, y], adrmodel.refract(0, 0, SEDM_LBDA, unit=0.55))
+    assert not x.flags.writeable
+    
+    adrmodel.set(airmass=1.8)
+    x2, y2 = get_adr_trajectory(adrmodel, SEDM_LBDA, unit=0.55)
+    assert not np.allclose(x2, x)
+    assert np.allclose([x2, y2], adrmodel.refract(0, 0, SEDM_LBDA, unit=0.55))
+    # - scalar wavelength
+    assert np.allclose(get_adr_trajectory(adrmodel, 5000., unit=0.55),
+                       np.reshape(adrmodel.refract(0, 0, 5000., unit=0.55), (2,1)))
+
+def test_psf_broadcast_matches_per_wavelength():
+    """ PSF3D_BiNormalCont.get_psf of the whole wavelength array == one (uncached) profile per wavelength """
+    from pysedm.utils.extractstar import PSF3D_BiNormalCont, binormal_profile
+    psf = PSF3D_BiNormalCont()
+    psf.set_psfdata({"adr":dict(xref=1.5, yref=-2., unit=0.55, **ADRPARAM),
+                     "profile":dict(stddev_ref=1.2, stddev_rho=-0.2, stddev_ratio=2.,
+                                    amplitude_ratio=0.3, theta=0.4, ell=0.1)})
+    x, y = np.meshgrid(np.linspace(-10, 10, 15), np.linspace(-10, 10, 15))
+    x, y = np.ravel(x), np.ravel(y)
+    lbda = SEDM_LBDA[::10]
+    cube = psf.get_psf(x, y, lbda)
+    assert cube.shape == (len(lbda), len(x))
+    assert np.allclose(cube, [psf.get_psf(x, y, l_) for l_ in lbda])
+    
+    adrmodel = ADR(**ADRPARAM)
+    baseline = []
+    for l_ in lbda:
+        xshift, yshift = adrmodel.refract(0, 0, l_, unit=0.55)
+        baseline.append(binormal_profile(x, y, xcentroid=1.5+xshift, ycentroid=-2+yshift,
+                                         stddev=1.2*(l_/6000)**(-0.2), stddev_ratio=2.,
+                                         amplitude_ratio=0.3, theta=0.4, ell=0.1))
+    assert np.allclose(cube, baseline)
@@ -0,0 +1,34 @@
+""" Tests of the hexagonal grid solver and lookup tables (pysedm.utils.hexagrid) on the simulated night """
+
+import numpy as np
+
+
+def test_qr_grid_matches_truth(simnight, simhexagrid):
+    """ the solved (Q,R) are the true lenslet (Q,R) up to a lattice symmetry and a translation """
+    ids  = np.asarray(simhexagrid.index_ids)
+    qr   = simhexagrid.index_to_qr(np.arange(simhexagrid.npoints))
+    true = np.asarray(simnight.qr)[ids]
+    assert not np.any(np.isnan(qr))
+    assert not np.any(simhexagrid.misplaced)
+    # qr = true . M + t, with M an integer matrix of determinant +-1
+    design = np.concatenate([true, np.ones((len(true), 1))], axis=1)
+    coefs  = np.linalg.lstsq(design, qr, rcond=None)[0]
+    assert np.allclose(design.dot(coefs), qr, atol=1e-6)
+    assert np.allclose(coefs, np.round(coefs), atol=1e-6)
+    assert np.isclose(abs(np.linalg.det(coefs[:2])), 1)
+
+def test_array_lookups_match_scalar(simhexagrid):
+    """ bulk id -> index -> qr / xy conversions == one call per id """
+    ids   = list(simhexagrid.index_ids)[::3] + [-5, 10**6]
+    index = simhexagrid.ids_to_index(ids)
+    assert list(index[-2:]) == [-1, -1]
+    assert list(index[:-2]) == [simhexagrid.ids_to_index(id_) for id_ in ids[:-2]]
+    
+    qr = simhexagrid.index_to_qr(index)
+    assert np.all(np.isnan(qr[-2:]))
+    assert np.allclose(qr[:-2], [simhexagrid.index_to_qr(i_) for i_ in index[:-2]])
+    for invert_rotation in [True, False]:
+        x, y = simhexagrid.index_to_xy(index, invert_rotation=invert_rotation)
+        assert np.all(np.isnan(x[-2:]))
+        assert np.allclose(np.asarray([x, y]).T[:-2],
+                           [simhexagrid.index_to_xy(i_, invert_rotation=invert_rotation) for i_ in index[:-2]])
@@ -0,0 +1,21 @@
+""" The pipeline entry points must stay light to import (see pysedm.script.pipeline) """
+
+import os
+import sys
+import subprocess
+
+import pysedm
+
+HEAVY_MODULES = ["pyifu", "astropy", "matplotlib", "shapely"]
+
+
+def test_pipeline_import_is_lazy():
+    """ importing pysedm.script.pipeline does not load the heavy dependencies """
+    code = "import sys, pysedm.script.pipeline; print(','.join(m for m in %r if m in sys.modules))"%HEAVY_MODULES
+    env  = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.dirname(pysedm.__file__)),
+                                                        os.environ.get("PYTHONPATH", "")]))
+    out  = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          capture_output=True, text=True, env=env, check=True)
+    assert out.stdout.strip() == ""
+    # - the -X importtime report goes to stderr
+    assert "pysedm.script.pipeline" in out.stderr
@@ -0,0 +1,75 @@
+""" Tests of the vectorized Mapper and WaveSolution conversions against their scalar baselines, on the simulated night """
+
+import numpy as np
+import pytest
+
+from pysedm.mapping import get_vertices_jbounds
+
+
+@pytest.fixture(scope="module")
+def simmapper(simtracematch, simhexagrid, simwavesolution):
+    """ Mapper of the simulated night """
+    from pysedm.mapping import Mapper
+    mapper = Mapper(tracematch=simtracematch, hexagrid=simhexagrid, wavesolution=simwavesolution)
+    mapper.derive_spaxel_mapping(list(simwavesolution.wavesolutions.keys()))
+    return mapper
+
+def test_pixels_to_lbda_array_matches_pynverse(simwavesolution):
+    """ Newton inversion of the wavelength solutions == pynverse inversion (one per trace) """
+    pytest.importorskip("pynverse")
+    traceindexes = list(simwavesolution.wavesolutions.keys())[::5]
+    lbda   = np.linspace(3700, 9400, 20)
+    pixels = simwavesolution.lbda_to_pixels_array(lbda[None,:], np.asarray(traceindexes)[:,None])
+    assert np.allclose(pixels, [simwavesolution.lbda_to_pixels(lbda, t) for t in traceindexes])
+    
+    lbda_fast = simwavesolution.pixels_to_lbda_array(pixels, np.asarray(traceindexes)[:,None])
+    lbda_base = [[simwavesolution.pixels_to_lbda(p, t) for p in pixels_] for t, pixels_ in zip(traceindexes, pixels)]
+    assert np.allclose(lbda_fast, lbda, atol=1e-6)
+    assert np.allclose(lbda_fast, np.asarray(lbda_base, dtype="float"), atol=1e-3)
+
+def test_centerlines_match_vertices(simmapper, simtracematch):
+    """ centerline polynomials == middle of the trace polygon """
+    for traceindex in simmapper.traceindexes[::4]:
+        verts = np.asarray(simtracematch.get_trace_vertices(traceindex), dtype="float")
+        i     = np.linspace(np.min(verts.T[0]), np.max(verts.T[0]), 30)[1:-1]
+        jlow, jup = get_vertices_jbounds(verts, i)
+        assert np.allclose(simmapper.get_trace_centerline_j(traceindex, i), (jlow+jup)/2., atol=0.05)
+
+@pytest.mark.parametrize("use_labelimage", [True, False])
+def test_ij_to_traceindex_array_matches_polygons(simmapper, simtracematch, use_labelimage):
+    """ vectorized (i, j) -> traceindex == shapely polygon containment (ij_to_traceindex) """
+    pytest.importorskip("shapely")
+    rng = np.random.default_rng(1)
+    traceindexes = rng.choice(simmapper.traceindexes, 20)
+    i, j = [], []
+    for traceindex in traceindexes:
+        verts = np.asarray(simtracematch.get_trace_vertices(traceindex), dtype="float")
+        i_    = rng.uniform(np.min(verts.T[0])+5, np.max(verts.T[0])-5, 5)
+        jlow, jup = get_vertices_jbounds(verts, i_)
+        i.append(i_)
+        j.append(rng.uniform(jlow+0.2*(jup-jlow), jup-0.2*(jup-jlow)))
+    # - plus pixels away from any trace
+    i, j = np.concatenate(i+[[10, 2040]]), np.concatenate(j+[[5, 2040]])
+    
+    baseline = [simmapper.ij_to_traceindex(i_, j_) for i_, j_ in zip(i, j)]
+    assert np.all(np.repeat(traceindexes, 5) == baseline[:-2])
+    assert np.all(simmapper.ij_to_traceindex_array(i, j, use_labelimage=use_labelimage)
+                  == [-1 if t_ is None else t_ for t_ in baseline])
+
+def test_centerlines_follow_tracematch_and_mapping(simtracematch, simhexagrid, simwavesolution):
+    """ the center lines (and label image) are derived again once the vertices or the spaxel mapping change """
+    from pysedm.mapping import Mapper
+    tmatch = simtracematch.copy()
+    mapper = Mapper(tracematch=tmatch, hexagrid=simhexagrid, wavesolution=simwavesolution)
+    traceindexes = list(simwavesolution.wavesolutions.keys())
+    mapper.derive_spaxel_mapping(traceindexes)
+    traceindex, i = traceindexes[0], np.mean(mapper.trace_centerlines["ibounds"][0])
+    j = mapper.get_trace_centerline_j(traceindex, i)
+    assert mapper.ij_to_traceindex_array(i, j) == traceindex
+    
+    tmatch.add_trace_offset(0, 3)
+    assert np.isclose(mapper.get_trace_centerline_j(traceindex, i), j+3)
+    assert mapper.ij_to_traceindex_array(i, j+3) == traceindex
+    
+    mapper.derive_spaxel_mapping(traceindexes[1:])
+    assert list(mapper.trace_centerlines["traceindexes"]) == sorted(traceindexes[1:])
@@ -0,0 +1,88 @@
+""" Tests of the stage instrumentation (pysedm.utils.performance) """
+
+import os
+import threading
+import multiprocessing
+import pytest
+
+from pysedm import io
+from pysedm.utils import performance
+
+DATE = "20000101"
+
+
+@pytest.fixture
+def nightdir(tmp_path, monkeypatch):
+    monkeypatch.setattr(io, "REDUXPATH", str(tmp_path))
+    os.makedirs(io.get_datapath(DATE))
+    return io.get_datapath(DATE)
+
+
+def _run_stages_(name, registry, nested=3, barrier=None):
+    """ top-level stage `name` with `nested` sub-stages """
+    with performance.stage(name, date=DATE, registry=registry, exposure=name):
+        for k in range(nested):
+            with performance.stage("%s.sub%d"%(name, k), registry=registry):
+                if barrier is not None:
+                    barrier.wait()
+                header = registry.to_header({})
+                assert header["PERFN0"][0] == name and header["PERFN1"][0] == "%s.sub%d"%(name, k)
+
+def _write_process_(args):
+    """ worker process: writes its own records to the night log """
+    reduxpath, name = args
+    io.REDUXPATH = reduxpath
+    _run_stages_(name, performance.PerfRegistry())
+
+
+def test_nested_stages(nightdir):
+    registry = performance.PerfRegistry()
+    _run_stages_("build", registry, nested=2)
+    records = registry.get_records()
+    assert [r["stage"] for r in records] == ["build.sub0", "build.sub1", "build"]
+    assert [r["depth"] for r in records] == [1, 1, 0]
+    assert all(r["date"] == DATE for r in records)
+    assert all(r["wall"] >= 0 and "_t0" not in r for r in records)
+    assert len(performance.read_night_log(DATE)) == 3
+    assert os.path.isfile(nightdir+"%s_PerfLog.csv"%DATE)
+
+def test_max_records(nightdir):
+    """ only the last records are kept in memory, all of them are in the night log """
+    registry = performance.PerfRegistry(max_records=5)
+    for k in range(3):
+        _run_stages_("exp%d"%k, registry, nested=2)
+    assert [r["stage"] for r in registry.get_records()] == \
+      ["exp1.sub1", "exp1", "exp2.sub0", "exp2.sub1", "exp2"]
+    assert len(performance.read_night_log(DATE)) == 9
+
+def test_concurrent_threads(nightdir):
+    """ stages of different threads have their own parents and night-log records """
+    registry = performance.PerfRegistry()
+    nthreads, nested = 4, 3
+    barrier  = threading.Barrier(nthreads)
+    threads  = [threading.Thread(target=_run_stages_, args=("exp%d"%k, registry, nested, barrier))
+                    for k in range(nthreads)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+    records = registry.get_records()
+    assert len(records) == nthreads*(nested+1)
+    for r in records:
+        if r["depth"] == 1:
+            assert r["parent"] == r["stage"].split(".")[0]
+        else:
+            assert r["depth"] == 0 and r["parent"] is None
+    log = performance.read_night_log(DATE)
+    assert len(log) == nthreads*(nested+1) # each record written once
+
+def test_concurrent_processes(nightdir):
+    """ the night log is appended to by several processes """
+    nprocs = 4
+    with multiprocessing.get_context("spawn").Pool(nprocs) as pool:
+        pool.map(_write_process_, [(io.REDUXPATH, "proc%d"%k) for k in range(nprocs)])
+    log = performance.read_night_log(DATE)
+    assert len(log) == nprocs*4
+    assert sorted(set(r["exposure"] for r in [r_["info"] for r_ in log] if "exposure" in r)) == \
+      ["proc%d"%k for k in range(nprocs)]
+    with open(nightdir+"%s_PerfLog.csv"%DATE) as f_:
+        assert len(f_.read().strip().splitlines()) == nprocs*4 + 1
@@ -0,0 +1,170 @@
+""" Tests of the make-style night pipeline (pysedm.script.pipeline) with dummy node actions """
+
+import os
+import pytest
+
+from pysedm import io
+from pysedm.script import pipeline
+from pysedm.script.pipeline import NightPipeline
+
+DATE = "20000101"
+
+
+@pytest.fixture
+def nightdir(tmp_path, monkeypatch):
+    monkeypatch.setattr(io, "REDUXPATH", str(tmp_path))
+    os.makedirs(io.get_datapath(DATE))
+    path = io.get_datapath(DATE)
+    for f_, content in [("raw.txt", "raw"), ("raw2.txt", "raw2")]:
+        with open(path+f_, "w") as fw:
+            fw.write(content)
+    return path
+
+def _concat_(path, name, inputs, output):
+    """ dummy node action: output is the concatenation of the inputs. Logs the call. """
+    with open(path+output, "w") as fw:
+        fw.write("".join(open(path+f_).read() for f_ in inputs))
+    with open(path+"actions.log", "a") as flog:
+        flog.write(name+"\n")
+
+def _fail_(path, name, inputs, output):
+    """ dummy node action that fails """
+    raise ValueError("%s fails"%name)
+
+def get_pipeline(path, njobs=1, actions={}):
+    """ raw -> a -> b and raw2 -> c """
+    pipe = NightPipeline(DATE, njobs=njobs, load=False)
+    for name, inputs, output in [("a", ["raw.txt"], "a.txt"), ("b", ["a.txt"], "b.txt"),
+                                 ("c", ["raw2.txt"], "c.txt")]:
+        pipe.add_node(name, inputs, [output], actions.get(name, _concat_), path, name, inputs, output)
+    return pipe
+
+def get_actions(path):
+    """ names of the nodes run so far """
+    if not os.path.isfile(path+"actions.log"):
+        return []
+    return open(path+"actions.log").read().split()
+
+
+@pytest.mark.parametrize("njobs", [1, 2])
+def test_build_once(nightdir, njobs):
+    """ all nodes are built in dependency order, then up-to-date (also for a new pipeline) """
+    assert get_pipeline(nightdir, njobs=njobs).run() == {"a":"built", "b":"built", "c":"built"}
+    assert get_actions(nightdir).index("a") < get_actions(nightdir).index("b")
+    assert open(nightdir+"b.txt").read() == "raw"
+    rerun = get_pipeline(nightdir, njobs=njobs)
+    for pipe in [rerun, rerun, get_pipeline(nightdir, njobs=njobs)]:
+        assert set(pipe.run().values()) == {"up-to-date"}
+    assert sorted(get_actions(nightdir)) == ["a", "b", "c"]
+
+def test_changed_input(nightdir):
+    """ a changed input rebuilds its node and the nodes reading its outputs """
+    get_pipeline(nightdir).run()
+    with open(nightdir+"raw.txt", "w") as fw:
+        fw.write("new raw")
+    assert get_pipeline(nightdir).run() == {"a":"built", "b":"built", "c":"up-to-date"}
+    assert open(nightdir+"b.txt").read() == "new raw"
+    # - missing output
+    os.remove(nightdir+"c.txt")
+    assert get_pipeline(nightdir).run() == {"a":"up-to-date", "b":"up-to-date", "c":"built"}
+
+def test_touched_input_is_hashed_once(nightdir, monkeypatch):
+    """ same content but new mtime: up-to-date and the new mtime is recorded """
+    get_pipeline(nightdir).run()
+    stat = os.stat(nightdir+"raw.txt")
+    os.utime(nightdir+"raw.txt", (stat.st_atime, stat.st_mtime+100))
+    assert set(get_pipeline(nightdir).run().values()) == {"up-to-date"}
+
+    hashed = []
+    def _signature_(filename, content=True):
+        if content:
+            hashed.append(filename)
+        return get_file_signature(filename, content=content)
+    get_file_signature = pipeline.get_file_signature
+    monkeypatch.setattr(pipeline, "get_file_signature", _signature_)
+    assert set(get_pipeline(nightdir).run().values()) == {"up-to-date"}
+    assert hashed == []
+
+def test_failed_dependency(nightdir):
+    """ the nodes depending on a failed node are skipped, the others are built """
+    with pytest.warns(UserWarning, match="a failed"):
+        status = get_pipeline(nightdir, actions={"a":_fail_}).run()
+    assert status == {"a":"failed", "b":"skipped", "c":"built"}
+    assert get_pipeline(nightdir).run() == {"a":"built", "b":"built", "c":"up-to-date"}
+
+def test_targets_force_and_dry_run(nightdir):
+    """ targets select the nodes and their dependencies; dry_run builds nothing """
+    assert get_pipeline(nightdir).run(dry_run=True) == {"a":"would-build", "b":"would-build", "c":"would-build"}
+    assert get_actions(nightdir) == []
+    assert get_pipeline(nightdir).run(targets="^b$") == {"a":"built", "b":"built"}
+    assert get_pipeline(nightdir).run(targets="^b$", force=True) == {"a":"up-to-date", "b":"built"}
+    assert get_actions(nightdir) == ["a", "b", "b"]
+
+def test_set_built(nightdir):
+    """ outputs built otherwise are recorded as up-to-date """
+    with open(nightdir+"a.txt", "w") as fw:
+        fw.write("raw")
+    pipe = get_pipeline(nightdir)
+    assert pipe.is_stale("a") == (True, "never built by the pipeline")
+    pipe.set_built(["a"])
+    assert get_pipeline(nightdir).run() == {"a":"up-to-date", "b":"built", "c":"built"}
+    assert "a" not in get_actions(nightdir)
+
+def test_parallel_nodes_are_not_forked(nightdir, monkeypatch):
+    """ njobs>1 starts its workers like utils.executor (see PROCESS_START_METHODS) """
+    from pysedm.utils import executor
+    contexts = []
+    def _get_process_context_():
+        contexts.append(get_process_context())
+        return contexts[-1]
+    get_process_context = executor.get_process_context
+    monkeypatch.setattr(executor, "get_process_context", _get_process_context_)
+    assert get_pipeline(nightdir, njobs=2).run() == {"a":"built", "b":"built", "c":"built"}
+    assert [c.get_start_method() for c in contexts] in [["forkserver"], ["spawn"]]
+
+def test_cube_node_chains_calibration_and_psf(tmp_path, monkeypatch):
+    """ the calibrated cube and the PSF extraction are outputs of the cube node, built in memory """
+    pytest.importorskip("pyifu")
+    import numpy as np
+    from pyifu.spectroscopy import Spectrum
+    from pysedm.sedm import SEDM_LBDA
+    from pysedm.script import ccd_to_cube
+    from pysedm.utils.simulation import simulate_night
+    monkeypatch.setattr(io, "REDUXPATH", str(tmp_path))
+    sim  = simulate_night(DATE, reduxpath=str(tmp_path), nscience=1, hexradius=2, seed=1, set_environ=False)
+    spec = Spectrum(None)
+    spec.create(lbda=SEDM_LBDA, data=np.ones(len(SEDM_LBDA)), variance=None, header=None)
+    fluxcal = "%s_%s_test.fits"%(io.PROD_SENSITIVITYROOT, DATE)
+    spec.writeto(sim.nightpath+fluxcal)
+
+    pipe = NightPipeline(DATE)
+    scifile = list(sim.truth["science"].keys())[0]
+    assert not any(n.startswith(("calcube:", "psf:")) for n in pipe.nodes)
+    node = pipe.nodes["cube:%s"%scifile]
+    cube = "%s_%s_STD-SIM0.fits"%(io.PROD_CUBEROOT, scifile.split(".fits")[0])
+    assert fluxcal in node["inputs"]
+    assert node["outputs"] == [cube, cube.replace(io.PROD_CUBEROOT, "%s_defcal"%io.PROD_CUBEROOT),
+                               cube.replace(io.PROD_CUBEROOT, io.PROD_SPECROOT+"_forcepsf_auto_")]
+
+    calls = []
+    monkeypatch.setattr(ccd_to_cube, "build_cubes", lambda *args, **kwargs: calls.append(kwargs))
+    node["action"](*node["args"], **node["kwargs"])
+    assert calls[0]["build_calibrated_cube"] and calls[0]["asyncwrite"]
+    assert [s_[0] for s_ in calls[0]["stages"].stages] == ["psf_extraction"]
+    # - no PSF extraction on the calibration cubes
+    class _Cube_( object ):
+        header = {"NAME": "Calib: dome"}
+    assert pipeline._psf_extraction_stage_(_Cube_(), DATE) is None
+
+def _nworkers_(path, name, inputs, output):
+    """ dummy node action: output is the number of workers of the node parallel loops """
+    from pysedm.utils.executor import get_nworkers
+    with open(path+output, "w") as fw:
+        fw.write("%d"%get_nworkers())
+
+def test_parallel_nodes_share_the_cpus(nightdir, monkeypatch):
+    """ each of the njobs nodes gets its share of the PYSEDM_NWORKERS cpus """
+    monkeypatch.setenv("PYSEDM_NWORKERS", "8")
+    pipe = get_pipeline(nightdir, njobs=3, actions={"a":_nworkers_, "c":_nworkers_})
+    assert pipe.run() == {"a":"built", "b":"built", "c":"built"}
+    assert open(nightdir+"a.txt").read() == open(nightdir+"c.txt").read() == "2"
@@ -0,0 +1,66 @@
+""" Tests of the night quality checks (pysedm.script.quality) on a simulated night """
+
+import os
+import json
+import numpy as np
+import pytest
+
+pytest.importorskip("pyifu")
+
+from pysedm import io
+from pysedm.script import quality
+from pysedm.utils.simulation import simulate_night
+
+DATE = "20000101"
+
+
+@pytest.fixture
+def night(tmp_path, monkeypatch):
+    """ simulated night (a standard star and a science target) with its tracematch,
+    and a standard star exposure without light """
+    from astropy.io import fits
+    monkeypatch.setattr(io, "REDUXPATH", str(tmp_path))
+    sim = simulate_night(DATE, reduxpath=str(tmp_path), nscience=2, hexradius=4, seed=3,
+                         set_environ=False)
+    sim.get_tracematch(build_masks=False, notebook=False).writeto(sim.nightpath+"%s_TraceMatch.pkl"%DATE,
+                                                                 savemasks=False)
+    empty = np.random.default_rng(1).normal(100, 5, fits.getdata(sim.nightpath+"dome.fits").shape)
+    fits.writeto(sim.nightpath+"crr_b_ifu%s_04_00_00.fits"%DATE, empty, fits.Header({"OBJECT":"STD-EMPTY"}))
+    # - the notrace mask is cached per date and tracematch modification time
+    quality._load_night_notrace_mask_.cache_clear()
+    yield sim
+    quality._load_night_notrace_mask_.cache_clear()
+
+def test_check_night_stdobs(night):
+    """ only the standard stars are checked, the empty one fails, and the report is saved """
+    report = quality.check_night_stdobs(DATE, nworkers=2)
+    assert report["nchecked"] == 2 and report["nfailed"] == 1
+    results = {r_["object"]: r_ for r_ in report["stdobs"]}
+    assert results["STD-SIM0"]["success"] and results["STD-SIM0"]["code"] == 0
+    assert not results["STD-EMPTY"]["success"] and results["STD-EMPTY"]["code"] == quality.STD_FAILURE_CODE
+    assert results["STD-SIM0"]["deltas"]["max"] > results["STD-EMPTY"]["deltas"]["max"]
+    with open(night.nightpath+"%s_%s.json"%(DATE, quality.QUALITY_ROOT)) as f_:
+        assert json.load(f_) == report
+
+def test_check_night_stdobs_target(night, tmp_path):
+    """ a target selects the ccds, standard star or not """
+    target = ",".join(sorted(night.truth["science"].keys())).replace(".fits", "")
+    savefile = str(tmp_path/"report.json")
+    report = quality.check_night_stdobs(DATE, target=target, savefile=savefile)
+    assert report["target"] == target
+    assert sorted(r_["object"] for r_ in report["stdobs"]) == ["SIM1", "STD-SIM0"]
+    assert all(r_["success"] for r_ in report["stdobs"])
+    with open(savefile) as f_:
+        assert json.load(f_) == report
+    assert quality.check_night_stdobs(DATE, target="nothing", savefile=False)["nchecked"] == 0
+
+def test_notrace_mask_follows_tracematch(night):
+    """ the cached mask is measured again once the tracematch is rebuilt """
+    mask = quality.get_night_notrace_mask(DATE)
+    assert quality.get_night_notrace_mask(DATE) is mask
+    tracematchfile = night.nightpath+"%s_TraceMatch.pkl"%DATE
+    mtime = os.path.getmtime(tracematchfile)
+    os.utime(tracematchfile, (mtime+10, mtime+10))
+    newmask = quality.get_night_notrace_mask(DATE)
+    assert newmask is not mask
+    np.testing.assert_array_equal(newmask, mask)
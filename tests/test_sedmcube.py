@@ -0,0 +1,86 @@
+""" Tests of the SEDMCube wavelength slices (pysedm.sedm) """
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pyifu")
+from pyifu.spectroscopy import Cube
+from pysedm.sedm import SEDMCube
+
+
+def get_cube(seed=1, nlbda=80, nspaxels=7):
+    """ small SEDMCube with a variance """
+    rng  = np.random.default_rng(seed)
+    cube = SEDMCube(None)
+    cube.create(rng.normal(10, 1, (nlbda, nspaxels)), variance=rng.uniform(0.5, 1.5, (nlbda, nspaxels)),
+                lbda=np.linspace(4000, 9000, nlbda),
+                spaxel_mapping={i:[i,0] for i in range(nspaxels)})
+    return cube
+
+@pytest.mark.parametrize("usemean", [True, False])
+def test_slices_match_pyifu(usemean):
+    cube = get_cube()
+    for lbdar in [[5000, 6000], [4000, 9000], [4321, 4500]]:
+        assert np.allclose(cube.get_slice(*lbdar, usemean=usemean),
+                           Cube.get_slice(cube, lbda_min=lbdar[0], lbda_max=lbdar[1], usemean=usemean))
+
+def test_cumulative_sums_follow_data_changes():
+    """ the cumulative sums are not reused once the data changed """
+    cube  = get_cube()
+    lbdar = [5000, 6000]
+    cube.get_slice(*lbdar)
+    cube.scale_by(2.)
+    assert np.allclose(cube.get_slice(*lbdar), Cube.get_slice(cube, lbda_min=lbdar[0], lbda_max=lbdar[1]))
+    cube.remove_flux(np.ones(len(cube.lbda)))
+    assert np.allclose(cube.get_slice(*lbdar), Cube.get_slice(cube, lbda_min=lbdar[0], lbda_max=lbdar[1]))
+    cube.set_data(cube.data*3, variance=cube.variance, spaxel_mapping=cube.spaxel_mapping)
+    assert np.allclose(cube.get_slice(*lbdar), Cube.get_slice(cube, lbda_min=lbdar[0], lbda_max=lbdar[1]))
+
+def test_cumulative_sums_after_inplace_change():
+    """ in-place changes are not seen by the cache until _reset_cumulative_sums_() """
+    cube  = get_cube()
+    lbdar = [5000, 6000]
+    before = cube.get_slice(*lbdar)
+    cube.data[:] *= 2
+    assert np.allclose(cube.get_slice(*lbdar), before)
+    cube._reset_cumulative_sums_()
+    assert np.allclose(cube.get_slice(*lbdar), 2*before)
+
+def test_cumulative_sums_do_not_hold_data():
+    """ the cache stores the id of the arrays, not the arrays """
+    cube = get_cube()
+    cube.get_slice(5000, 6000)
+    for cached in cube._derived_properties["cumulative_sums"].values():
+        for arrayid in cached[0]:
+            assert not any(isinstance(a_, np.ndarray) for a_ in arrayid)
+
+@pytest.mark.parametrize("data", ["data", "variance"])
+def test_simulated_cube_slices_match_pyifu(simcube, data):
+    """ cumulative-sum slices == pyifu slices on the simulated standard star cube """
+    ranges = [[4500, 5500], [7000, 9000], [3800, 9200]]
+    slices = simcube.get_slices(ranges, data=data)
+    for lbdar, slice_ in zip(ranges, slices):
+        base = Cube.get_slice(simcube, lbda_min=lbdar[0], lbda_max=lbdar[1], data=data)
+        assert np.allclose(slice_, base, equal_nan=True)
+        assert np.allclose(simcube.get_slice(*lbdar, data=data), base, equal_nan=True)
+
+def test_async_write_does_not_modify_the_cube(tmp_path, monkeypatch):
+    """ the cube is cast before it is submitted, the writer thread leaves it unchanged """
+    import threading
+    from pysedm.sedm import _writeto_
+    from pysedm.utils.chaining import AsyncWriter
+    monkeypatch.setenv("PYSEDM_PRECISION", "float32")
+    cube, release = get_cube(), threading.Event()
+    class _Blocking_( object ):
+        def writeto(self, savefile):
+            release.wait(5)
+
+    writer = AsyncWriter()
+    writer.submit(_Blocking_(), "blocking")
+    _writeto_(cube, str(tmp_path/"e3d_test.fits"), asyncwrite=writer)
+    assert cube.data.dtype == np.float32 and cube.variance.dtype == np.float32
+    arrays = [cube.data, cube.variance, cube.rawdata, cube.rawvariance]
+    release.set()
+    assert writer.close() == []
+    assert all(a_ is b_ for a_, b_ in zip(arrays, [cube.data, cube.variance, cube.rawdata, cube.rawvariance]))
+    assert (tmp_path/"e3d_test.fits").exists()
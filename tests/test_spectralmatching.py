@@ -0,0 +1,83 @@
+""" Tests of the trace matching fast paths (pysedm.spectralmatching) on the simulated night """
+
+import numpy as np
+import pytest
+
+from pysedm.spectralmatching import register_images, shift_sparse_mask, load_trace_masks
+
+
+@pytest.mark.parametrize("ij_offset", [[3, -2], [-1, 4], [7, 1]])
+def test_register_images_integer_shift(simnight, ij_offset):
+    """ the (i, j) shift of a moved dome is recovered """
+    dome  = simnight.get_dome()
+    moved = np.roll(dome, ij_offset[::-1], axis=(0,1))
+    registration = register_images(moved, dome, max_shift=10, ntiles=4)
+    assert np.allclose([registration["i_offset"], registration["j_offset"]], ij_offset, atol=0.05)
+    assert registration["residual"] < 0.2
+
+def test_shifted_masks_match_rebuilt_masks(simtracematch):
+    """ shift_sparse_mask (registration bootstrap) == masks built on the moved vertices """
+    i_offset, j_offset = 3, -2
+    traceindexes = simtracematch.trace_indexes[:5]
+    moved = simtracematch.copy()
+    moved.add_trace_offset(i_offset, j_offset)
+    load_trace_masks(moved, traceindexes, notebook=False)
+    for i in traceindexes:
+        shifted = shift_sparse_mask(simtracematch.trace_masks[i], i_offset, j_offset)
+        assert np.allclose(shifted.toarray(), moved.trace_masks[i].toarray())
+
+@pytest.mark.parametrize("j_offset", [0.4, -1.3])
+def test_fractional_shift_of_masks(simtracematch, j_offset):
+    """ masks moved by a fractional offset (trace flexure) follow the masks rebuilt on the moved vertices """
+    traceindexes = simtracematch.trace_indexes[:3]
+    moved = simtracematch.copy()
+    moved.add_trace_offset(0, j_offset)
+    load_trace_masks(moved, traceindexes, notebook=False)
+    j = np.arange(moved.trace_masks[traceindexes[0]].shape[0])[:,None]
+    for i in traceindexes:
+        shifted, rebuilt = shift_sparse_mask(simtracematch.trace_masks[i], 0, j_offset).toarray(), moved.trace_masks[i].toarray()
+        original = simtracematch.trace_masks[i].toarray()
+        incol = rebuilt.sum(axis=0) > 0
+        assert np.allclose(shifted.sum(axis=0), original.sum(axis=0))
+        # - trace center of each column
+        jshifted = (shifted*j).sum(axis=0)[incol] / shifted.sum(axis=0)[incol]
+        jrebuilt = (rebuilt*j).sum(axis=0)[incol] / rebuilt.sum(axis=0)[incol]
+        assert np.max(np.abs(jshifted-jrebuilt)) < 0.05
+
+def test_extraction_matrix_rows(simtracematch, simccd):
+    """ the cached extraction matrix follows the requested traceindexes """
+    traceindexes = simtracematch.trace_indexes[::-7]
+    spectra = simtracematch.get_extraction_matrix(traceindexes) * np.ravel(simccd.data)
+    assert np.allclose(spectra.reshape(len(traceindexes), -1),
+                       [np.sum(simccd.data*simtracematch.get_trace_mask(i), axis=0) for i in traceindexes])
+
+def test_polygons_to_mask():
+    """ pixels touched by the polygons (pixel i spans [i-0.5, i+0.5]) """
+    from pysedm.spectralmatching import polygons_to_mask
+    rectangle = [[2.2, 1.2], [5.7, 1.2], [5.7, 3.4], [2.2, 3.4]]
+    expected  = np.zeros((8, 10), dtype="bool")
+    expected[1:4, 2:7] = True
+    assert np.array_equal(polygons_to_mask([rectangle], shape=(8, 10)), expected)
+    # - polygon within a pixel, polygon partly out of the ccd, polygon out of the ccd
+    triangle = [[8.1, 6.1], [8.3, 6.1], [8.2, 6.3]]
+    edge     = [[-3, -3], [0.2, -3], [0.2, 0.2], [-3, 0.2]]
+    outside  = [[20, 20], [22, 20], [22, 22]]
+    expected[6, 8] = expected[0, 0] = True
+    assert np.array_equal(polygons_to_mask([rectangle, triangle, edge, outside], shape=(8, 10)), expected)
+
+def test_notrace_mask_matches_rasterization(simnight):
+    """ native resolution mask == pixels overlapping a trace, and agrees with the RGBA rasterization """
+    import shapely
+    tracematch = simnight.get_tracematch(build_masks=False, notebook=False)
+    notrace = tracematch.get_notrace_mask()
+    assert notrace is tracematch.get_notrace_mask() # cached
+    # - exact: the pixel overlaps a trace polygon (checked around the masked pixels)
+    from scipy.ndimage import binary_dilation
+    ys, xs = np.nonzero(binary_dilation(~notrace, iterations=2))
+    traces = shapely.union_all([shapely.Polygon(tracematch.trace_vertices[i]) for i in tracematch.trace_indexes])
+    overlap = np.zeros(notrace.shape, dtype="bool")
+    overlap[ys, xs] = shapely.area(shapely.intersection(shapely.box(xs-0.5, ys-0.5, xs+0.5, ys+0.5), traces)) > 0
+    assert np.array_equal(notrace, ~overlap)
+    # - the rasterization misses some pixels with a small overlap
+    rasterized = tracematch.get_notrace_mask(subpixelization=10)
+    assert np.mean(notrace == rasterized) > 0.9995
@@ -0,0 +1,151 @@
+""" Tests of the watch mode (pysedm.script.watch) on a simulated night """
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pyifu")
+pytest.importorskip("sep")
+pytest.importorskip("pynverse")
+
+from pysedm import io
+from pysedm.utils.simulation import simulate_night
+
+DATE = "20000101"
+
+
+def _sepobject_works_():
+    """ astrobject's SepObject (used by the trace flexure) may not support the installed numpy """
+    import sep
+    from astrobject.collections import get_sepobject
+    y, x = np.mgrid[:32,:32]
+    image = np.exp(-((x-16.)**2+(y-16.)**2)/4.)*100
+    try:
+        get_sepobject(sep.extract(image, 10))
+    except AttributeError:
+        return False
+    return True
+
+def _simulate_night_(path, monkeypatch, nscience=1, seed=2):
+    """ simulated night with its calibrations (true tracematch with masks, hexagrid,
+    wavesolution, flat) and flat backgrounds (their fit is too slow for a test) """
+    from modefit.basics import polynomial_model
+    from pysedm.background import get_background, DEGREE
+    from pysedm.script.ccd_to_cube import build_flatfield
+    monkeypatch.setenv("SEDMREDUXPATH", str(path))
+    monkeypatch.setattr(io, "REDUXPATH", str(path))
+    sim  = simulate_night(DATE, reduxpath=str(path), nscience=nscience, hexradius=4, seed=seed,
+                          set_environ=False)
+    path = sim.nightpath
+    smap = sim.get_tracematch(build_masks=True, notebook=False)
+    smap.writeto(path+"%s_TraceMatch.pkl"%DATE, savemasks=False)
+    smap.writeto(path+"%s_TraceMatch_WithMasks.pkl"%DATE)
+    smap.extract_hexgrid().writeto(path+"%s_HexaGrid.pkl"%DATE)
+    sim.get_wavesolution().writeto(path+"%s_WaveSolution.pkl"%DATE)
+    for filename in ["dome.fits"]+list(sim.truth["science"].keys()):
+        get_background({col:{k:0 for k in polynomial_model(DEGREE).FREEPARAMETERS}
+                            for col in range(2, 2048, 200)}
+                       ).writeto(io.filename_to_background_name(path+filename))
+    build_flatfield(DATE, savefig=False)
+    return sim
+
+@pytest.fixture
+def night(tmp_path, monkeypatch):
+    """ simulated night with one exposure (see _simulate_night_) """
+    return _simulate_night_(tmp_path, monkeypatch)
+
+@pytest.fixture
+def busynight(tmp_path, monkeypatch):
+    """ simulated night with three exposures and an inverse sensitivity (see _simulate_night_) """
+    from pyifu.spectroscopy import Spectrum
+    from pysedm.sedm import SEDM_LBDA
+    sim  = _simulate_night_(tmp_path, monkeypatch, nscience=3)
+    spec = Spectrum(None)
+    spec.create(lbda=SEDM_LBDA, data=np.ones(len(SEDM_LBDA))*2, variance=None, header=None)
+    spec.writeto(sim.nightpath+"%s_%s_test.fits"%(io.PROD_SENSITIVITYROOT, DATE))
+    return sim
+
+def test_watch_simulated_night(night, monkeypatch):
+    """ the exposure is reduced once, with the trace masks shifted (not rebuilt) """
+    if not _sepobject_works_():
+        pytest.skip("astrobject's SepObject does not support the installed numpy")
+    from pysedm.script import ccd_to_cube
+    from pysedm.script.watch import NightWatcher
+
+    def _rebuilt_(*args, **kwargs):
+        raise AssertionError("the trace masks have been rebuilt")
+    monkeypatch.setattr(ccd_to_cube, "load_trace_masks", _rebuilt_)
+
+    # - too few spaxels for the sodium line flexure (nspaxels*averaging faintest)
+    watcher = NightWatcher(DATE, interval=0.1, psf_extraction=False, fluxcalibration=False,
+                           verbose=False, flexure_corrected=False)
+    watcher.run(until_idle=True)
+    scifile = list(night.truth["science"].keys())[0]
+    info    = watcher.status[scifile]
+    assert info["state"] == "done", info.get("error")
+    assert len(info["products"]) == 1
+
+    from pysedm.sedm import get_sedmcube
+    cube = get_sedmcube(night.nightpath+info["products"][0])
+    assert cube.header["FLXTRACE"]
+    assert np.sum(np.isfinite(cube.data)) > 0
+
+    # - restart: nothing left to do
+    watcher = NightWatcher(DATE, interval=0.1, verbose=False)
+    assert watcher.get_new_exposures() == []
+    assert watcher.status[scifile]["state"] == "done"
+
+def test_watch_queue_and_restart(busynight):
+    """ back-pressure, parallel workers, flux calibrated products and restart of interrupted exposures
+    (no trace flexure: independent of sep) """
+    import json
+    from pysedm.script.watch import NightWatcher
+    options = dict(interval=0.1, psf_extraction=False, fluxcalibration=True, verbose=False,
+                   traceflexure_corrected=False, flexure_corrected=False)
+    scifiles = sorted(busynight.truth["science"].keys())
+    
+    # - back-pressure: only queuesize exposures are queued, the scan stops at the first one left pending
+    watcher = NightWatcher(DATE, nworkers=2, queuesize=1, **options)
+    assert watcher.get_new_exposures() == [] # sizes recorded, not yet stable
+    assert watcher.scan() == 2
+    assert [watcher.status.get(f, {}).get("state") for f in scifiles] == ["queued", "pending", None]
+    
+    watcher.run(until_idle=True)
+    for scifile in scifiles:
+        info = watcher.status[scifile]
+        assert info["state"] == "done", info.get("error")
+        assert info["ntries"] == 1
+        basename = scifile.split(".fits")[0]
+        assert [p.split(basename)[0] for p in info["products"]] == ["%s_"%io.PROD_CUBEROOT, "%s_defcal_"%io.PROD_CUBEROOT]
+        
+    # - restart: an exposure interrupted while running is reduced again, the done ones are not
+    with open(watcher.statusfile) as f_:
+        status = json.load(f_)
+    status[scifiles[1]]["state"] = "running"
+    with open(watcher.statusfile, "w") as f_:
+        json.dump(status, f_)
+    watcher = NightWatcher(DATE, nworkers=2, queuesize=1, **options)
+    assert watcher.status[scifiles[1]]["state"] == "pending"
+    watcher.run(until_idle=True)
+    assert [watcher.status[f]["ntries"] for f in scifiles] == [1, 2, 1]
+    assert all(watcher.status[f]["state"] == "done" for f in scifiles)
+
+def test_watch_shares_the_cpus(tmp_path, monkeypatch):
+    """ the background fit of each worker gets its share of the cpus (no full pool per worker) """
+    from pysedm import background, ccd
+    from pysedm.script.watch import NightWatcher
+    monkeypatch.setattr(io, "REDUXPATH", str(tmp_path))
+    monkeypatch.setenv("PYSEDM_NWORKERS", "8")
+    ncores = []
+    class _Stop_( Exception ):
+        pass
+    def _build_background_(ccd_, ncore=None, **kwargs):
+        ncores.append(ncore)
+        raise _Stop_()
+    monkeypatch.setattr(ccd, "get_ccd", lambda *args, **kwargs: None)
+    monkeypatch.setattr(background, "build_background", _build_background_)
+    for options, ncore in [(dict(nworkers=3), 2), (dict(nworkers=16), 1), (dict(nworkers=3, ncore=5), 5)]:
+        watcher = NightWatcher(DATE, verbose=False, **options)
+        watcher._derived_properties["calibrations"] = {"tracematch": None}
+        with pytest.raises(_Stop_):
+            watcher.reduce_exposure(str(tmp_path/"crr_b_ifu20000101_03_00_00.fits"))
+        assert ncores[-1] == ncore
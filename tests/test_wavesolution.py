@@ -0,0 +1,28 @@
+""" Tests of the sodium line flexure fit (pysedm.wavesolution.Flexure) on the simulated night """
+
+import numpy as np
+import pytest
+
+
+def test_batch_sodiumlines_match_sequential(simcube):
+    """ single least-squares fit of all the sodium lines == one modefit fit per spectrum """
+    pytest.importorskip("modefit")
+    from pysedm.wavesolution import Flexure
+    np.random.seed(3) # spaxel averaging groups
+    flexure = Flexure(simcube)
+    flexure.fit_cube_sodiumlines(nspaxels=12, averaging=5, batch=True, compare_to_sequential=True)
+    assert np.isfinite(flexure.sodiumline_batch_difference)
+    assert flexure.sodiumline_batch_difference < 1 # AA (the line sigma is 15-50 AA)
+    mus, _ = flexure.get_cube_sodiumline_wavelength(array=True)
+    assert len(mus) == 12 and np.all(np.isfinite(mus))
+
+def test_batch_sodiumlines_follow_reference(simcube):
+    """ the fitted wavelength window follows sodium_reference """
+    from pysedm.wavesolution import Flexure, SODIUM_SKYLINE_LBDA
+    spectra = [simcube.get_spectrum(i) for i in simcube.indexes[:3]]
+    fluxes  = [spec_.data for spec_ in spectra]
+    fitvalues = Flexure(simcube).fit_sodiumlines_batch(spectra[0].lbda, fluxes, sodium_reference=SODIUM_SKYLINE_LBDA)
+    # - a reference far from the line: the line position is bounded by reference -+ lbda_buffer/2
+    shifted   = Flexure(simcube).fit_sodiumlines_batch(spectra[0].lbda, fluxes, sodium_reference=7000, lbda_buffer=100)
+    assert all(abs(fv["mu0"]-SODIUM_SKYLINE_LBDA) < 50 for fv in fitvalues)
+    assert all(6950 <= fv["mu0"] <= 7050 for fv in shifted)